@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import multiprocessing
+import sys
+import time
+import json
+import random
+import platform
+import argparse
+import timeit
+import fbcrc
+import fbpacket as fb
+import fbdecode
+import fbview
+import fbcmd
+import fbmetrics
+import fbtrace
+import fbhid
+from fbpacket import Container
+import parse_control_log
+from utils import construct_str, construct_pretty
+
+def crc16_legacy(data):
+    # The original per-character implementation, kept as a reference point.
+    # crc is never masked inside the loop, so it grows into a long and the
+    # cost is quadratic in len(data).
+    crc = 0
+    i = 0
+    while i < len(data):
+        j = 255 & (ord(data[i]) ^ crc >> 8)
+        crc = fbcrc._crcTable[j] ^ crc << 8;
+        i += 1
+    return 65535 & (0 ^ crc)
+
+def best_time(func, number, repeat=3):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+# Seconds per operation for each "bench/case" measured in this run
+results = {}
+
+def record(bench, case, seconds):
+    results['%s/%s' % (bench, case)] = seconds
+
+def report(name, size, seconds):
+    record('crc', '%s %d' % (name, size), seconds)
+    print "%-24s %9d B  %10.2f us  %9.2f MB/s" % (
+        name, size, seconds * 1e6, size / seconds / 1e6 if seconds else 0)
+
+LEGACY_MAX_SIZE = 4096
+
+def bench_crc(sizes=(20, 1024, 64 * 1024, 1024 * 1024)):
+    engines = [
+        ('crc16_legacy', crc16_legacy),
+        ('crc16_sliced', fbcrc._crc16_sliced),
+        ('crc16', fbcrc.crc16),
+    ]
+    for size in sizes:
+        data = os.urandom(size)
+        number = max(1, 200000 // size)
+        for name, func in engines:
+            if func is crc16_legacy and size > LEGACY_MAX_SIZE:
+                continue
+            report(name, size, best_time(lambda: func(data), number))
+        chunks = [data[i:i+20] for i in range(0, size, 20)]
+        report('Crc16.update(20 B)', size,
+               best_time(lambda: reduce(lambda c, b: c.update(b), chunks, fbcrc.Crc16()), number))
+
+def sample_in_reports():
+    # One well-formed, full length report per known IN opcode. The payloads
+    # are the same from run to run, so results compare against a baseline.
+    reports = []
+    r = random.Random(0)
+    for opCode, opStr in sorted(fb.HID_CTRL_IN_OPCODE.decoding.items()):
+        data = chr(fb.HID_REPORT_SIZE) + chr(opCode) + ''.join(
+            chr(r.randrange(256)) for _ in range(fb.HID_REPORT_SIZE - 2))
+        if opStr in ('HID_CTRL_IN_VERSION_RESPONSE', 'HID_CTRL_IN_BOOTLOADER_VERSION_RESPONSE'):
+            # A valid ccIC
+            data = data[:20] + '\x01' + data[21:]
+        reports.append((opStr, data))
+    return reports
+
+def sample_out_reports():
+    # A zero-filled command per known OUT opcode, as fbtalk would send it
+    return [(opStr, fbcmd.HID_OUT_TEMPLATES[opStr].build())
+            for opStr in sorted(fbcmd.HID_OUT_TEMPLATES)]
+
+def bench_decode():
+    for opStr, data in sample_in_reports():
+        for name, func in [('construct', fb.parse_hid_IN), ('compiled', fbdecode.parse_hid_IN)]:
+            t = best_time(lambda: func(data), 2000)
+            record('decode', '%s %s' % (opStr, name), t)
+            print "%-40s %-10s %8.2f us" % (opStr, name, t * 1e6)
+
+def bench_decode_out():
+    for opStr, data in sample_out_reports():
+        for name, func in [('construct', fb.parse_hid_OUT), ('compiled', fbdecode.parse_hid_OUT)]:
+            t = best_time(lambda: func(data), 2000)
+            record('decode-out', '%s %s' % (opStr, name), t)
+            print "%-40s %-10s %8.2f us" % (opStr, name, t * 1e6)
+
+def bench_view():
+    # Cost of getting at hdr.opcode, the common case for handlers
+    for opStr, data in sample_in_reports():
+        for name, func in [('compiled', fbdecode.parse_hid_IN), ('view', fbview.view_hid_IN)]:
+            t = best_time(lambda: func(data).hdr.opcode, 2000)
+            record('view', '%s %s' % (opStr, name), t)
+            print "%-40s %-10s %8.2f us" % (opStr, name, t * 1e6)
+
+def construct_read_memory(start, size):
+    # How fbtalk.readTrackerMemory used to build each command
+    return fb.make_data_packet(fb.RF_ReadTrackerMemoryPkt.build(
+        Container(
+            hdr = Container(rsvd = 0, group = 'RF_PKT_GRP_READ', opcode = 'RF_PKT_READ_TRACKER_MEMORY'),
+            startAddr = start,
+            numBytesToRead = size,
+        )
+    ))
+
+def bench_build(count=1000):
+    template = fbcmd.RF_TEMPLATES['RF_PKT_READ_TRACKER_MEMORY']
+    names = ['startAddr', 'numBytesToRead']
+    rows = [(i * 256, 256) for i in range(count)]
+    buf = bytearray(template.size * count)
+    for name, func in [
+            ('construct', lambda: [construct_read_memory(*row) for row in rows]),
+            ('template.build', lambda: [template.build(startAddr=a, numBytesToRead=n) for a, n in rows]),
+            ('template.build_many', lambda: template.build_many(names, rows, buf)),
+            ]:
+        t = best_time(func, 3)
+        record('build', name, t / count)
+        print "%-24s %6d cmds  %8.2f us/cmd" % (name, count, t / count * 1e6)
+
+def bench_commands():
+    # The commands fbtalk sends, built the way fbtalk builds them
+    H = fbcmd.HID_OUT_TEMPLATES
+    R = fbcmd.RF_TEMPLATES
+    for name, func in [
+            ('establishLinkEx', lambda: H['HID_CTRL_OUT_ESTABLISH_LINK_EX'].build(addr='01-02-03-04-05-06')),
+            ('setTX', lambda: H['HID_CTRL_OUT_ENABLE_TX_PIPE'].build(enable=True)),
+            ('setTransmitterPower', lambda: H['HID_CTRL_OUT_SET_TRANSMITTER_POWER'].build(
+                transmitterPower='TRANSMITTER_POWER_MAXIMUM')),
+            ('readTrackerMemory', lambda: R['RF_PKT_READ_TRACKER_MEMORY'].build(
+                startAddr=0x1000, numBytesToRead=256)),
+            ('setTrackerTime', lambda: R['RF_PKT_MISC_SET_DEVICE_CLOCK'].build(gmtTime=1400000000)),
+            ('trackerEcho', lambda: R['RF_PKT_MISC_ECHO_PACKET'].build(payloadBytes='0123456789abcdef')),
+            ('construct readTrackerMemory', lambda: construct_read_memory(0x1000, 256)),
+            ]:
+        t = best_time(func, 10000)
+        record('commands', name, t)
+        print "%-30s %8.2f us" % (name, t * 1e6)
+    for size in (3, 10, 20):
+        pkt = fb.RF_PKT_MAGIC_BYTE + os.urandom(size - 1)
+        t = best_time(lambda: fb.make_data_packet(pkt), 100000)
+        record('commands', 'make_data_packet %d' % size, t)
+        print "%-30s %8.2f us" % ('make_data_packet %d B' % size, t * 1e6)
+
+def bench_pretty():
+    # Rendering parsed reports, as handlers and parse_control_log do
+    for opStr, data in sample_in_reports():
+        packet = fbdecode.parse_hid_IN(data)
+        for name, func in [('str', str), ('construct_str', construct_str),
+                           ('construct_pretty', construct_pretty)]:
+            t = best_time(lambda: func(packet), 1000)
+            record('pretty', '%s %s' % (opStr, name), t)
+            print "%-40s %-16s %8.2f us" % (opStr, name, t * 1e6)
+
+def bench_metrics():
+    # Per-report cost of the transport instrumentation
+    h = fbmetrics.Histogram()
+    m = fbmetrics.Metrics()
+    ack = [2, 254] + [0] * 30
+    cmd = [2, 13] + [0] * 30
+    def round_trip():
+        m.command_sent(cmd)
+        m.ctrl_report(ack)
+    for name, func in [
+            ('Histogram.record', lambda: h.record(1234)),
+            ('Metrics.ctrl_report', lambda: m.ctrl_report(ack)),
+            ('command round trip', round_trip),
+            ('Metrics.data_report', lambda: m.data_report(ack)),
+            ]:
+        t = best_time(func, 100000)
+        record('metrics', name, t)
+        print "%-24s %8.2f us" % (name, t * 1e6)
+
+def bench_trace():
+    # Per-frame cost of the always-on tracer, for each report type it sees
+    t = fbtrace.Tracer()
+    for name, report in [('str', '\x02\xfe' + '\0' * 30),
+                         ('list', [2, 254] + [0] * 30),
+                         ('bytearray', bytearray(32))]:
+        s = best_time(lambda: t.trace(fbtrace.DIR_IN, fbtrace.IF_CTRL, report), 100000)
+        record('trace', name, s)
+        print "%-24s %8.2f us" % (name, s * 1e6)
+
+class _StaticDevice(object):
+    # hid.device stand-in that always has the same report ready
+    def __init__(self, report):
+        self.report = report
+
+    def read(self, max_length, timeout_ms=0):
+        return self.report[:max_length]
+
+    def write(self, data):
+        return len(data)
+
+def bench_hid():
+    # Per-report cost of getting reports to and from a hid.device, by hand
+    # and through an fbhid.Transport; the device's own list is left out
+    report = [2, 254] + [0] * 30
+    msg = '\x02\x01' + '\0' * 30
+    # What fbcmd.Template.patch() hands back
+    patched = bytearray(msg)
+    dev = _StaticDevice(report)
+    t = fbhid.Transport(dev)
+    def legacy_read():
+        x = dev.read(32)
+        return ''.join(chr(c) for c in x)
+    def legacy_parse():
+        return fbdecode.parse_hid_IN(legacy_read())
+    for name, func in [
+            ('write legacy', lambda: dev.write([ord(c) for c in msg])),
+            ('write Transport', lambda: t.write(msg)),
+            ('write Transport bytearray', lambda: t.write(patched)),
+            ('read legacy', legacy_read),
+            ('read Transport.recv', lambda: t.recv()),
+            ('read recv+tobytes', lambda: t.recv().tobytes()),
+            ('read+parse legacy', legacy_parse),
+            ('read+parse Transport', lambda: fbdecode.parse_hid_IN(t.recv())),
+            ]:
+        s = best_time(func, 100000)
+        record('hid', name, s)
+        print "%-26s %8.2f us" % (name, s * 1e6)
+
+def rf_escape_bytewise(data):
+    # What escaping by hand looks like, as a reference point
+    out = []
+    for c in data:
+        if c == '\xDB':
+            out.append('\xDB\xDD')
+        elif c == '\xC0':
+            out.append('\xDB\xDC')
+        else:
+            out.append(c)
+    return ''.join(out)
+
+def bench_escape(sizes=(20, 1024, 64 * 1024)):
+    r = random.Random(0)
+    for size in sizes:
+        number = max(1, 200000 // size)
+        # Random bytes, where 1 in 128 needs escaping, and the worst case
+        for kind, data in [('random', ''.join(chr(r.randrange(256)) for _ in xrange(size))),
+                           ('all-escapes', '\xC0\xDB' * (size // 2))]:
+            escaped = fb.rf_escape(data)
+            chunks = [buffer(escaped, i, 20) for i in xrange(0, len(escaped), 20)]
+            def incremental():
+                feed = fb.RFUnescaper().feed
+                for chunk in chunks:
+                    feed(chunk)
+            for name, func in [
+                    ('bytewise escape', lambda: rf_escape_bytewise(data)),
+                    ('rf_escape', lambda: fb.rf_escape(data)),
+                    ('rf_escape bytearray', lambda: fb.rf_escape(bytearray(data))),
+                    ('rf_unescape', lambda: fb.rf_unescape(escaped)),
+                    ('RFUnescaper 20 B', incremental),
+                    ]:
+                t = best_time(func, number)
+                record('escape', '%s %s %d' % (name, kind, size), t)
+                print "%-20s %-12s %9d B  %10.2f us  %9.2f MB/s" % (
+                    name, kind, size, t * 1e6, size / t / 1e6 if t else 0)
+
+def make_log(path, lines, control_every=4):
+    # Synthetic USB capture: every control_every-th line is CONTROL IN, the
+    # one after it CONTROL OUT, the rest other traffic
+    reports = [data for _, data in sample_in_reports()
+               if fb.HID_CTRL_IN_OPCODE.encoding[_] in (2, 3, 5, 255)]
+    ins = [data.encode('hex').upper() for data in reports]
+    outs = [fbcmd.HID_OUT_TEMPLATES['HID_CTRL_OUT_FORCE_DISCONNECT'].build().encode('hex').upper(),
+            fbcmd.RF_TEMPLATES['RF_PKT_READ_TRACKER_MEMORY'].build().encode('hex').upper()]
+    with open(path, 'wb') as f:
+        out = []
+        for i in xrange(lines):
+            r = i % control_every
+            if r == 0:
+                out.append('[%10d] CONTROL IN bytes: %s\n' % (i, ins[i % len(ins)]))
+            elif r == 1:
+                out.append('[%10d] CONTROL OUT bytes: %s\n' % (i, outs[i % len(outs)]))
+            else:
+                out.append('[%10d] usb 1-1: URB %08x status 0 len 32\n' % (i, i))
+            if len(out) == 10000:
+                f.write(''.join(out))
+                out = []
+        f.write(''.join(out))
+
+def legacy_parse_log(path):
+    # The original line-at-a-time loop, minus the print
+    reg = parse_control_log.reg
+    with open(path) as logfile:
+        for line in logfile:
+            match = reg.search(line)
+            if match:
+                res = match.groupdict()
+                if res['direction'] == 'IN':
+                    str(fb.parse_hid_IN(res['data'].decode('hex')))
+                elif res['direction'] == 'OUT':
+                    str(fb.parse_hid_OUT(res['data'].decode('hex')))
+
+def bench_log(lines=2000000, legacy_lines=200000):
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    try:
+        for name, n, func in [
+                ('legacy', legacy_lines, lambda: legacy_parse_log(path)),
+                ('text', lines, lambda: sum(len(c) for c in parse_control_log.decode(
+                    parse_control_log.open_log(path)))),
+                ('jsonl', lines, lambda: sum(len(c) for c in parse_control_log.decode(
+                    parse_control_log.open_log(path), fmt=parse_control_log.format_jsonl))),
+                ('scan only', lines, lambda: sum(1 for _ in parse_control_log.scan(
+                    parse_control_log.open_log(path)))),
+                ]:
+            make_log(path, n)
+            t = best_time(func, 1, repeat=1)
+            record('log', name, t / n)
+            print "%-12s %9d lines  %8.2f s  %10.0f lines/s  %7.2f MB/s" % (
+                name, n, t, n / t, os.path.getsize(path) / t / 1e6)
+    finally:
+        os.unlink(path)
+
+def bench_log_parallel(lines=2000000):
+    # Scaling of parse_control_log -j with the number of processes
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    try:
+        make_log(path, lines)
+        jobs = 1
+        while jobs <= multiprocessing.cpu_count():
+            t = best_time(lambda: sum(len(c) for c in parse_control_log.decode_parallel(
+                path, 'text', jobs, chunk_size=4 << 20)), 1, repeat=1)
+            record('log-parallel', 'jobs=%d' % jobs, t / lines)
+            print "jobs=%-3d %9d lines  %8.2f s  %10.0f lines/s" % (jobs, lines, t, lines / t)
+            jobs *= 2
+    finally:
+        os.unlink(path)
+
+BENCHMARKS = {
+    'crc': bench_crc,
+    'escape': bench_escape,
+    'decode': bench_decode,
+    'decode-out': bench_decode_out,
+    'view': bench_view,
+    'build': bench_build,
+    'commands': bench_commands,
+    'metrics': bench_metrics,
+    'trace': bench_trace,
+    'hid': bench_hid,
+    'pretty': bench_pretty,
+    'log': bench_log,
+    'log-parallel': bench_log_parallel,
+}
+
+def save(path):
+    with open(path, 'w') as f:
+        json.dump({
+            'time': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'node': platform.node(),
+            'results': results,
+        }, f, indent=1, separators=(',', ': '), sort_keys=True)
+
+def compare(path, threshold):
+    """Prints each result against the baseline in path; returns the regressions
+
+    Times are per operation, so a ratio above 1 + threshold is a slowdown.
+    """
+    with open(path) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    print "%-60s %12s %12s %8s" % ('case', 'baseline', 'now', 'change')
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old, new = baseline[key], results[key]
+        change = new / old - 1 if old else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print "%-60s %9.2f us %9.2f us %+7.1f%%%s" % (key, old * 1e6, new * 1e6, change * 100, flag)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the codec and transport hot paths')
+    parser.add_argument('names', nargs='*', metavar='BENCH',
+                        help='any of %s (default: all)' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('-o', '--output', help='save results as JSON')
+    parser.add_argument('-b', '--baseline', help='compare against results saved with -o')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='slowdown that counts as a regression (default 0.1 = 10%%)')
+    args = parser.parse_args(argv)
+
+    for name in args.names or sorted(BENCHMARKS):
+        print "== %s" % name
+        BENCHMARKS[name]()
+    if args.output:
+        save(args.output)
+    if args.baseline:
+        print "== compared to %s" % args.baseline
+        regressions = compare(args.baseline, args.threshold)
+        if regressions:
+            print "%d regressions" % len(regressions)
+            return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
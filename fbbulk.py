@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# Pipelined tracker memory reader
+# ===============================
+#
+# readTrackerMemory asks for one range, and the caller then waits out its
+# XFR2HOST stream, and a timeout, before asking for the next. read_memory
+# splits a range into CHUNK byte reads, and with window > 1 keeps that many
+# in flight, so the radio always has the next stream queued behind the
+# current one.
+#
+# Pipelining assumes the tracker queues reads sent mid-stream and answers
+# them in order, one stream each. That hasn't been confirmed on hardware
+# (fbemu is written to behave that way, and test_fbbulk runs windows > 1
+# against it with lost and reordered reports), so WINDOW is 1 and a window
+# is something to opt into. Either way the oldest read in flight owns the next
+# stream, which an fbstream.Reassembler puts back together and checks.
+# Anything that breaks that pairing (a stream with a bad CRC or length, data
+# outside a stream, a stream that never finishes) makes the reader drain the
+# pipe and ask again for every read that was in flight.
+#
+# A MemoryDump holds the chunks read so far: in a bytearray, or in a
+# memory-mapped file with a <file>.part journal of which chunks are done.
+# After a dropped link, reconnect and call read_memory again with a
+# MemoryDump over the same file; only the missing chunks are read.
+#
+# RF_ReadFirstHostBlockPkt/RF_ReadNextHostBlockPkt have a window and sequence
+# numbers, but name a block type rather than an address, so a transfer made
+# with them can't be picked up part way through. Plain RF_ReadTrackerMemoryPkt
+# reads, each with its own address, can.
+
+import os
+import mmap
+import json
+from binascii import hexlify, unhexlify
+from collections import deque
+from construct import Container
+import fbpacket as fb
+from fbclient import Timeout
+from fbstream import Reassembler, StreamError
+from fbcmd import RF_TEMPLATES
+
+CHUNK = 1024
+# Reads in flight; see above before raising it
+WINDOW = 1
+
+READ_TIMEOUT = 2.0
+RETRIES = 3
+# How long the pipe must stay quiet before a drain is over
+DRAIN_QUIET = 0.25
+# Chunks read between journal updates
+CHECKPOINT = 64
+
+_RF_NAK = fb.RF_PktHdr.build(Container(rsvd=0, group='RF_PKT_GRP_MISC', opcode='RF_PKT_MISC_CMD_NAK'))
+
+class ReadError(Exception):
+    pass
+
+class MemoryDump(object):
+    """start:start+size of tracker memory, as read so far
+
+    With path, the data is memory-mapped from that file. If the file and its
+    journal are left from an earlier dump of the same range, that dump
+    carries on where it stopped.
+    """
+
+    def __init__(self, start, size, path=None, chunk=CHUNK):
+        if size <= 0:
+            raise ValueError("nothing to read")
+        self.start = start
+        self.size = size
+        self.chunk = chunk
+        self.count = (size + chunk - 1) // chunk
+        self.done = bytearray(self.count)
+        self.path = path
+        self._file = None
+        if path is None:
+            self.data = bytearray(size)
+            return
+        self.journal = path + '.part'
+        resume = self._load_journal()
+        self._file = open(path, 'r+b' if resume else 'w+b')
+        if not resume:
+            self._file.truncate(size)
+        self.data = mmap.mmap(self._file.fileno(), size)
+        self.checkpoint()
+
+    def _header(self):
+        return {'start': self.start, 'size': self.size, 'chunk': self.chunk}
+
+    def _load_journal(self):
+        try:
+            with open(self.journal) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if (any(state.get(k) != v for k, v in self._header().items()) or
+                not os.path.exists(self.path) or os.path.getsize(self.path) != self.size):
+            return False
+        self.done[:] = unhexlify(state['done'])
+        return True
+
+    def span(self, index):
+        """(address, length) of a chunk"""
+        offset = index * self.chunk
+        return self.start + offset, min(self.chunk, self.size - offset)
+
+    def missing(self):
+        return [i for i, done in enumerate(self.done) if not done]
+
+    def complete(self):
+        return self.done.count('\0') == 0
+
+    def store(self, index, payload):
+        offset = index * self.chunk
+        if self._file is None:
+            self.data[offset:offset + len(payload)] = payload
+        else:
+            # mmap slice assignment only takes a str
+            self.data.seek(offset)
+            self.data.write(buffer(payload))
+        self.done[index] = 1
+
+    def checkpoint(self):
+        """Makes the journal match what has been stored"""
+        if self._file is None:
+            return
+        self.data.flush()
+        if self.complete():
+            if os.path.exists(self.journal):
+                os.remove(self.journal)
+            return
+        state = self._header()
+        state['done'] = hexlify(self.done)
+        tmp = '%s.%d' % (self.journal, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.journal)
+
+    def close(self):
+        if self._file is not None:
+            self.checkpoint()
+            self.data.close()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def _drain(client):
+    while client.recv_data(DRAIN_QUIET) is not None:
+        pass
+
+def read_memory(client, dump, window=WINDOW, timeout=READ_TIMEOUT, retries=RETRIES):
+    """Reads a MemoryDump's missing chunks over a link with TX enabled
+
+    Raises fbclient.Timeout after retries timeouts in a row, e.g. when the
+    link drops; the chunks read by then are kept in dump. Raises ReadError
+    if the tracker NAKs a read.
+    """
+    template = RF_TEMPLATES['RF_PKT_READ_TRACKER_MEMORY']
+    todo = deque(dump.missing())
+    inflight = deque()
+    reassembler = Reassembler()
+    stalls = 0
+    stored = 0
+    try:
+        while todo or inflight:
+            while todo and len(inflight) < window:
+                i = todo.popleft()
+                addr, n = dump.span(i)
+                client.send_data(template.build(startAddr=addr, numBytesToRead=n))
+                inflight.append(i)
+
+            report = client.recv_data(timeout)
+            if report is None:
+                stalls += 1
+                if stalls > retries:
+                    raise Timeout("memory read stalled with %d chunks to go" %
+                                  (len(todo) + len(inflight)))
+                ok = False
+            else:
+                stalls = 0
+                ok = True
+                if report.startswith(_RF_NAK):
+                    addr, n = dump.span(inflight[0])
+                    raise ReadError("tracker refused %d bytes at 0x%x" % (n, addr))
+                try:
+                    block = reassembler.feed(report)
+                except StreamError:
+                    ok = False
+                else:
+                    if block is not None:
+                        if (block.blockType == 'RF_TRACKERBLOCK_MEMORY' and
+                                len(block) == dump.span(inflight[0])[1]):
+                            dump.store(inflight.popleft(), block.data)
+                            stored += 1
+                            if stored % CHECKPOINT == 0:
+                                dump.checkpoint()
+                        else:
+                            ok = False
+
+            if not ok:
+                # Lost the pairing of streams to reads: start over from the
+                # oldest read in flight once the pipe is quiet
+                _drain(client)
+                todo.extendleft(reversed(inflight))
+                inflight.clear()
+                reassembler.reset()
+    finally:
+        dump.checkpoint()
+    return dump
+
+def dump_memory(client, start, size, path=None, window=WINDOW, chunk=CHUNK, **kwargs):
+    """Reads start:start+size of tracker memory; returns the data
+
+    With path, the data is written to that file, picking up an unfinished
+    dump of the same range, and the path is returned.
+    """
+    dump = MemoryDump(start, size, path, chunk)
+    with dump:
+        read_memory(client, dump, window, **kwargs)
+        if path is None:
+            return bytes(dump.data)
+    return path
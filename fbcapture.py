@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+# Binary HID capture files
+# ========================
+#
+# Layout, all little endian:
+#
+#   header   HEADER: magic, version, record size
+#   records  RECORD each: timestamp (ns), direction, interface, report
+#            length, then the report padded to HID_REPORT_SIZE
+#   index    for each (interface, direction, opcode) slot, the uint32
+#            numbers of the records with that opcode byte, back to back
+#   slots    INDEX_SLOTS x SLOT: (first entry, count) into the index above
+#   times    TIME_ENTRY every TIME_STRIDE records: (timestamp, record number)
+#   trailer  TRAILER: record count, offsets of index/slots/times, magic
+#
+# The opcode is the second byte of the report: the HID opcode on the control
+# interface, the RF header byte on the data interface.
+
+import sys
+import io
+import mmap
+import time
+import struct
+from array import array
+from bisect import bisect_left
+from binascii import hexlify
+import fbpacket as fb
+
+MAGIC = 'FBCAP\0\0\0'
+TRAILER_MAGIC = 'FBCAPEND'
+VERSION = 1
+
+DIR_IN = 0
+DIR_OUT = 1
+DIRECTIONS = {'IN': DIR_IN, 'OUT': DIR_OUT}
+
+IF_CTRL = 0
+IF_DATA = 1
+
+HEADER = struct.Struct('<8sHH')
+RECORD = struct.Struct('<qBBH%ds' % fb.HID_REPORT_SIZE)
+_RECORD_HDR = struct.Struct('<qBBH')
+SLOT = struct.Struct('<II')
+TIME_ENTRY = struct.Struct('<qI')
+TRAILER = struct.Struct('<IQQQ8s')
+
+INDEX_SLOTS = 4 * 256
+TIME_STRIDE = 1024
+
+class CaptureError(Exception):
+    pass
+
+def _slot(interface, direction, opcode):
+    return (((interface << 1) | direction) << 8) | opcode
+
+def now_ns():
+    return int(time.time() * 1e9)
+
+class CaptureWriter(object):
+    def __init__(self, path):
+        self.f = io.open(path, 'wb', buffering=1 << 20)
+        self.f.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.count = 0
+        self.index = [None] * INDEX_SLOTS
+        self.times = []
+        self.record = bytearray(RECORD.size)
+
+    def append(self, direction, interface, report, timestamp=None):
+        """Records one report: a str, bytearray, memoryview or list of ints"""
+        if timestamp is None:
+            timestamp = now_ns()
+        # bytes() of a list of ints would give its repr
+        report = bytes(bytearray(report[:fb.HID_REPORT_SIZE]))
+        RECORD.pack_into(self.record, 0, timestamp, direction, interface, len(report), report)
+        self.f.write(self.record)
+        opcode = ord(report[1]) if len(report) > 1 else 0
+        slot = _slot(interface, direction, opcode)
+        if self.index[slot] is None:
+            self.index[slot] = array('I')
+        self.index[slot].append(self.count)
+        if self.count % TIME_STRIDE == 0:
+            self.times.append((timestamp, self.count))
+        self.count += 1
+
+    def close(self):
+        if self.f is None:
+            return
+        f = self.f
+        index_off = f.tell()
+        slots = []
+        first = 0
+        for entries in self.index:
+            if entries is None:
+                slots.append(SLOT.pack(first, 0))
+                continue
+            f.write(entries.tostring())
+            slots.append(SLOT.pack(first, len(entries)))
+            first += len(entries)
+        slots_off = f.tell()
+        f.write(''.join(slots))
+        times_off = f.tell()
+        f.write(''.join(TIME_ENTRY.pack(ts, n) for ts, n in self.times))
+        f.write(TRAILER.pack(self.count, index_off, slots_off, times_off, TRAILER_MAGIC))
+        f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class CaptureReader(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = HEADER.unpack_from(self.buf)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise CaptureError("%s is not a version %d capture" % (path, VERSION))
+        (self.count, self.index_off, self.slots_off, self.times_off,
+         magic) = TRAILER.unpack_from(self.buf, len(self.buf) - TRAILER.size)
+        if magic != TRAILER_MAGIC:
+            raise CaptureError("%s has no index; was it closed?" % path)
+        ntimes = (len(self.buf) - TRAILER.size - self.times_off) // TIME_ENTRY.size
+        times = [TIME_ENTRY.unpack_from(self.buf, self.times_off + i * TIME_ENTRY.size)
+                 for i in range(ntimes)]
+        self.time_keys = [ts for ts, _ in times]
+        self.time_records = [n for _, n in times]
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.buf.close()
+
+    def record(self, n):
+        """Returns (timestamp, direction, interface, report) for record n
+
+        report is trimmed to the length that was captured.
+        """
+        off = HEADER.size + n * RECORD.size
+        timestamp, direction, interface, length = _RECORD_HDR.unpack_from(self.buf, off)
+        off += _RECORD_HDR.size
+        return timestamp, direction, interface, self.buf[off:off + length]
+
+    def __iter__(self):
+        for n in xrange(self.count):
+            yield self.record(n)
+
+    def indices(self, opcode, direction=None, interface=IF_CTRL):
+        """Record numbers for an opcode, given by number or by its HID name"""
+        if not isinstance(opcode, int):
+            if opcode in fb.HID_CTRL_IN_OPCODE.encoding:
+                opcode, direction = fb.HID_CTRL_IN_OPCODE.encoding[opcode], DIR_IN
+            else:
+                opcode, direction = fb.HID_CTRL_OUT_OPCODE.encoding[opcode], DIR_OUT
+        if direction is None:
+            direction = DIR_IN
+        first, count = SLOT.unpack_from(self.buf,
+            self.slots_off + _slot(interface, direction, opcode) * SLOT.size)
+        entries = array('I')
+        start = self.index_off + first * entries.itemsize
+        entries.fromstring(self.buf[start:start + count * entries.itemsize])
+        return entries
+
+    def by_opcode(self, opcode, direction=None, interface=IF_CTRL):
+        """Yields the records with the given opcode, without scanning the rest"""
+        for n in self.indices(opcode, direction, interface):
+            yield self.record(n)
+
+    def between(self, start, end):
+        """Yields the records with start <= timestamp < end
+
+        Assumes records were appended in time order; the time index narrows
+        the search to one TIME_STRIDE block. Records with the same timestamp
+        can run over several blocks, so the search starts in the block
+        before the first one that starts at or after start.
+        """
+        i = max(0, bisect_left(self.time_keys, start) - 1)
+        n = self.time_records[i] if self.time_records else 0
+        while n < self.count:
+            rec = self.record(n)
+            if rec[0] >= end:
+                break
+            if rec[0] >= start:
+                yield rec
+            n += 1
+
+def format_text(direction, report):
+    """A record as a parse_control_log compatible line"""
+    return 'CONTROL %s bytes: %s' % ('IN' if direction == DIR_IN else 'OUT',
+                                     hexlify(report).upper())
+
+def convert(logpath, cappath):
+    """Converts a CONTROL IN/OUT text log into a capture
+
+    Text logs carry no timestamps, so the records get timestamp 0.
+    """
+    # Here rather than at the top, so fbtrace (and with it fbclient) doesn't
+    # load the log parser and multiprocessing
+    import parse_control_log
+    with CaptureWriter(cappath) as w:
+        for batch in parse_control_log.batches(parse_control_log.scan(
+                parse_control_log.open_log(logpath))):
+            for offset, direction, data, raw in batch:
+                w.append(DIRECTIONS[direction], IF_CTRL, raw, 0)
+        return w.count
+
+def main(argv):
+    if len(argv) == 3 and argv[0] == 'convert':
+        print "%d records" % convert(argv[1], argv[2])
+    elif len(argv) in (2, 3) and argv[0] == 'dump':
+        r = CaptureReader(argv[1])
+        records = r.by_opcode(argv[2]) if len(argv) == 3 else iter(r)
+        for timestamp, direction, interface, report in records:
+            print format_text(direction, report)
+    else:
+        print "usage: %s convert LOG CAPTURE | dump CAPTURE [OPCODE]" % sys.argv[0]
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+
+# Event-driven dongle client
+# ==========================
+#
+# send_and_wait decides a command is done when the dongle has been quiet for
+# a while, so every command costs at least that long. A Client instead keeps
+# a reader thread on each interface. Control reports resolve the futures and
+# feed the queues registered for their opcode, so a command returns as soon
+# as its terminal response (an ACK, NAK, DISCOVERY_COMPLETE, ...) comes in.
+# Data reports go to a single queue.
+#
+# This is Python 2 code, so threads and Queue stand in for asyncio; Future
+# mirrors the small part of the concurrent.futures API that's needed.
+#
+# Timeouts adapt the way TCP's retransmission timeout does (RFC 6298): an
+# RttEstimator keeps a smoothed round trip time and its variance for each
+# HID_CTRL_OUT_OPCODE, and a command waits SRTT + 4 * RTTVAR for its
+# terminal response, doubled after each timeout. Only a terminal response
+# gives a sample; a timeout always backs off, even if something that isn't
+# terminal (an ACK ahead of LINK_ESTABLISHED, say) came in first, so a slow
+# terminal response never drags the timeout down. Commands that take as
+# long as they're told to, like discovery's scanDuration, wait that long on
+# top.
+#
+# command() has one command in flight at a time. A Pipeline sends commands
+# back to back instead. Every response belongs to the oldest command in
+# flight: it finishes that command if it's terminal for it, and is never
+# handed on to a later one. Commands that depend on an earlier answer are
+# held back (see REQUIRES).
+#
+# Every Client keeps an fbtrace.Tracer of the last TRACE_FRAMES reports on
+# both interfaces, so a stall or failure can be looked at after the fact
+# with client.tracer.dump(), and an fbmetrics.Metrics of command latencies
+# and report counts, read with client.metrics.snapshot() or prometheus().
+
+import time
+import struct
+import threading
+import Queue
+import fbpacket as fb
+import fbdecode
+from fbhid import Transport
+from fbtrace import Tracer
+import fbmetrics
+
+POLL_MS = 100
+# Reports each Client's tracer keeps, about 180 KB of buffer
+TRACE_FRAMES = 4096
+# Until an opcode has a round trip time measured
+COMMAND_TIMEOUT = 5.0
+
+RTT_ALPHA = 1 / 8.0
+RTT_BETA = 1 / 4.0
+RTT_K = 4
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+
+# OUT commands that run for as long as one of their fields says: the field
+# and its unit in seconds
+DURATION_FIELDS = {
+    'HID_CTRL_OUT_START_DISCOVERY': ('scanDuration', 1e-3),
+}
+
+NAK = fb.HID_CTRL_IN_OPCODE.encoding['HID_CTRL_IN_NAK_RESPONSE']
+
+# length, opcode
+_OUT_HDR = struct.Struct('<BB')
+
+# The IN opcodes that finish each command; anything else is done at its ACK.
+# A NAK finishes every command.
+TERMINAL = {
+    'HID_CTRL_OUT_ECHO_REQUEST': ('HID_CTRL_IN_ECHO_RESPONSE',),
+    'HID_CTRL_OUT_QUERY_VERSION': ('HID_CTRL_IN_VERSION_RESPONSE',),
+    'HID_CTRL_OUT_START_DISCOVERY': ('HID_CTRL_IN_DISCOVERY_COMPLETE',),
+    'HID_CTRL_OUT_ESTABLISH_LINK': ('HID_CTRL_IN_LINK_ESTABLISHED', 'HID_CTRL_IN_LINK_TERMINATED',
+                                    'HID_CTRL_IN_ALREADY_CONNECTED'),
+    'HID_CTRL_OUT_ESTABLISH_LINK_EX': ('HID_CTRL_IN_LINK_ESTABLISHED', 'HID_CTRL_IN_LINK_TERMINATED',
+                                       'HID_CTRL_IN_ALREADY_CONNECTED'),
+    'HID_CTRL_OUT_ESTABLISH_LINK_EX2': ('HID_CTRL_IN_LINK_ESTABLISHED', 'HID_CTRL_IN_LINK_TERMINATED',
+                                        'HID_CTRL_IN_ALREADY_CONNECTED'),
+    'HID_CTRL_OUT_READ_RSSI': ('HID_CTRL_IN_RSSI_DATA',),
+    'HID_CTRL_OUT_DISCOVER_CHARS': ('HID_CTRL_IN_CHR_DISCOVERY_COMPLETE',),
+    'HID_CTRL_OUT_QUERY_FEATURE_BITS': ('HID_CTRL_IN_FEATURE_BITS',),
+    'HID_CTRL_OUT_READ_FLASH_DATA': ('HID_CTRL_IN_READ_FLASH_DATA',),
+    'HID_CTRL_OUT_QUERY_BOOTLOADER_VERSION': ('HID_CTRL_IN_BOOTLOADER_VERSION_RESPONSE',),
+}
+DEFAULT_TERMINAL = ('HID_CTRL_IN_ACK_RESPONSE',)
+
+# Reports a command can cause on the way to its terminal response. A
+# pipelined command collects its own, so they're never taken for the
+# answer to the next one.
+SIDE_EFFECTS = {
+    'HID_CTRL_OUT_TERMINATE_LINK': ('HID_CTRL_IN_LINK_TERMINATED',),
+    'HID_CTRL_OUT_FORCE_DISCONNECT': ('HID_CTRL_IN_LINK_TERMINATED',),
+}
+
+class Timeout(Exception):
+    pass
+
+class CommandError(Exception):
+    """The dongle NAKed a command"""
+    def __init__(self, command, response):
+        self.command = command
+        self.response = response
+        self.errorCode = response.errorCode
+        Exception.__init__(self, "%s failed: %s (%s)" % (command, response.errorCode,
+            fb.ERROR_CODES.get(response.errorCode, "unknown error")))
+
+class Future(object):
+    """A result that a reader thread fills in later; only the first one sticks"""
+    __slots__ = ('_event', '_result', '_exc')
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        if not self._event.is_set():
+            self._result = result
+            self._event.set()
+
+    def set_exception(self, exc):
+        if not self._event.is_set():
+            self._exc = exc
+            self._event.set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise Timeout("no response after %s s" % timeout)
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+def command_name(msg):
+    """The HID_CTRL_OUT_OPCODE of a command given as str, bytearray or memoryview"""
+    return fb.HID_CTRL_OUT_OPCODE.decoding[_OUT_HDR.unpack_from(msg)[1]]
+
+def command_duration(name, msg):
+    """How long the command in msg takes by design, in seconds"""
+    field = DURATION_FIELDS.get(name)
+    if field is None:
+        return 0.0
+    field, unit = field
+    return getattr(fbdecode.parse_hid_OUT(msg), field) * unit
+
+class RttEstimator(object):
+    """Smoothed round trip time and variance per key, and the timeout they give"""
+
+    def __init__(self, initial=COMMAND_TIMEOUT, min_rto=MIN_RTO, max_rto=MAX_RTO):
+        self.initial = initial
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = {}
+        self.rttvar = {}
+        self.rto = {}
+        self._lock = threading.Lock()
+
+    def timeout(self, key):
+        return self.rto.get(key, self.initial)
+
+    def sample(self, key, rtt):
+        with self._lock:
+            srtt = self.srtt.get(key)
+            if srtt is None:
+                srtt, rttvar = rtt, rtt / 2.0
+            else:
+                rttvar = (1 - RTT_BETA) * self.rttvar[key] + RTT_BETA * abs(srtt - rtt)
+                srtt = (1 - RTT_ALPHA) * srtt + RTT_ALPHA * rtt
+            self.srtt[key] = srtt
+            self.rttvar[key] = rttvar
+            self.rto[key] = min(self.max_rto, max(self.min_rto, srtt + RTT_K * rttvar))
+
+    def backoff(self, key):
+        """Doubles key's timeout after it ran out, until the next sample"""
+        with self._lock:
+            self.rto[key] = min(self.max_rto, self.timeout(key) * 2)
+
+    def snapshot(self):
+        return dict((key, {'srtt': self.srtt.get(key), 'rttvar': self.rttvar.get(key),
+                           'rto': self.rto[key]}) for key in self.rto)
+
+class Client(object):
+    def __init__(self, ctrl, data, handler=None, poll_ms=POLL_MS, rtt=None, max_data=0,
+                 trace_frames=TRACE_FRAMES, metrics=True):
+        """Starts reading from both interfaces
+
+        handler, e.g. a Router, also sees every control report, on the
+        reader thread. rtt is the RttEstimator for command timeouts. With
+        max_data, at most that many data reports are queued; past that the
+        data reader stops reading, which pushes back on the dongle.
+        trace_frames sizes tracer, the Tracer over both interfaces; with 0
+        there's no tracer. Likewise metrics, the Metrics over them, is None
+        without metrics.
+        """
+        self.ctrl = ctrl
+        self.data = data
+        self.tracer = Tracer(trace_frames) if trace_frames else None
+        if self.tracer is not None:
+            ctrl, data = self.tracer.wrap(ctrl, data)
+        self.metrics = fbmetrics.Metrics() if metrics else None
+        if self.metrics is not None:
+            ctrl, data = self.metrics.wrap(ctrl, data)
+        self._ctrl = Transport(ctrl)
+        self._data = Transport(data)
+        self.handler = handler
+        self.poll_ms = poll_ms
+        self.rtt = RttEstimator() if rtt is None else rtt
+        self.data_reports = Queue.Queue(max_data)
+        self._lock = threading.Lock()
+        self._command_lock = threading.Lock()
+        self._waiters = [[] for _ in range(256)]
+        self._queues = [() for _ in range(256)]
+        self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._reader, args=(self._ctrl, self._on_ctrl), name='fbclient-ctrl'),
+            threading.Thread(target=self._reader, args=(self._data, self._on_data), name='fbclient-data'),
+        ]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def close(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _reader(self, transport, deliver):
+        # deliver gets a memoryview of the transport's buffer, which the
+        # next read overwrites
+        recv = transport.recv
+        poll_ms = self.poll_ms
+        stop = self._stop
+        while not stop.is_set():
+            view = recv(poll_ms)
+            if view is not None:
+                deliver(view)
+
+    def _on_data(self, view):
+        report = view.tobytes()
+        # Only blocks when max_data is set and the queue is full
+        put = self.data_reports.put
+        while not self._stop.is_set():
+            try:
+                put(report, timeout=self.poll_ms / 1000.0)
+                return
+            except Queue.Full:
+                pass
+
+    def _on_ctrl(self, view):
+        op = ord(view[1])
+        with self._lock:
+            waiters = self._waiters[op]
+            if waiters:
+                self._waiters[op] = []
+            queues = self._queues[op]
+        if self.handler is not None:
+            self.handler(view.tobytes())
+        if not (waiters or queues):
+            return
+        try:
+            # Parsed in place; the response doesn't refer back to the view
+            response = fbdecode.parse_hid_IN(view)
+        except Exception as e:
+            for f in waiters:
+                f.set_exception(e)
+            return
+        for f in waiters:
+            f.set_result(response)
+        for q in queues:
+            q.put(response)
+
+    @staticmethod
+    def _opcodes(opcodes):
+        return [op if isinstance(op, int) else fb.HID_CTRL_IN_OPCODE.encoding[op]
+                for op in opcodes]
+
+    def expect(self, *opcodes):
+        """A Future for the next control report with any of the given opcodes
+
+        Register it before sending whatever triggers the report.
+        """
+        f = Future()
+        with self._lock:
+            for op in self._opcodes(opcodes):
+                self._waiters[op].append(f)
+        return f
+
+    def _forget(self, f, opcodes):
+        with self._lock:
+            for op in self._opcodes(opcodes):
+                self._waiters[op] = [w for w in self._waiters[op] if w is not f]
+
+    def subscribe(self, *opcodes):
+        """A Queue that receives every parsed report with the given opcodes"""
+        q = Queue.Queue()
+        self.listen(q, *opcodes)
+        return q
+
+    def listen(self, sink, *opcodes):
+        """Like subscribe, but reports go to sink.put(), on the reader thread
+
+        unsubscribe(sink) undoes it.
+        """
+        with self._lock:
+            for op in self._opcodes(opcodes):
+                self._queues[op] = self._queues[op] + (sink,)
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._queues = [tuple(s for s in qs if s is not q) for qs in self._queues]
+
+    def command(self, msg, terminal=None, timeout=None, collect=()):
+        """Sends a control command and waits for its terminal response
+
+        Returns (response, collected), where collected holds the reports
+        with the collect opcodes that arrived in the meantime. Raises
+        CommandError on a NAK and Timeout if nothing terminal arrives
+        within timeout, by default the command's duration plus its RTO.
+        One command is in flight at a time, so ACKs can't be mixed up.
+        """
+        name = command_name(msg)
+        if terminal is None:
+            terminal = TERMINAL.get(name, DEFAULT_TERMINAL)
+        terminal = tuple(terminal) + (NAK,)
+        duration = command_duration(name, msg)
+        if timeout is None:
+            timeout = duration + self.rtt.timeout(name)
+        with self._command_lock:
+            q = self.subscribe(*collect) if collect else None
+            f = self.expect(*terminal)
+            try:
+                self._ctrl.write(msg)
+                sent = time.time()
+                try:
+                    response = f.result(timeout)
+                except Timeout:
+                    self.rtt.backoff(name)
+                    raise
+                self.rtt.sample(name, max(0.0, time.time() - sent - duration))
+            finally:
+                self._forget(f, terminal)
+                if q is not None:
+                    self.unsubscribe(q)
+        if response.hdr.opcode == 'HID_CTRL_IN_NAK_RESPONSE':
+            raise CommandError(name, response)
+        collected = []
+        while q is not None and not q.empty():
+            collected.append(q.get_nowait())
+        return response, collected
+
+    def discover(self, msg, timeout=None):
+        """Runs a discovery and returns the TRACKER_DEVICE_INFO responses
+
+        Returns as soon as DISCOVERY_COMPLETE arrives, and by default waits
+        for it for the scanDuration in msg plus the usual RTO.
+        """
+        _, trackers = self.command(msg, timeout=timeout,
+                                   collect=('HID_CTRL_IN_TRACKER_DEVICE_INFO',))
+        return trackers
+
+    def pipeline(self, timeout=None):
+        """A Pipeline for sending commands back to back; use it in a with block"""
+        return Pipeline(self, timeout)
+
+    def send_data(self, msg):
+        self._data.write(msg)
+
+    def recv_data(self, timeout=None):
+        """The next report from the data interface, or None after timeout"""
+        try:
+            return self.data_reports.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def iter_data(self, msg=None, stop=None, timeout=None, cancel=None):
+        """Sends msg, if given, on the data interface and yields reports as they arrive
+
+        Ends after yielding a report that stop(report) is true for, after
+        timeout seconds without a report, or once the cancel Event is set.
+        Nothing is kept once yielded, so memory stays flat however long the
+        transfer; with max_data, a slow consumer slows the dongle down.
+        """
+        if msg is not None:
+            self.send_data(msg)
+        poll = self.poll_ms / 1000.0
+        while True:
+            end = None if timeout is None else time.time() + timeout
+            report = None
+            while report is None:
+                if cancel is not None and cancel.is_set():
+                    return
+                wait = None if end is None else end - time.time()
+                if wait is not None and wait <= 0:
+                    return
+                if cancel is not None:
+                    wait = poll if wait is None else min(wait, poll)
+                report = self.recv_data(wait)
+            yield report
+            if stop is not None and stop(report):
+                return
+
+class DependencyError(Exception):
+    """A pipelined command wasn't sent because one it depends on failed"""
+
+# Commands that only make sense once an earlier one got a given response.
+# Pipelined after any of the listed commands, they're held back until it's
+# answered and fail with DependencyError unless the answer was that one.
+REQUIRES = {
+    'HID_CTRL_OUT_ENABLE_TX_PIPE': (('HID_CTRL_OUT_ESTABLISH_LINK', 'HID_CTRL_OUT_ESTABLISH_LINK_EX',
+                                     'HID_CTRL_OUT_ESTABLISH_LINK_EX2'), 'HID_CTRL_IN_LINK_ESTABLISHED'),
+}
+
+class _Command(Future):
+    __slots__ = ('pipeline', 'msg', 'name', 'terminal', 'collect', 'collected', 'after',
+                 'required', 'duration', 'timeout', 'sent', 'deadline', 'response')
+
+    def result(self, timeout=None):
+        """(response, collected), as Client.command returns"""
+        self.pipeline._wait(self, timeout)
+        if not self.done():
+            raise Timeout("%s: no response after %s s" % (self.name, timeout))
+        return Future.result(self)
+
+class Pipeline(object):
+    """Sends control commands back to back and matches up their responses
+
+    The dongle answers commands in the order it gets them, so every
+    response goes to the oldest command in flight. A NAK or one of its
+    terminal opcodes finishes it; one of its collect opcodes or
+    SIDE_EFFECTS is collected; anything else is dropped rather than
+    handed to a later command. Commands can wait on others with after=,
+    and REQUIRES adds the dependencies that are always needed.
+
+    The pipeline has the Client's command lock while it's open, so don't
+    call Client.command from the same thread until it's closed.
+    """
+
+    def __init__(self, client, timeout=None):
+        self.client = client
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._held = []
+        self._inflight = []
+        self._all = []
+        self._last = {}
+        self._opcodes = set()
+        client._command_lock.acquire()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, msg, after=(), terminal=None, timeout=None, collect=()):
+        """Queues a command; returns a Future for (response, collected)
+
+        It's sent at once unless a command in after, or one REQUIRES names,
+        is still unanswered. The result raises CommandError on a NAK,
+        DependencyError if a dependency failed and Timeout as
+        Client.command does.
+        """
+        c = _Command()
+        c.pipeline = self
+        # A copy, as msg may be a template buffer that's reused before a
+        # held command goes out
+        c.msg = msg = bytearray(msg)
+        c.name = name = command_name(msg)
+        if terminal is None:
+            terminal = TERMINAL.get(name, DEFAULT_TERMINAL)
+        c.terminal = frozenset(self.client._opcodes(terminal))
+        c.collect = frozenset(self.client._opcodes(tuple(collect) + SIDE_EFFECTS.get(name, ())))
+        c.collected = []
+        c.after = list(after)
+        c.required = None
+        c.duration = command_duration(name, msg)
+        c.timeout = timeout if timeout is not None else self.timeout
+        c.sent = c.deadline = c.response = None
+        requires = REQUIRES.get(name)
+        if requires is not None:
+            prereqs, c.required = requires
+            prior = [self._last[p] for p in prereqs if p in self._last]
+            if prior:
+                c.after.append(max(prior, key=self._all.index))
+        new = (c.terminal | c.collect | set([NAK])) - self._opcodes
+        if new:
+            self._opcodes |= new
+            self.client.listen(self, *new)
+        with self._cond:
+            self._all.append(c)
+            self._last[name] = c
+            self._held.append(c)
+            self._release()
+        return c
+
+    def _release(self):
+        # Sends or fails every held command whose dependencies are settled,
+        # in the order they were submitted. Called with _cond held.
+        for c in list(self._held):
+            if not all(d.done() for d in c.after):
+                continue
+            self._held.remove(c)
+            failed = [d for d in c.after if d._exc is not None]
+            if failed:
+                c.set_exception(DependencyError("%s: %s" % (c.name, failed[0]._exc)))
+            elif c.required is not None and any(
+                    d.name in REQUIRES[c.name][0] and d.response.hdr.opcode != c.required for d in c.after):
+                c.set_exception(DependencyError("%s needs %s" % (c.name, c.required)))
+            else:
+                self._send(c)
+        self._cond.notify_all()
+
+    def _send(self, c):
+        # In flight before it's written, so a quick response finds it
+        self._inflight.append(c)
+        c.sent = time.time()
+        timeout = c.timeout if c.timeout is not None else self.client.rtt.timeout(c.name)
+        c.deadline = c.sent + c.duration + timeout
+        self.client._ctrl.write(c.msg)
+
+    def put(self, response):
+        """Takes a parsed control report from the Client's reader"""
+        op = fb.HID_CTRL_IN_OPCODE.encoding[response.hdr.opcode]
+        with self._cond:
+            if not self._inflight:
+                return
+            owner = self._inflight[0]
+            if op != NAK and op not in owner.terminal:
+                if op in owner.collect:
+                    owner.collected.append(response)
+                return
+            del self._inflight[0]
+            owner.response = response
+            if op == NAK:
+                owner.set_exception(CommandError(owner.name, response))
+            else:
+                owner.set_result((response, owner.collected))
+            self.client.rtt.sample(owner.name, max(0.0, time.time() - owner.sent - owner.duration))
+            self._release()
+
+    def _expire(self, now):
+        # Called with _cond held
+        for c in [c for c in self._inflight if c.deadline <= now]:
+            self._inflight.remove(c)
+            self.client.rtt.backoff(c.name)
+            c.set_exception(Timeout("%s: no response after %.2f s" % (c.name, now - c.sent)))
+        self._release()
+
+    def _wait(self, c, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not c.done():
+                now = time.time()
+                self._expire(now)
+                if c.done():
+                    break
+                limits = [x.deadline for x in self._inflight]
+                if end is not None:
+                    if now >= end:
+                        break
+                    limits.append(end)
+                self._cond.wait(min(limits) - now if limits else None)
+
+    def wait(self):
+        """Waits for every command submitted so far to be answered or fail"""
+        for c in list(self._all):
+            self._wait(c)
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.client.unsubscribe(self)
+            self.client._command_lock.release()
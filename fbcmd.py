@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+# Prebuilt command templates
+# ==========================
+#
+# Each Template runs construct once, when it's created, to build the complete
+# packet with its fixed fields (header, opcode, constants) filled in. At call
+# time the per-call fields are written over a copy of it with
+# struct.pack_into, into a bytearray that the template reuses. RF packets
+# also get the make_data_packet padding and length trailer up front.
+#
+# Building one costs a few hundredths of a millisecond. The zero-filled
+# templates for every command type are only built when first looked up;
+# the session commands at the bottom, which fbtalk and fbsched share, are
+# built here once.
+
+import struct
+from collections import Mapping
+from binascii import unhexlify
+from construct import Container, Struct, FormatField, StaticField, \
+    MetaArray, MappingAdapter, BitIntegerAdapter, Buffered
+from construct.core import Reconfig
+from construct.protocols.layer2.ethernet import MacAddressAdapter
+import fbpacket as fb
+from cStringIO import StringIO
+
+class _Field(object):
+    __slots__ = ('offset', 'pack_into')
+
+    def __init__(self, offset, pack_into):
+        self.offset = offset
+        self.pack_into = pack_into
+
+def _format_field(off, packer, encoding=None):
+    pack = packer.pack_into
+    if encoding is None:
+        def pack_into(buf, base, value):
+            pack(buf, base + off, value)
+    else:
+        def pack_into(buf, base, value):
+            pack(buf, base + off, encoding.get(value, value))
+    return _Field(off, pack_into)
+
+def _flag_field(off, encoding):
+    truth, falsehood = ord(encoding[True]), ord(encoding[False])
+    def pack_into(buf, base, value):
+        buf[base + off] = truth if value else falsehood
+    return _Field(off, pack_into)
+
+def _mac_field(off, length):
+    pack = struct.Struct('%ds' % length).pack_into
+    def pack_into(buf, base, value):
+        if len(value) != length:
+            value = unhexlify(value.replace('-', ''))
+        pack(buf, base + off, value)
+    return _Field(off, pack_into)
+
+def _bytes_field(off, length):
+    # 's' pads short values with NULs, as trackerEcho used to by hand, but
+    # would silently truncate long ones
+    pack = struct.Struct('%ds' % length).pack_into
+    def pack_into(buf, base, value):
+        if len(value) > length:
+            raise ValueError("%d bytes don't fit a %d byte field" % (len(value), length))
+        pack(buf, base + off, value)
+    return _Field(off, pack_into)
+
+def _array_field(off, count, packer):
+    pack = struct.Struct('<%d%s' % (count, packer.format[1:])).pack_into
+    def pack_into(buf, base, value):
+        pack(buf, base + off, *value)
+    return _Field(off, pack_into)
+
+def _bit_field(off, shift, width, encoding=None):
+    mask = ((1 << width) - 1) << shift
+    def pack_into(buf, base, value):
+        if encoding is not None:
+            value = encoding.get(value, value)
+        i = base + off
+        buf[i] = (buf[i] & ~mask & 0xFF) | ((value << shift) & mask)
+    return _Field(off, pack_into)
+
+def _bit_fields(cons, off, fields):
+    # An EmbeddedBitStruct that fills exactly one byte; bits are MSB first
+    inner = cons.subcon
+    while isinstance(inner, Reconfig):
+        inner = inner.subcon
+    if not isinstance(inner, Struct) or inner.sizeof() != 8:
+        return
+    shift = 8
+    for sc in inner.subcons:
+        bits = sc
+        encoding = None
+        while isinstance(bits, Reconfig):
+            bits = bits.subcon
+        if isinstance(bits, MappingAdapter):
+            encoding = bits.encoding
+            bits = bits.subcon
+        if not isinstance(bits, BitIntegerAdapter):
+            return
+        shift -= bits.width
+        if sc.name is not None and sc.name != 'rsvd':
+            fields[sc.name] = _bit_field(off, shift, bits.width, encoding)
+
+def _measure(cons, blank):
+    """Parses blank with cons, returning the defaults and each field's offset
+
+    Offsets are taken from the stream position rather than sizeof(), which
+    can't size the Switch inside RF_PktHdr.
+    """
+    stream = StringIO(blank)
+    context = Container()
+    obj = Container()
+    offsets = []
+    for sc in cons.subcons:
+        offsets.append((sc, stream.tell()))
+        if sc.conflags & cons.FLAG_EMBED:
+            context["<obj>"] = obj
+            sc._parse(stream, context)
+        else:
+            value = sc._parse(stream, context)
+            if sc.name is not None:
+                obj[sc.name] = value
+                context[sc.name] = value
+    return obj, offsets, stream.tell()
+
+def _layout(offsets):
+    """Maps each patchable top-level field to its offset and packer"""
+    fields = {}
+    for sc, off in offsets:
+        inner = sc
+        while isinstance(inner, Reconfig):
+            inner = inner.subcon
+        if isinstance(inner, FormatField):
+            fields[sc.name] = _format_field(off, inner.packer)
+        elif isinstance(inner, MappingAdapter) and isinstance(inner.subcon, FormatField):
+            fields[sc.name] = _format_field(off, inner.subcon.packer, inner.encoding)
+        elif isinstance(inner, MappingAdapter) and isinstance(inner.subcon, StaticField) \
+                and inner.subcon.length == 1 and True in inner.encoding:
+            fields[sc.name] = _flag_field(off, inner.encoding)
+        elif isinstance(inner, MacAddressAdapter):
+            fields[sc.name] = _mac_field(off, inner.subcon.length)
+        elif type(inner) is StaticField:
+            fields[sc.name] = _bytes_field(off, inner.length)
+        elif isinstance(inner, MetaArray) and isinstance(inner.subcon, FormatField):
+            count = inner.countfunc(Container())
+            fields[sc.name] = _array_field(off, count, inner.subcon.packer)
+        elif isinstance(inner, Buffered):
+            _bit_fields(inner, off, fields)
+    return fields
+
+class Template(object):
+    """A prebuilt packet whose per-call fields are patched in place"""
+
+    def __init__(self, cons, values, data_packet=False):
+        self.name = cons.name
+        # Parse an all-zero packet to get a default for every field, then
+        # override with the fixed values
+        blank = '\0' * fb.HID_REPORT_SIZE
+        if data_packet:
+            blank = fb.RF_PKT_MAGIC_BYTE + blank[1:]
+        packet, offsets, _ = _measure(cons, blank)
+        packet.update(values)
+        packet = cons.build(packet)
+        if data_packet:
+            packet = fb.make_data_packet(packet)
+        self.packet = packet
+        self.size = len(packet)
+        self.buf = bytearray(packet)
+        self.fields = _layout(offsets)
+
+    def patch(self, **values):
+        """Fills the template's own buffer and returns it
+
+        The buffer is reused by the next call, so send it before then.
+        """
+        buf = self.buf
+        buf[:] = self.packet
+        fields = self.fields
+        for name, value in values.iteritems():
+            fields[name].pack_into(buf, 0, value)
+        return buf
+
+    def build(self, **values):
+        return bytes(self.patch(**values))
+
+    __call__ = build
+
+    def build_into(self, buf, offset=0, **values):
+        """Writes the packet into buf at offset, e.g. a slot in a batch"""
+        size = self.size
+        buf[offset:offset + size] = self.packet
+        fields = self.fields
+        for name, value in values.iteritems():
+            fields[name].pack_into(buf, offset, value)
+
+    def build_many(self, names, rows, buf=None):
+        """Builds one packet per row into a single buffer
+
+        Each row holds the values for names, in order. Packet i is at
+        buf[i * size:(i + 1) * size].
+        """
+        rows = list(rows)
+        size = self.size
+        if buf is None:
+            buf = bytearray(size * len(rows))
+        buf[:size * len(rows)] = self.packet * len(rows)
+        packers = [self.fields[name].pack_into for name in names]
+        offset = 0
+        for row in rows:
+            for pack_into, value in zip(packers, row):
+                pack_into(buf, offset, value)
+            offset += size
+        return buf
+
+def hid_out_template(opStr, PktType=None, **values):
+    """Template for a control command sent TO the dongle"""
+    if PktType is None:
+        PktType = HID_OUT_TYPES[opStr]
+    values['hdr'] = Container(length=PktType.sizeof(), opcode=opStr)
+    return Template(PktType, values)
+
+def rf_template(group, opcode, PktType=None, **values):
+    """Template for an RF packet sent to the tracker over the data pipe"""
+    if PktType is None:
+        PktType = RF_TYPES[opcode]
+    values['hdr'] = Container(rsvd=0, group=group, opcode=opcode)
+    return Template(PktType, values, data_packet=True)
+
+HID_CtrlOutHdrOnly = Struct("HID_CtrlOutHdrOnly",
+    fb.Rename("hdr", fb.HID_CtrlRptHdrOut)
+)
+
+HID_OUT_TYPES = dict(fb.HID_OUT_MAP)
+# Commands with no payload of their own that aren't in HID_OUT_MAP
+for opStr in ['HID_CTRL_OUT_STOP_SAMPLING_RSSI', 'HID_CTRL_OUT_READ_RSSI',
+              'HID_CTRL_OUT_QUERY_STATE', 'HID_CTRL_OUT_QUERY_FEATURE_BITS',
+              'HID_CTRL_OUT_REBOOT', 'HID_CTRL_OUT_QUERY_BOOTLOADER_VERSION']:
+    HID_OUT_TYPES[opStr] = HID_CtrlOutHdrOnly
+
+RF_TYPES = {
+    'RF_PKT_MISC_CMD_ACK': fb.RF_CmdAckPkt,
+    'RF_PKT_MISC_CMD_NAK': fb.RF_CmdNakPkt,
+    'RF_PKT_MISC_SET_DEVICE_CLOCK': fb.RF_SetDeviceClockPkt,
+    'RF_PKT_MISC_ALERT_USER': fb.RF_AlertUserPkt,
+    'RF_PKT_MISC_ECHO_PACKET': fb.RF_EchoPkt,
+    'RF_PKT_MISC_INIT_AIRLINK': fb.RF_InitAirlink,
+    'RF_PKT_READ_TRACKER_BLOCK': fb.RF_ReadTrackerBlockPkt,
+    'RF_PKT_READ_TRACKER_MEMORY': fb.RF_ReadTrackerMemoryPkt,
+    'RF_PKT_READ_FIRST_HOST_BLOCK': fb.RF_ReadFirstHostBlockPkt,
+    'RF_PKT_READ_NEXT_HOST_BLOCK': fb.RF_ReadNextHostBlockPkt,
+    'RF_PKT_READ_AIRLINK_BLOCK': fb.RF_ReadAirlinkBlockPkt,
+    'RF_PKT_UPDATE_BEACON_PARAMS': fb.RF_UpdateBeaconParamsPkt,
+    'RF_PKT_UPDATE_SECRET': fb.RF_UpdateSecretPkt,
+    'RF_PKT_UPDATE_TRACKER_BLOCK': fb.RF_UpdateTrackerBlockPkt,
+    'RF_PKT_XFR2TRACKER_SINGLE_BLOCK': fb.RF_Xfr2TrackerSingleBlockPkt,
+    'RF_PKT_XFR2TRACKER_STREAM_STARTING': fb.RF_Xfr2TrackerStreamStartingPkt,
+    'RF_PKT_XFR2TRACKER_STREAM_FINISHED': fb.RF_Xfr2TrackerStreamFinishedPkt,
+}
+
+RF_GROUPS = {
+    'RF_PKT_MISC': 'RF_PKT_GRP_MISC',
+    'RF_PKT_READ': 'RF_PKT_GRP_READ',
+    'RF_PKT_UPDATE': 'RF_PKT_GRP_UPDATE',
+    'RF_PKT_XFR2HOST': 'RF_PKT_GRP_XFR2HOST',
+    'RF_PKT_XFR2TRACKER': 'RF_PKT_GRP_XFR2TRACKER',
+}
+
+def rf_group(opcode):
+    for prefix, group in RF_GROUPS.items():
+        if opcode.startswith(prefix + '_'):
+            return group
+    raise KeyError(opcode)
+
+class _LazyTemplates(Mapping):
+    """Builds each template the first time it's looked up"""
+
+    def __init__(self, types, make):
+        self.types = types
+        self.make = make
+        self.built = {}
+
+    def __getitem__(self, name):
+        t = self.built.get(name)
+        if t is None:
+            if name not in self.types:
+                raise KeyError(name)
+            t = self.built[name] = self.make(name)
+        return t
+
+    def __iter__(self):
+        return iter(self.types)
+
+    def __len__(self):
+        return len(self.types)
+
+# Zero-filled templates for every known command type, built on first use
+# so importing this module doesn't pay for all of them
+HID_OUT_TEMPLATES = _LazyTemplates(HID_OUT_TYPES, hid_out_template)
+RF_TEMPLATES = _LazyTemplates(RF_TYPES, lambda opcode: rf_template(rf_group(opcode), opcode))
+
+# Session commands
+# ----------------
+
+establishLinkExTemplate = hid_out_template('HID_CTRL_OUT_ESTABLISH_LINK_EX',
+    addrType = 1,
+    minConnInterval = 6,
+    maxConnInterval = 6,
+    slaveLatency = 0,
+    connTimeout = 200,
+)
+
+def establishLinkEx(addr):
+    return establishLinkExTemplate.build(addr=addr)
+
+enableTX = HID_OUT_TEMPLATES['HID_CTRL_OUT_ENABLE_TX_PIPE'].build(enable=True)
+
+terminateLink = HID_OUT_TEMPLATES['HID_CTRL_OUT_TERMINATE_LINK'].build()
+
+initAirlink = rf_template('RF_PKT_GRP_MISC', 'RF_PKT_MISC_INIT_AIRLINK',
+    majorHostVersion = 10,
+    minorHostVersion = 4,
+    minConnInterval = 6,
+    maxConnInterval = 6,
+    slaveLatency = 0,
+    connTimeout = 200
+).build()
+
+readTrackerBlock = RF_TEMPLATES['RF_PKT_READ_TRACKER_BLOCK'].build(blockType='RF_TRACKERBLOCK_MEGA_DUMP')
@@ -1,3 +1,5 @@
+import binascii
+
 _crcTable = [0, 4129, 8258, 12387, 16516, 20645, 24774, 28903, 33032, 37161,
         41290, 45419, 49548, 53677, 57806, 61935, 4657, 528, 12915, 8786,
         21173, 17044, 29431, 25302, 37689, 33560, 45947, 41818, 54205, 50076,
@@ -25,11 +27,73 @@ _crcTable = [0, 4129, 8258, 12387, 16516, 20645, 24774, 28903, 33032, 37161,
         61215, 65342, 53085, 57212, 44955, 49082, 36825, 40952, 28183, 32310,
         20053, 24180, 11923, 16050, 3793, 7920]
 
-def crc16(data):
-    crc = 0
+def _make_slice_tables(n):
+    # _crcTables[k][x] is the CRC contribution of byte x followed by k zero
+    # bytes, so n input bytes can be folded in with n independent lookups.
+    tables = [_crcTable]
+    for k in range(1, n):
+        prev = tables[-1]
+        tables.append([((v << 8) & 0xFFFF) ^ _crcTable[v >> 8] for v in prev])
+    return tables
+
+_crcTables = _make_slice_tables(8)
+
+def _crc16_bytewise(data, crc=0):
+    for b in bytearray(data):
+        crc = _crcTable[b ^ (crc >> 8)] ^ ((crc << 8) & 0xFFFF)
+    return crc
+
+def _crc16_sliced(data, crc=0):
+    """Pure Python slicing-by-8 CRC, used where binascii.crc_hqx is missing"""
+    buf = data if isinstance(data, bytearray) else bytearray(data)
+    t0, t1, t2, t3, t4, t5, t6, t7 = _crcTables
+    n = len(buf)
+    end = n - (n % 8)
     i = 0
-    while i < len(data):
-        j = 255 & (ord(data[i]) ^ crc >> 8)
-        crc = _crcTable[j] ^ crc << 8;
-        i += 1
-    return 65535 & (0 ^ crc)
+    while i < end:
+        b0, b1, b2, b3, b4, b5, b6, b7 = buf[i:i+8]
+        crc = (t7[b0 ^ (crc >> 8)] ^ t6[b1 ^ (crc & 0xFF)] ^
+               t5[b2] ^ t4[b3] ^ t3[b4] ^ t2[b5] ^ t1[b6] ^ t0[b7])
+        i += 8
+    if i < n:
+        crc = _crc16_bytewise(buf[i:], crc)
+    return crc
+
+# binascii.crc_hqx is the same CRC-CCITT (poly 0x1021, MSB first) computed in
+# C, and takes str/bytes, bytearray and memoryview without copying.
+_crc16_update = getattr(binascii, 'crc_hqx', _crc16_sliced)
+
+def crc16(data):
+    return _crc16_update(data, 0)
+
+def crc16_many(buffers):
+    """Checksums each buffer in buffers, returning a list of CRCs"""
+    update = _crc16_update
+    return [update(buf, 0) for buf in buffers]
+
+class Crc16(object):
+    """Incremental CRC16, for checksumming a stream as it arrives"""
+    __slots__ = ('crc', 'length')
+
+    def __init__(self, data=None):
+        self.crc = 0
+        self.length = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self.crc = _crc16_update(data, self.crc)
+        self.length += len(data)
+        return self
+
+    def digest(self):
+        return self.crc
+
+    def hexdigest(self):
+        return '%04x' % self.crc
+
+    def copy(self):
+        c = Crc16()
+        c.crc = self.crc
+        c.length = self.length
+        return c
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+# Compiled decoders for HID reports
+# =================================
+#
+# Each construct Struct in fbpacket is flattened into a single struct.Struct
+# plus a generated function that assembles the same Container that construct
+# would have produced. Anything the compiler does not understand (embedded
+# bit structs, dynamic arrays, adapters other than the ones below) makes it
+# give up, and those packets keep going through construct.
+#
+# Compiling takes a few milliseconds for the lot, so each opcode's decoders
+# are compiled the first time a report with that opcode is parsed.
+
+import struct
+from construct import Container, ListContainer, Struct, FormatField, \
+    StaticField, MetaArray, MappingAdapter, StringAdapter, Select, Pass
+from construct.core import Reconfig
+from construct.protocols.layer2.ethernet import MacAddressAdapter
+import fbpacket as fb
+
+_HDR = struct.Struct('<BB')
+
+_HEX_BYTE = ['%02x' % i for i in range(256)]
+
+class CompileError(Exception):
+    pass
+
+def _mk(keys, values):
+    # Container() with a known key order, without going through the
+    # per-item __setitem__
+    c = Container.__new__(Container)
+    dict.update(c, zip(keys, values))
+    object.__setattr__(c, '__keys_order__', list(keys))
+    return c
+
+class LayoutWalker(object):
+    """Walks a fixed-layout construct, one field at a time
+
+    walk() looks through Renames and the like and hands each field to the
+    method for its kind: struct, format, mapping, mac, string, static, array
+    or optional. Subclasses implement those; the compiler below and
+    fbview's views are both built this way. Fields of any other kind raise
+    error.
+    """
+    error = CompileError
+
+    def packer(self, cons):
+        if cons.packer.format[0] != '<':
+            raise self.error("unsupported endianness in %s" % cons.name)
+        return cons.packer
+
+    def fields(self, cons):
+        """A Struct's fields, all of which must be named"""
+        for sc in cons.subcons:
+            if sc.conflags & cons.FLAG_EMBED or sc.name is None:
+                raise self.error("embedded field in %s" % cons.name)
+        return cons.subcons
+
+    def walk(self, cons):
+        while isinstance(cons, Reconfig):
+            cons = cons.subcon
+        if isinstance(cons, Struct):
+            return self.struct(cons)
+        if isinstance(cons, FormatField):
+            return self.format(cons, self.packer(cons))
+        if isinstance(cons, MappingAdapter):
+            return self.mapping(cons)
+        if isinstance(cons, MacAddressAdapter) and isinstance(cons.subcon, StaticField):
+            return self.mac(cons, cons.subcon.length)
+        if isinstance(cons, StringAdapter) and isinstance(cons.subcon, StaticField):
+            return self.string(cons, cons.subcon.length, cons.encoding)
+        if type(cons) is StaticField:
+            return self.static(cons, cons.length)
+        if isinstance(cons, MetaArray) and isinstance(cons.subcon, FormatField):
+            try:
+                count = cons.countfunc(Container())
+            except Exception:
+                raise self.error("dynamic array %s" % cons.name)
+            return self.array(cons, count, self.packer(cons.subcon))
+        if isinstance(cons, Select) and len(cons.subcons) == 2 and \
+                cons.subcons[1] is Pass and isinstance(cons.subcons[0], FormatField):
+            # Optional(): present only if there are enough bytes left
+            return self.optional(cons, self.packer(cons.subcons[0]))
+        raise self.error("can't lay out %s (%s)" % (cons.name, type(cons).__name__))
+
+class _Compiler(LayoutWalker):
+    def __init__(self, with_optional):
+        self.with_optional = with_optional
+        self.fmt = []
+        self.nvals = 0
+        self.consts = {}
+        self.optional_seen = False
+
+    def const(self, value):
+        name = '_c%d' % len(self.consts)
+        self.consts[name] = value
+        return name
+
+    def value(self, fmt, count=1):
+        self.fmt.append(fmt)
+        start = self.nvals
+        self.nvals += count
+        return start
+
+    def struct(self, cons):
+        keys = []
+        exprs = []
+        for sc in self.fields(cons):
+            keys.append(sc.name)
+            exprs.append(self.walk(sc))
+        return '_mk(%s, (%s,))' % (self.const(tuple(keys)), ', '.join(exprs))
+
+    def format(self, cons, packer):
+        return 'v[%d]' % self.value(packer.format[1:])
+
+    def mapping(self, cons):
+        inner = self.walk(cons.subcon)
+        mapping = self.const(cons.decoding)
+        if cons.decdefault is NotImplemented:
+            # KeyError sends the whole report back to construct, which
+            # raises the proper MappingError
+            return '%s[%s]' % (mapping, inner)
+        if cons.decdefault is Pass:
+            return '%s.get(%s, %s)' % (mapping, inner, inner)
+        return '%s.get(%s, %s)' % (mapping, inner, self.const(cons.decdefault))
+
+    def mac(self, cons, length):
+        start = self.value('%dB' % length, length)
+        return "'-'.join(map(_hex, v[%d:%d]))" % (start, start + length)
+
+    def string(self, cons, length, encoding):
+        expr = 'v[%d]' % self.value('%ds' % length)
+        if encoding:
+            expr = '%s.decode(%r)' % (expr, encoding)
+        return expr
+
+    def static(self, cons, length):
+        return 'v[%d]' % self.value('%ds' % length)
+
+    def array(self, cons, count, packer):
+        start = self.value('%d%s' % (count, packer.format[1:]), count)
+        return 'ListContainer(v[%d:%d])' % (start, start + count)
+
+    def optional(self, cons, packer):
+        if self.optional_seen:
+            raise CompileError("more than one optional field in %s" % cons.name)
+        self.optional_seen = True
+        if self.with_optional:
+            return self.format(cons, packer)
+        return 'None'
+
+class CompiledDecoder(object):
+    """A struct.Struct based decoder for one fixed-layout packet type"""
+    __slots__ = ('name', 'size', 'decode')
+
+    def __init__(self, name, packer, decode):
+        self.name = name
+        self.size = packer.size
+        self.decode = decode
+
+    def __repr__(self):
+        return '<CompiledDecoder %s (%d bytes)>' % (self.name, self.size)
+
+def _compile_variant(cons, with_optional):
+    c = _Compiler(with_optional)
+    expr = c.walk(cons)
+    packer = struct.Struct('<' + ''.join(c.fmt))
+    env = {
+        '_unpack': packer.unpack_from,
+        '_mk': _mk,
+        '_hex': _HEX_BYTE.__getitem__,
+        'ListContainer': ListContainer,
+    }
+    env.update(c.consts)
+    src = 'def decode(data):\n    v = _unpack(data)\n    return %s\n' % expr
+    exec src in env
+    return CompiledDecoder(cons.name, packer, env['decode']), c.optional_seen
+
+def compile_struct(cons):
+    """Returns a list of decoders for cons, largest first, or None
+
+    Structs with an Optional() field get two decoders, with and without it;
+    the first one that fits the available bytes is the one construct would
+    have matched.
+    """
+    try:
+        full, has_optional = _compile_variant(cons, True)
+        if not has_optional:
+            return [full]
+        short, _ = _compile_variant(cons, False)
+        return [full, short]
+    except CompileError:
+        return None
+
+# Placeholder for decoders that haven't been compiled yet
+_UNCOMPILED = object()
+
+class DecoderTable(object):
+    """compile_struct() results by index, each compiled on first lookup
+
+    decoders is the plain list behind it, for hot paths that check for
+    _UNCOMPILED themselves.
+    """
+    __slots__ = ('types', 'decoders')
+
+    def __init__(self, types, size=256):
+        self.types = [None] * size
+        for index, PktType in types:
+            self.types[index] = PktType
+        self.decoders = [_UNCOMPILED] * size
+
+    def compile(self, index):
+        PktType = self.types[index]
+        decoders = self.decoders[index] = None if PktType is None else compile_struct(PktType)
+        return decoders
+
+    def __getitem__(self, index):
+        decoders = self.decoders[index]
+        if decoders is _UNCOMPILED:
+            decoders = self.compile(index)
+        return decoders
+
+def _opcode_table(opcodes, pkt_map):
+    return DecoderTable((opcodes.encoding[opStr], PktType) for opStr, PktType in pkt_map.items())
+
+HID_IN_DECODERS = _opcode_table(fb.HID_CTRL_IN_OPCODE, fb.HID_IN_MAP)
+HID_OUT_DECODERS = _opcode_table(fb.HID_CTRL_OUT_OPCODE, fb.HID_OUT_MAP)
+
+_VERSION_OPCODE = fb.HID_CTRL_IN_OPCODE.encoding['HID_CTRL_IN_VERSION_RESPONSE']
+# Legacy and extended version responses
+_VERSION_DECODERS = DecoderTable([(0, fb.HID_CtrlInVersionResponse),
+                                  (1, fb.HID_CtrlInVersionResponseEx)], 2)
+
+_IN = HID_IN_DECODERS.decoders
+_OUT = HID_OUT_DECODERS.decoders
+
+def _tobytes(data):
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(bytearray(data))
+
+def parse_hid_IN(data):
+    """Parses a message received FROM the dongle, as fbpacket.parse_hid_IN"""
+    length, opCode = _HDR.unpack_from(data)
+    avail = min(length, len(data))
+    if opCode == _VERSION_OPCODE:
+        decoders = _VERSION_DECODERS[length > fb.VERSION_RESPONSE_LEGACY_PKT_SIZE]
+    else:
+        decoders = _IN[opCode]
+        if decoders is _UNCOMPILED:
+            decoders = HID_IN_DECODERS.compile(opCode)
+    if decoders is not None:
+        for dec in decoders:
+            if dec.size <= avail:
+                try:
+                    return dec.decode(data)
+                except KeyError:
+                    break
+    return fb.parse_hid_IN(_tobytes(data))
+
+def parse_hid_OUT(data):
+    """Parses a message sent TO the dongle, as fbpacket.parse_hid_OUT"""
+    # OUT reports aren't trimmed to their length byte
+    opCode = _HDR.unpack_from(data)[1]
+    decoders = _OUT[opCode]
+    if decoders is _UNCOMPILED:
+        decoders = HID_OUT_DECODERS.compile(opCode)
+    if decoders is not None:
+        avail = len(data)
+        for dec in decoders:
+            if dec.size <= avail:
+                try:
+                    return dec.decode(data)
+                except KeyError:
+                    break
+    return fb.parse_hid_OUT(_tobytes(data))
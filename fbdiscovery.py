@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Discovery aggregator
+# ====================
+#
+# A DiscoveryTable folds HID_CTRL_IN_TRACKER_DEVICE_INFO reports into one
+# record per tracker MAC, however many scans they come from. Each record
+# keeps an exponentially smoothed RSSI, when the tracker was first and last
+# seen, and the productId and synchedRecently bits of its RF_ServiceData.
+#
+# Records are also filed into 256 buckets by rounded smoothed RSSI, one set
+# for every tracker and one for those that haven't synced recently. An
+# update moves a record between buckets in O(1), and best() walks the
+# buckets from the strongest signal down, so "best N unsynced" never sorts
+# the whole table.
+
+import time
+import Queue
+
+ALPHA = 0.3
+
+DEVICE_INFO = 'HID_CTRL_IN_TRACKER_DEVICE_INFO'
+
+class TrackerRecord(object):
+    __slots__ = ('addr', 'addrType', 'rssi', 'last_rssi', 'first_seen', 'last_seen',
+                 'seen', 'productId', 'synchedRecently', 'serviceUUID', 'bucket')
+
+    def __init__(self, addr, now):
+        self.addr = addr
+        self.addrType = None
+        self.rssi = None
+        self.last_rssi = None
+        self.first_seen = now
+        self.last_seen = now
+        self.seen = 0
+        self.productId = None
+        self.synchedRecently = False
+        self.serviceUUID = None
+        self.bucket = None
+
+    def __repr__(self):
+        return '<TrackerRecord %s rssi=%.1f productId=%s synchedRecently=%s seen=%d>' % (
+            self.addr, self.rssi, self.productId, self.synchedRecently, self.seen)
+
+def _bucket(rssi):
+    return int(round(rssi)) + 128
+
+class DiscoveryTable(object):
+    def __init__(self, alpha=ALPHA, clock=time.time):
+        self.alpha = alpha
+        self.clock = clock
+        self.records = {}
+        self._all = [set() for _ in range(256)]
+        self._unsynced = [set() for _ in range(256)]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, addr):
+        return addr in self.records
+
+    def __getitem__(self, addr):
+        return self.records[addr]
+
+    def _unfile(self, rec):
+        if rec.bucket is not None:
+            self._all[rec.bucket].discard(rec)
+            self._unsynced[rec.bucket].discard(rec)
+
+    def _file(self, rec):
+        rec.bucket = _bucket(rec.rssi)
+        self._all[rec.bucket].add(rec)
+        if not rec.synchedRecently:
+            self._unsynced[rec.bucket].add(rec)
+
+    def update(self, response):
+        """Folds in one parsed TRACKER_DEVICE_INFO report; returns its record
+
+        Usable as a Router handler, but note that it returns the record.
+        """
+        now = self.clock()
+        rec = self.records.get(response.addr)
+        if rec is None:
+            rec = self.records[response.addr] = TrackerRecord(response.addr, now)
+        else:
+            self._unfile(rec)
+        rssi = response.rssi
+        if rec.rssi is None:
+            rec.rssi = float(rssi)
+        else:
+            rec.rssi += self.alpha * (rssi - rec.rssi)
+        rec.last_rssi = rssi
+        rec.last_seen = now
+        rec.seen += 1
+        rec.addrType = response.addrType
+        rec.serviceUUID = response.serviceUUID
+        sd = response.serviceData
+        if response.serviceDataLen >= 2:
+            # RF_ServiceData: productId, then reserved:1 colorCode:4
+            # canDisplayNumber:1 synchedRecently:1 specialMode:1, MSB first
+            rec.productId = sd[0]
+            rec.synchedRecently = bool(sd[1] >> 1 & 1)
+        self._file(rec)
+        return rec
+
+    __call__ = update
+
+    def mark_synced(self, addr):
+        """Treats a tracker as synced until its next report says otherwise"""
+        rec = self.records[addr]
+        self._unfile(rec)
+        rec.synchedRecently = True
+        self._file(rec)
+
+    def expire(self, max_age):
+        """Drops trackers not seen for max_age seconds"""
+        cutoff = self.clock() - max_age
+        for addr, rec in self.records.items():
+            if rec.last_seen < cutoff:
+                self._unfile(rec)
+                del self.records[addr]
+
+    def best(self, n, unsynced=True, max_age=None, exclude=()):
+        """Up to n records with the strongest smoothed RSSI, strongest first
+
+        With unsynced, only trackers that haven't synced recently; with
+        max_age, only those seen in the last max_age seconds.
+        """
+        buckets = self._unsynced if unsynced else self._all
+        cutoff = None if max_age is None else self.clock() - max_age
+        out = []
+        for i in xrange(255, -1, -1):
+            bucket = buckets[i]
+            if not bucket:
+                continue
+            for rec in sorted(bucket, key=lambda r: -r.rssi):
+                if cutoff is not None and rec.last_seen < cutoff:
+                    continue
+                if rec.addr in exclude:
+                    continue
+                out.append(rec)
+                if len(out) == n:
+                    return out
+        return out
+
+    def scan(self, client, msg, timeout=None):
+        """Runs one discovery on a Client and folds in what it finds
+
+        Returns the number of reports seen.
+        """
+        kwargs = {} if timeout is None else {'timeout': timeout}
+        trackers = client.discover(msg, **kwargs)
+        for response in trackers:
+            self.update(response)
+        return len(trackers)
+
+    def run(self, client, msg, stop, timeout=None):
+        """Scans back to back until the stop Event is set
+
+        Reports reach the table through a queue fed by the Client's reader,
+        so none are lost between one scan and the next.
+        """
+        q = client.subscribe(DEVICE_INFO)
+        kwargs = {} if timeout is None else {'timeout': timeout}
+        try:
+            while not stop.is_set():
+                client.command(msg, **kwargs)
+                while True:
+                    try:
+                        self.update(q.get_nowait())
+                    except Queue.Empty:
+                        break
+        finally:
+            client.unsubscribe(q)
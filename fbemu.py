@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+# Loopback dongle and tracker emulator
+# ====================================
+#
+# Dongle stands in for the 0x2687:0xfb01 USB dongle and the trackers around
+# it. Its ctrl and data attributes behave like the hid.device objects that
+# get_devs returns: write() takes a list of ints, read(32, timeout_ms)
+# returns one, or [] on timeout. Everything fbtalk sends is understood:
+#
+#   control  version query, echo, discovery, link establish/terminate, TX
+#            pipe, transmitter power and the rest (ACKed); NAKs when a
+#            command doesn't make sense in the current state
+#   data     echo, init airlink, set clock, and tracker block (megadump)
+#            and memory reads answered with XFR2HOST streams
+#
+# XFR2HOST payloads are escaped as a whole (0xC0 -> DB DC, 0xDB -> DB DD) and
+# cut into RF_MAX_PACKET_SIZE chunks, so no chunk starts with the RF magic
+# byte; the stream trailer carries the crc16 of the unescaped payload.
+#
+# Responses are delivered latency seconds after the command, report_interval
+# apart, and each IN report is lost with probability loss, or swapped with
+# the one after it with probability reorder. Discovery takes
+# scanDuration * scan_scale; pass scan_scale=0 to have it finish at once.
+
+import time
+import random
+import threading
+from collections import deque
+import fbpacket as fb
+import fbdecode
+from fbcrc import crc16
+from fbcmd import rf_template
+from construct import Container
+
+CTRL = 0
+DATA = 1
+
+# Error codes used for NAKs (see fbpacket.ERROR_CODES)
+COMMAND_DISALLOWED = 12
+CONNECTION_TIMEOUT = 8
+CONNECTION_FAILED = 62
+TERMINATED_BY_LOCAL_HOST = 22
+
+_MAGIC = ord(fb.RF_PKT_MAGIC_BYTE)
+
+def _report(data):
+    return [ord(c) for c in data] + [0] * (fb.HID_REPORT_SIZE - len(data))
+
+def in_report(opcode, PktType, **values):
+    """Builds a control IN report, with its length byte filled in"""
+    values['hdr'] = Container(length=0, opcode=opcode)
+    data = PktType.build(Container(**values))
+    return _report(chr(len(data)) + data[1:])
+
+def _pattern(seed, size):
+    r = random.Random(seed)
+    return ''.join(chr(r.randrange(256)) for _ in xrange(size))
+
+def _mac(addr):
+    if len(addr) == 6:
+        return '-'.join(c.encode('hex') for c in addr)
+    return addr.lower()
+
+class Tracker(object):
+    """A tracker in range of the emulated dongle"""
+
+    def __init__(self, addr, rssi=-60, productId=1, synchedRecently=False,
+                 megadump=None, memory=None, serviceUUID=0xFB00):
+        self.addr = _mac(addr)
+        self.rssi = rssi
+        self.productId = productId
+        self.synchedRecently = synchedRecently
+        self.serviceUUID = serviceUUID
+        self.megadump = _pattern(self.addr, 4096) if megadump is None else megadump
+        self.memory = _pattern(self.addr + 'mem', 65536) if memory is None else memory
+
+    def device_info(self):
+        serviceData = fb.RF_ServiceData.build(Container(
+            productId=self.productId, reserved=0, colorCode=0, canDisplayNumber=0,
+            synchedRecently=int(self.synchedRecently), specialMode=0))
+        return in_report('HID_CTRL_IN_TRACKER_DEVICE_INFO', fb.HID_CtrlInTrackerDeviceInfo,
+            addr=self.addr, addrType=1, rssi=self.rssi, serviceDataLen=len(serviceData),
+            serviceData=[ord(c) for c in serviceData.ljust(fb.HID_MAX_SERVICE_DATA_BYTES, '\0')],
+            serviceUUID=self.serviceUUID)
+
+class Interface(object):
+    """One HID interface of the emulated dongle, with the hid.device API"""
+
+    def __init__(self, dongle, number):
+        self.dongle = dongle
+        self.number = number
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.nonblocking = False
+
+    def open_path(self, path):
+        pass
+
+    def close(self):
+        pass
+
+    def set_nonblocking(self, flag):
+        self.nonblocking = bool(flag)
+
+    def write(self, data):
+        if isinstance(data, (str, bytearray)):
+            data = str(data)
+        else:
+            data = ''.join(chr(c) for c in data)
+        self.dongle.handle(self.number, data)
+        return len(data)
+
+    def deliver(self, due, report):
+        with self.cond:
+            self.pending.append((due, report))
+            self.cond.notify()
+
+    def read(self, max_length, timeout_ms=0):
+        # As in cython-hidapi, timeout_ms=0 blocks unless nonblocking is set
+        deadline = None
+        if timeout_ms > 0:
+            deadline = time.time() + timeout_ms / 1000.0
+        elif self.nonblocking:
+            deadline = 0
+        with self.cond:
+            while True:
+                now = time.time()
+                if self.pending and self.pending[0][0] <= now:
+                    return self.pending.popleft()[1][:max_length]
+                wait = None
+                if self.pending:
+                    wait = self.pending[0][0] - now
+                if deadline is not None:
+                    if now >= deadline:
+                        return []
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self.cond.wait(wait)
+
+class Dongle(object):
+    def __init__(self, trackers=(), latency=0.0, report_interval=0.0, loss=0.0,
+                 scan_scale=1.0, connect_failure=0.0, seed=None, reorder=0.0,
+                 deviceAddr='02-00-00-00-fb-01', version=(1, 0)):
+        self.trackers = dict((t.addr, t) for t in trackers)
+        self.latency = latency
+        self.report_interval = report_interval
+        self.loss = loss
+        self.reorder = reorder
+        self.scan_scale = scan_scale
+        self.connect_failure = connect_failure
+        self.random = random.Random(seed)
+        self.deviceAddr = deviceAddr
+        self.version = version
+        self.linked = None
+        self.tx_enabled = False
+        self.ctrl = Interface(self, CTRL)
+        self.data = Interface(self, DATA)
+        self.lock = threading.Lock()
+        self._data_due = 0.0
+        self._ack = in_report('HID_CTRL_IN_ACK_RESPONSE', fb.DefaultIn(2), payload='')
+
+    def interfaces(self):
+        """(CtrlIF, DataIF), as get_devs returns them"""
+        return self.ctrl, self.data
+
+    def _send(self, interface, reports, start=None):
+        """Queues reports on an interface, starting latency seconds from now"""
+        due = (time.time() if start is None else start) + self.latency
+        if interface is self.data:
+            # The radio sends one thing at a time, so a response to a command
+            # sent mid-stream follows the stream rather than interleaving.
+            # That's a model: what a real tracker does with a second read
+            # sent mid-stream is unconfirmed (see fbbulk)
+            due = max(due, self._data_due)
+        # [time due, report], leaving a lost report's slot empty
+        slots = []
+        for report in reports:
+            if not (self.loss and self.random.random() < self.loss):
+                slots.append([due, report])
+            due += self.report_interval
+        if self.reorder:
+            for a, b in zip(slots, slots[1:]):
+                if self.random.random() < self.reorder:
+                    a[1], b[1] = b[1], a[1]
+        for at, report in slots:
+            interface.deliver(at, report)
+        if interface is self.data:
+            self._data_due = due
+
+    def _nak(self, errorCode):
+        return in_report('HID_CTRL_IN_NAK_RESPONSE', fb.HID_CtrlInNakResponse, errorCode=errorCode)
+
+    def _link_terminated(self, reason):
+        self.linked = None
+        self.tx_enabled = False
+        return in_report('HID_CTRL_IN_LINK_TERMINATED', fb.HID_CtrlInLinkTerminated, reason=reason)
+
+    def handle(self, number, data):
+        with self.lock:
+            if number == CTRL:
+                self._handle_ctrl(data)
+            else:
+                self._handle_data(data)
+
+    # Control interface
+    # -----------------
+
+    def _handle_ctrl(self, data):
+        cmd = fbdecode.parse_hid_OUT(data)
+        opcode = cmd.hdr.opcode
+        handler = getattr(self, '_' + opcode[len('HID_CTRL_OUT_'):].lower(), None)
+        if handler is None:
+            self._send(self.ctrl, [self._ack])
+        else:
+            handler(cmd)
+
+    def _query_version(self, cmd):
+        self._send(self.ctrl, [in_report('HID_CTRL_IN_VERSION_RESPONSE', fb.HID_CtrlInVersionResponse,
+            majorVersion=self.version[0], minorVersion=self.version[1], deviceAddr=self.deviceAddr,
+            flashEraseTime=0, firmwareStartAddress=0, firmwareEndAddress=0,
+            ccIC='MICROCONTROLLER_CC2540F256')])
+
+    def _echo_request(self, cmd):
+        self._send(self.ctrl, [in_report('HID_CTRL_IN_ECHO_RESPONSE', fb.HID_CtrlInEchoResponse,
+            payload=cmd.payload)])
+
+    def _start_discovery(self, cmd):
+        trackers = [t for t in self.trackers.values() if t.serviceUUID == cmd.serviceUUID]
+        scan = cmd.scanDuration / 1000.0 * self.scan_scale
+        now = time.time()
+        for i, t in enumerate(trackers):
+            self._send(self.ctrl, [t.device_info()], now + scan * (i + 1) / (len(trackers) + 1))
+        # Discovery itself always reports back, even on a lossy link
+        self.ctrl.deliver(now + scan + self.latency, in_report('HID_CTRL_IN_DISCOVERY_COMPLETE',
+            fb.HID_CtrlInDiscoveryComplete, numTrackers=min(len(trackers), 255)))
+
+    def _establish_link(self, cmd):
+        if self.linked is not None:
+            self._send(self.ctrl, [in_report('HID_CTRL_IN_ALREADY_CONNECTED', fb.DefaultIn(2), payload='')])
+            return
+        tracker = self.trackers.get(_mac(cmd.addr))
+        if tracker is None:
+            self._send(self.ctrl, [self._nak(CONNECTION_FAILED)])
+        elif self.connect_failure and self.random.random() < self.connect_failure:
+            self._send(self.ctrl, [self._link_terminated(CONNECTION_TIMEOUT)])
+        else:
+            self.linked = tracker
+            self._send(self.ctrl, [in_report('HID_CTRL_IN_LINK_ESTABLISHED',
+                fb.HID_CtrlInLinkEstablished, linkStatus=0)])
+
+    _establish_link_ex = _establish_link
+    _establish_link_ex2 = _establish_link
+
+    def _terminate_link(self, cmd):
+        reports = []
+        if self.linked is not None:
+            reports.append(self._link_terminated(TERMINATED_BY_LOCAL_HOST))
+        self._send(self.ctrl, reports + [self._ack])
+
+    _force_disconnect = _terminate_link
+
+    def drop_link(self, reason=CONNECTION_TIMEOUT):
+        """Loses the link, as if the tracker went out of range
+
+        Data reports not yet read are lost with it.
+        """
+        with self.lock:
+            if self.linked is not None:
+                self._send(self.ctrl, [self._link_terminated(reason)])
+            with self.data.cond:
+                self.data.pending.clear()
+
+    def _enable_tx_pipe(self, cmd):
+        if self.linked is None:
+            self._send(self.ctrl, [self._nak(COMMAND_DISALLOWED)])
+            return
+        self.tx_enabled = cmd.enable
+        self._send(self.ctrl, [self._ack])
+
+    # Data interface
+    # --------------
+
+    def _handle_data(self, data):
+        tracker = self.linked
+        if tracker is None or not self.tx_enabled:
+            return
+        pkt = data[:ord(data[-1])] if len(data) == fb.HID_REPORT_SIZE else data
+        if not pkt or ord(pkt[0]) != _MAGIC:
+            return
+        hdr = fb.RF_PktHdr.parse(pkt)
+        if hdr.opcode == 'RF_PKT_MISC_ECHO_PACKET':
+            self._send(self.data, [_report(fb.make_data_packet(pkt))])
+        elif hdr.opcode == 'RF_PKT_MISC_INIT_AIRLINK':
+            self._send(self.data, [_report(_AIRLINK_BLOCK.build(deviceAddress=tracker.addr))])
+        elif hdr.opcode == 'RF_PKT_MISC_SET_DEVICE_CLOCK':
+            self._send(self.data, [_report(_RF_ACK.build())])
+        elif hdr.opcode == 'RF_PKT_READ_TRACKER_BLOCK':
+            block = fb.RF_ReadTrackerBlockPkt.parse(pkt)
+            if block.blockType == 'RF_TRACKERBLOCK_MEGA_DUMP':
+                self._stream(tracker.megadump, 'RF_TRACKERBLOCK_MEGA_DUMP')
+            else:
+                self._send(self.data, [_report(_RF_NAK.build(errorCode=COMMAND_DISALLOWED))])
+        elif hdr.opcode == 'RF_PKT_READ_TRACKER_MEMORY':
+            read = fb.RF_ReadTrackerMemoryPkt.parse(pkt)
+            end = read.startAddr + read.numBytesToRead
+            if end > len(tracker.memory):
+                self._send(self.data, [_report(_RF_NAK.build(errorCode=COMMAND_DISALLOWED))])
+            else:
+                self._stream(tracker.memory[read.startAddr:end], 'RF_TRACKERBLOCK_MEMORY')
+        else:
+            self._send(self.data, [_report(_RF_NAK.build(errorCode=COMMAND_DISALLOWED))])
+
+    def _stream(self, payload, blockType):
+        escaped = fb.rf_escape(payload)
+        size = fb.RF_MAX_PACKET_SIZE
+        reports = [_report(_STREAM_STARTING.build(blockType=blockType, numPayloadBytes=len(payload)))]
+        reports.extend(_report(fb.make_data_packet(escaped[i:i + size]))
+                       for i in xrange(0, len(escaped), size))
+        reports.append(_report(_STREAM_FINISHED.build(blockType=blockType, crc=crc16(payload),
+                                                      numPayloadBytes=len(payload))))
+        self._send(self.data, reports)
+
+_STREAM_STARTING = rf_template('RF_PKT_GRP_XFR2HOST', 'RF_PKT_XFR2HOST_STREAM_STARTING',
+                               fb.RF_Xfr2HostStreamStartingPkt)
+_STREAM_FINISHED = rf_template('RF_PKT_GRP_XFR2HOST', 'RF_PKT_XFR2HOST_STREAM_FINISHED',
+                               fb.RF_Xfr2HostStreamFinishedPkt)
+_AIRLINK_BLOCK = rf_template('RF_PKT_GRP_READ', 'RF_PKT_READ_AIRLINK_BLOCK', fb.RF_ReadAirlinkBlockPkt,
+                             blockType='RF_TRACKERBLOCK_AIRLINK_INFO', majorAirlinkVersion=6,
+                             minorAirlinkVersion=0, bootMode='RF_BOOTMODE_APP')
+_RF_ACK = rf_template('RF_PKT_GRP_MISC', 'RF_PKT_MISC_CMD_ACK')
+_RF_NAK = rf_template('RF_PKT_GRP_MISC', 'RF_PKT_MISC_CMD_NAK')
+
+def make_trackers(count, seed=0):
+    """count trackers with distinct addresses and RSSIs from -90 to -40"""
+    r = random.Random(seed)
+    return [Tracker('c0-ff-ee-%02x-%02x-%02x' % (i >> 16 & 0xFF, i >> 8 & 0xFF, i & 0xFF),
+                    rssi=r.randint(-90, -40), synchedRecently=r.random() < 0.5)
+            for i in range(count)]
+
+class _Device(object):
+    """hid.device() stand-in that opens an emulated interface by path"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.interface = None
+
+    def open_path(self, path):
+        self.interface = self.backend.paths[path]
+
+    def __getattr__(self, name):
+        if self.interface is None:
+            raise IOError("device not open")
+        return getattr(self.interface, name)
+
+class Backend(object):
+    """Stands in for the hid module, with any number of emulated dongles
+
+    enumerate() lists each dongle's two interfaces the way hidapi does, with
+    the data interface first on every other dongle so callers can't rely on
+    the order.
+    """
+
+    def __init__(self, dongles):
+        self.dongles = list(dongles)
+        self.paths = {}
+        self.infos = []
+        for i, dongle in enumerate(self.dongles):
+            pair = [(0, dongle.ctrl), (1, dongle.data)]
+            if i % 2:
+                pair.reverse()
+            for number, interface in pair:
+                path = 'emu:%d:%d' % (i, number)
+                self.paths[path] = interface
+                self.infos.append({
+                    'path': path,
+                    'vendor_id': 0x2687,
+                    'product_id': 0xfb01,
+                    'serial_number': u'EMU%04d' % i,
+                    'interface_number': number,
+                })
+
+    def enumerate(self, vid=0, pid=0):
+        return [dict(info) for info in self.infos
+                if vid in (0, info['vendor_id']) and pid in (0, info['product_id'])]
+
+    def device(self):
+        return _Device(self)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Bytes-native HID transport
+# ==========================
+#
+# cython-hidapi's device.read returns a list of ints, and its write takes
+# anything that iterates as ints. Converting each report by hand, with
+# [ord(c) for c in msg] on the way out and ''.join(chr(c) for c in x) on
+# the way in, builds a list of 32 ints and 32 one-character strings per
+# report.
+#
+# A Transport wraps one hid.device. write() hands the device a bytearray,
+# which already iterates as ints. read_into() copies each report into one
+# preallocated bytearray in place, and recv() returns a memoryview of it, so
+# a parser such as fbdecode.parse_hid_IN or fbview.view_hid_IN can read the
+# report where it lies. That view is only good until the next read; take
+# view.tobytes() to keep a report.
+#
+# A Tap is a stand-in for a hid.device that shows every report going
+# through it to a callback; fbtrace and fbmetrics instrument interfaces
+# with one.
+
+import fbpacket as fb
+
+class Transport(object):
+    """One hid.device interface, in bytes"""
+    __slots__ = ('device', 'buf', 'view')
+
+    def __init__(self, device, size=fb.HID_REPORT_SIZE):
+        self.device = device
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+    def write(self, msg):
+        """Sends a str, bytearray or memoryview"""
+        return self.device.write(msg if isinstance(msg, bytearray) else bytearray(msg))
+
+    def read_into(self, timeout_ms=0):
+        """Reads one report into buf; returns its length, 0 on timeout"""
+        x = self.device.read(len(self.buf), timeout_ms=timeout_ms)
+        n = len(x)
+        if n == len(self.buf):
+            self.buf[:] = x
+        elif n:
+            # Resizing buf would invalidate view, so short reports go
+            # through a copy
+            self.view[:n] = str(bytearray(x))
+        return n
+
+    def recv(self, timeout_ms=0):
+        """The next report as a memoryview of buf, or None on timeout"""
+        n = self.read_into(timeout_ms)
+        if n == len(self.buf):
+            return self.view
+        return self.view[:n] if n else None
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+class Tap(object):
+    """Forwards to a hid.device, passing each report written to on_write
+    and each report read to on_read"""
+
+    def __init__(self, device, on_write, on_read):
+        self.device = device
+        self.on_write = on_write
+        self.on_read = on_read
+
+    def write(self, data):
+        self.on_write(data)
+        return self.device.write(data)
+
+    def read(self, max_length, timeout_ms=0):
+        x = self.device.read(max_length, timeout_ms=timeout_ms)
+        if x:
+            self.on_read(x)
+        return x
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
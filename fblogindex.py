@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# Sidecar decode cache for control logs
+# =====================================
+#
+# The first run over a log decodes every CONTROL IN/OUT line once and keeps
+# the direction, opcode and top-level scalar fields of each packet in an
+# SQLite file next to it, keyed by byte offset. Later runs only decode what
+# was appended since, and queries like "NAKs with errorCode 8" are answered
+# from the index without touching the log.
+#
+# The index remembers which file it belongs to (device, inode and a hash of
+# the head of the log) and how far it got; if the log was replaced or
+# truncated it is rebuilt from scratch.
+
+import os
+import sys
+import hashlib
+import sqlite3
+import argparse
+import parse_control_log
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS records (
+    offset INTEGER PRIMARY KEY,
+    direction TEXT,
+    opcode TEXT,
+    data TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS records_opcode ON records (opcode, direction);
+CREATE TABLE IF NOT EXISTS fields (offset INTEGER, name TEXT, value);
+CREATE INDEX IF NOT EXISTS fields_name_value ON fields (name, value);
+'''
+
+HEAD_SIZE = 4096
+
+def key_fields(packet):
+    """The top-level scalar fields of a packet worth querying on"""
+    for name, value in packet.items():
+        if name == 'hdr' or value is None:
+            continue
+        if isinstance(value, (int, long, bool)):
+            yield name, int(value)
+        elif isinstance(value, str) and len(value) <= 32:
+            # Trace messages are NUL padded; raw bytes needn't be UTF-8
+            yield name, value.split('\0', 1)[0].decode('latin-1')
+
+def _head_hash(buf, length):
+    return hashlib.sha1(buf[:min(length, HEAD_SIZE)]).hexdigest()
+
+class LogIndex(object):
+    def __init__(self, logpath, indexpath=None):
+        self.logpath = logpath
+        self.indexpath = indexpath or logpath + '.fbidx'
+        self.db = sqlite3.connect(self.indexpath)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, **values):
+        self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', values.items())
+
+    def _reset(self):
+        self.db.execute('DELETE FROM records')
+        self.db.execute('DELETE FROM fields')
+        self.db.execute('DELETE FROM meta')
+
+    def update(self):
+        """Indexes whatever was appended to the log since the last update
+
+        Returns the number of new packets. A trailing line without its
+        newline is left for the next update.
+        """
+        st = os.stat(self.logpath)
+        buf = parse_control_log.open_log(self.logpath)
+        scanned = self._meta('scanned', 0)
+        identity = '%d:%d' % (st.st_dev, st.st_ino)
+        if (self._meta('identity') != identity or len(buf) < scanned or
+                self._meta('head') != _head_hash(buf, scanned)):
+            self._reset()
+            scanned = 0
+        end = buf.rfind('\n', scanned) + 1 if len(buf) else 0
+        if end <= scanned:
+            return 0
+        count = 0
+        with self.db:
+            # A line that isn't valid hex comes out with its error as raw
+            matches = parse_control_log.scan(buf, scanned, end)
+            for batch in parse_control_log.batches(matches,
+                                                   decode_batch=parse_control_log._decode_lines):
+                records = []
+                fields = []
+                for offset, direction, data, raw in batch:
+                    if isinstance(raw, Exception):
+                        records.append((offset, direction, None, data, repr(raw)))
+                        continue
+                    try:
+                        packet = parse_control_log.parse_packet(direction, raw)
+                    except Exception as e:
+                        records.append((offset, direction, None, data, repr(e)))
+                        continue
+                    records.append((offset, direction, packet.hdr.opcode, data, None))
+                    fields.extend((offset, name, value) for name, value in key_fields(packet))
+                self.db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)', records)
+                self.db.executemany('INSERT INTO fields VALUES (?, ?, ?)', fields)
+                count += len(records)
+            self._set_meta(identity=identity, scanned=end, head=_head_hash(buf, end))
+        return count
+
+    def query(self, opcode=None, direction=None, **fields):
+        """Returns (offset, direction, opcode, data) for the matching packets, in log order"""
+        sql = ['SELECT offset, direction, opcode, data FROM records WHERE 1']
+        args = []
+        if opcode is not None:
+            sql.append('AND opcode = ?')
+            args.append(opcode)
+        if direction is not None:
+            sql.append('AND direction = ?')
+            args.append(direction)
+        for name, value in sorted(fields.items()):
+            sql.append('AND offset IN (SELECT offset FROM fields WHERE name = ? AND value = ?)')
+            args.extend((name, value))
+        sql.append('ORDER BY offset')
+        return self.db.execute(' '.join(sql), args).fetchall()
+
+    def errors(self):
+        """Packets that failed to decode, as (offset, direction, data, error)"""
+        return self.db.execute('SELECT offset, direction, data, error FROM records '
+                               'WHERE error IS NOT NULL ORDER BY offset').fetchall()
+
+def _field_arg(text):
+    name, _, value = text.partition('=')
+    try:
+        value = int(value, 0)
+    except ValueError:
+        pass
+    return name, value
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query a control log through its decode cache')
+    parser.add_argument('logfile')
+    parser.add_argument('-o', '--opcode', help='e.g. HID_CTRL_IN_NAK_RESPONSE')
+    parser.add_argument('-d', '--direction', choices=['IN', 'OUT'])
+    parser.add_argument('-w', '--where', action='append', type=_field_arg, default=[],
+                        metavar='FIELD=VALUE', help='e.g. errorCode=8; may be repeated')
+    parser.add_argument('--decode', action='store_true', help='print the full decoded packets')
+    args = parser.parse_args(argv)
+
+    index = LogIndex(args.logfile)
+    new = index.update()
+    if new:
+        print >>sys.stderr, "indexed %d new packets" % new
+    for offset, direction, opcode, data in index.query(args.opcode, args.direction, **dict(args.where)):
+        if args.decode:
+            raw = data.decode('hex')
+            sys.stdout.write(parse_control_log.format_text(offset, direction, data,
+                parse_control_log.parse_packet(direction, raw)))
+        else:
+            print "%d %s %s %s" % (offset, direction, opcode, data)
+    index.close()
+
+if __name__ == '__main__':
+    main()
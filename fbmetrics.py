@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# Transport metrics
+# =================
+#
+# Metrics.wrap puts a thin proxy around the ctrl and data hid.device objects,
+# so it sees every report whether the caller is send_and_wait, recv_all or a
+# Client. It keeps:
+#
+#   - latency from each OUT command to its first IN report and to its
+#     terminal one (see fbclient.TERMINAL), per HID_CTRL_OUT_OPCODE. With
+#     commands pipelined, IN reports belong to the oldest one in flight, as
+#     in fbclient.Pipeline; a command not answered within MAX_RTO is
+#     forgotten.
+#   - a count of every HID_CTRL_IN_OPCODE and of every NAK errorCode
+#   - bytes and reports read from the data interface
+#
+# Latencies go into Histograms: HDR-style log-linear buckets of
+# microseconds, 64 per power of two, so recording is an index computation
+# and an increment, and any quantile is within ~1.6% of the true value.
+#
+# snapshot() returns all of it as a JSON-ready dict, prometheus() in the
+# Prometheus text exposition format.
+#
+# Every fbclient.Client keeps a Metrics as client.metrics, and fbtalk one
+# over the interfaces get_devs opens.
+
+import time
+import threading
+from array import array
+from collections import deque
+import fbpacket as fb
+# fbclient imports this module in turn, so its names are looked up on use
+import fbclient
+from fbhid import Tap
+
+SUB_BITS = 6
+SUB_COUNT = 1 << SUB_BITS
+# Up to 2**40 us, about 12 days
+MAX_SHIFT = 40 - SUB_BITS
+
+# Bucket bounds for the Prometheus export, in seconds
+EXPORT_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                 0.5, 1, 2.5, 5, 10, 30, 60)
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+_NAK = fb.HID_CTRL_IN_OPCODE.encoding['HID_CTRL_IN_NAK_RESPONSE']
+
+def _index(v):
+    if v < SUB_COUNT:
+        return v
+    shift = v.bit_length() - SUB_BITS - 1
+    return (shift + 1) * SUB_COUNT + (v >> shift) - SUB_COUNT
+
+def _upper(index):
+    """Largest value that lands in bucket index"""
+    if index < SUB_COUNT:
+        return index
+    shift = index // SUB_COUNT - 1
+    sub = index % SUB_COUNT + SUB_COUNT
+    return ((sub + 1) << shift) - 1
+
+class Histogram(object):
+    """Log-linear histogram of non-negative integers (microseconds here)"""
+
+    def __init__(self):
+        self.counts = array('L', [0]) * ((MAX_SHIFT + 2) * SUB_COUNT)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        v = int(value)
+        if v < 0:
+            v = 0
+        i = _index(v)
+        if i >= len(self.counts):
+            i = len(self.counts) - 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            if n:
+                self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        for v in (other.min, other.max):
+            if v is not None:
+                self.min = v if self.min is None else min(self.min, v)
+                self.max = v if self.max is None else max(self.max, v)
+
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0.0
+
+    def percentile(self, q):
+        """The value at quantile q (0-1), to bucket precision"""
+        if not self.count:
+            return 0
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(_upper(i), self.max)
+        return self.max
+
+    def count_below(self, value):
+        """How many recorded values are <= value, to bucket precision"""
+        last = _index(int(value))
+        return sum(self.counts[:last + 1])
+
+    def summary(self, scale=1e-6):
+        """count, min, max, mean and QUANTILES, scaled to seconds by default"""
+        s = {
+            'count': self.count,
+            'min': (self.min or 0) * scale,
+            'max': (self.max or 0) * scale,
+            'mean': self.mean() * scale,
+        }
+        for q in QUANTILES:
+            s['p%s' % ('%g' % (q * 100)).replace('.', '')] = self.percentile(q) * scale
+        return s
+
+def _terminal_set(name):
+    return frozenset(fb.HID_CTRL_IN_OPCODE.encoding[op]
+                     for op in fbclient.TERMINAL.get(name, fbclient.DEFAULT_TERMINAL)) | \
+        frozenset([_NAK])
+
+class Metrics(object):
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.first = {}
+        self.terminal = {}
+        self.in_counts = [0] * 256
+        self.naks = {}
+        self.data_bytes = 0
+        self.data_reports = 0
+        self.started = clock()
+        self._lock = threading.Lock()
+        # [opcode, time sent, first report seen] per command in flight
+        self._pending = deque()
+        self._terminals = dict((name, _terminal_set(name))
+                               for name in fb.HID_CTRL_OUT_OPCODE.encoding)
+
+    def wrap(self, ctrl, data):
+        """Instrumented stand-ins for the ctrl and data interfaces"""
+        return (Tap(ctrl, self.command_sent, self.ctrl_report),
+                Tap(data, lambda data: None, self.data_report))
+
+    def _histogram(self, table, name):
+        h = table.get(name)
+        if h is None:
+            h = table[name] = Histogram()
+        return h
+
+    def command_sent(self, msg):
+        op = msg[1] if isinstance(msg, (list, bytearray)) else ord(msg[1])
+        name = fb.HID_CTRL_OUT_OPCODE.decoding.get(op)
+        if name is None:
+            return
+        now = self.clock()
+        with self._lock:
+            pending = self._pending
+            while pending and pending[0][1] < now - fbclient.MAX_RTO:
+                pending.popleft()
+            pending.append([name, now, False])
+
+    def ctrl_report(self, report):
+        if not isinstance(report, list):
+            report = bytearray(report)
+        op = report[1]
+        self.in_counts[op] += 1
+        if op == _NAK and report[0] >= 4:
+            code = report[2] | report[3] << 8
+            self.naks[code] = self.naks.get(code, 0) + 1
+        with self._lock:
+            if not self._pending:
+                return
+            oldest = self._pending[0]
+            name, sent, seen = oldest
+            elapsed = (self.clock() - sent) * 1e6
+            if not seen:
+                oldest[2] = True
+                self._histogram(self.first, name).record(elapsed)
+            if op in self._terminals[name]:
+                self._histogram(self.terminal, name).record(elapsed)
+                self._pending.popleft()
+
+    def data_report(self, report):
+        self.data_reports += 1
+        self.data_bytes += len(report)
+
+    def snapshot(self):
+        elapsed = self.clock() - self.started
+        return {
+            'time': self.clock(),
+            'latency': dict((name, {
+                'first': self.first[name].summary() if name in self.first else None,
+                'terminal': self.terminal[name].summary() if name in self.terminal else None,
+            }) for name in set(self.first) | set(self.terminal)),
+            'in_reports': dict((fb.HID_CTRL_IN_OPCODE.decoding.get(op, str(op)), n)
+                               for op, n in enumerate(self.in_counts) if n),
+            'naks': dict((str(code), n) for code, n in self.naks.items()),
+            'data': {
+                'bytes': self.data_bytes,
+                'reports': self.data_reports,
+                'seconds': elapsed,
+                'bytes_per_second': self.data_bytes / elapsed if elapsed > 0 else 0.0,
+            },
+        }
+
+    def prometheus(self, prefix='fb'):
+        out = []
+        metric = prefix + '_command_latency_seconds'
+        out.append('# HELP %s Time from an OUT command to its first or terminal IN report' % metric)
+        out.append('# TYPE %s histogram' % metric)
+        for stage, table in (('first', self.first), ('terminal', self.terminal)):
+            for name in sorted(table):
+                h = table[name]
+                labels = 'opcode="%s",stage="%s"' % (name, stage)
+                for bound in EXPORT_BOUNDS:
+                    out.append('%s_bucket{%s,le="%g"} %d' % (metric, labels, bound,
+                                                            h.count_below(bound * 1e6)))
+                out.append('%s_bucket{%s,le="+Inf"} %d' % (metric, labels, h.count))
+                out.append('%s_sum{%s} %.6f' % (metric, labels, h.total * 1e-6))
+                out.append('%s_count{%s} %d' % (metric, labels, h.count))
+
+        metric = prefix + '_ctrl_in_reports_total'
+        out.append('# HELP %s Control IN reports by opcode' % metric)
+        out.append('# TYPE %s counter' % metric)
+        for op, n in enumerate(self.in_counts):
+            if n:
+                out.append('%s{opcode="%s"} %d' % (metric,
+                    fb.HID_CTRL_IN_OPCODE.decoding.get(op, str(op)), n))
+
+        metric = prefix + '_nak_total'
+        out.append('# HELP %s NAK responses by errorCode' % metric)
+        out.append('# TYPE %s counter' % metric)
+        for code in sorted(self.naks):
+            out.append('%s{errorCode="%d",error="%s"} %d' % (metric, code,
+                fb.ERROR_CODES.get(code, 'unknown'), self.naks[code]))
+
+        out.append('# TYPE %s_data_in_bytes_total counter' % prefix)
+        out.append('%s_data_in_bytes_total %d' % (prefix, self.data_bytes))
+        out.append('# TYPE %s_data_in_reports_total counter' % prefix)
+        out.append('%s_data_in_reports_total %d' % (prefix, self.data_reports))
+        elapsed = self.clock() - self.started
+        out.append('# TYPE %s_data_in_bytes_per_second gauge' % prefix)
+        out.append('%s_data_in_bytes_per_second %.3f' % (prefix,
+            self.data_bytes / elapsed if elapsed > 0 else 0.0))
+        return '\n'.join(out) + '\n'
@@ -292,11 +292,15 @@ HID_CtrlOutEnableFirmware = Struct("HID_CtrlOutEnableFirmware",
     ULInt32("securityCode")
 )
 
+_default_out = {}
+
 def DefaultOut(datalen):
-    return Struct("HID_CTRL_OUT_DEFAULT",
-        Rename("hdr", HID_CtrlRptHdrOut),
-        HexDumpAdapter(String("payload", datalen - HID_CtrlRptHdrOut.sizeof()))
-    )
+    if datalen not in _default_out:
+        _default_out[datalen] = Struct("HID_CTRL_OUT_DEFAULT",
+            Rename("hdr", HID_CtrlRptHdrOut),
+            HexDumpAdapter(String("payload", datalen - HID_CtrlRptHdrOut.sizeof()))
+        )
+    return _default_out[datalen]
 
 HID_OUT_MAP = {
     "HID_CTRL_OUT_ECHO_REQUEST": HID_CtrlOutEchoRequest,
@@ -525,11 +529,15 @@ HID_CtrlInDataOutStatus = Struct("HID_CtrlInDataOutStatus",
     ULInt8("status")
 )
 
+_default_in = {}
+
 def DefaultIn(datalen):
-    return Struct("HID_CTRL_IN_DEFAULT",
-        Rename("hdr", HID_CtrlRptHdrIn),
-        HexDumpAdapter(String("payload", datalen - HID_CtrlRptHdrIn.sizeof()))
-    )
+    if datalen not in _default_in:
+        _default_in[datalen] = Struct("HID_CTRL_IN_DEFAULT",
+            Rename("hdr", HID_CtrlRptHdrIn),
+            HexDumpAdapter(String("payload", datalen - HID_CtrlRptHdrIn.sizeof()))
+        )
+    return _default_in[datalen]
 
 HID_IN_MAP = {
     'HID_CTRL_IN_ECHO_RESPONSE': HID_CtrlInEchoResponse,
@@ -953,3 +961,76 @@ RF_BondedStatus = Struct("RF_BondedStatus",
 
 def make_data_packet(pkt):
     return pkt + '\0'*(32 - len(pkt) - 1) + chr(len(pkt))
+
+# In a stream payload RF_PKT_MAGIC_BYTE is sent as ESCAPE ESCAPE1 and ESCAPE
+# as ESCAPE ESCAPE2, so no data packet starts with the magic byte. Both ways
+# are whole-buffer str.replace passes; nothing loops over bytes in Python.
+
+_RF_ESCAPE = chr(RF_PKT_ESCAPE_BYTE)
+_RF_ESCAPED_MAGIC = _RF_ESCAPE + chr(RF_PKT_ESCAPE1_BYTE)
+_RF_ESCAPED_ESCAPE = _RF_ESCAPE + chr(RF_PKT_ESCAPE2_BYTE)
+
+def _rf_bytes(data):
+    # str and bytearray have replace(); memoryview and buffer don't
+    if isinstance(data, (str, bytearray)):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return str(data)
+
+def rf_escape(data):
+    """Escapes a stream payload given as str, bytearray, memoryview or buffer
+
+    Returns a bytearray for a bytearray, else a str.
+    """
+    data = _rf_bytes(data)
+    if _RF_ESCAPE in data:
+        data = data.replace(_RF_ESCAPE, _RF_ESCAPED_ESCAPE)
+    if RF_PKT_MAGIC_BYTE in data:
+        data = data.replace(RF_PKT_MAGIC_BYTE, _RF_ESCAPED_MAGIC)
+    return data
+
+def rf_unescape(data):
+    """Undoes rf_escape; raises ValueError on an ESCAPE not followed by ESCAPE1/2"""
+    data = _rf_bytes(data)
+    if _RF_ESCAPE not in data:
+        return data
+    data = data.replace(_RF_ESCAPED_MAGIC, RF_PKT_MAGIC_BYTE)
+    # Every ESCAPE left has to start an ESCAPE ESCAPE2 pair
+    escapes = data.count(_RF_ESCAPE)
+    if escapes:
+        if data.count(_RF_ESCAPED_ESCAPE) != escapes:
+            raise ValueError("bad RF escape sequence")
+        data = data.replace(_RF_ESCAPED_ESCAPE, _RF_ESCAPE)
+    return data
+
+class RFUnescaper(object):
+    """rf_unescape for a payload that arrives in pieces
+
+    An ESCAPE at the end of one piece is held back until the next one brings
+    the other half of its pair. A piece with nothing to undo is returned as
+    it was given.
+    """
+    __slots__ = ('carry',)
+
+    def __init__(self):
+        self.carry = ''
+
+    def feed(self, data):
+        if self.carry:
+            data = self.carry + _rf_bytes(data)
+            self.carry = ''
+        else:
+            data = _rf_bytes(data) if isinstance(data, memoryview) else data
+            if _RF_ESCAPE not in data:
+                return data
+        if data[-1:] == _RF_ESCAPE:
+            self.carry = _RF_ESCAPE
+            data = data[:-1]
+        return rf_unescape(data)
+
+    def finish(self):
+        """Raises ValueError if the payload ended half way through a pair"""
+        if self.carry:
+            self.carry = ''
+            raise ValueError("payload ends mid escape")
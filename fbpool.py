@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# Multi-dongle device pool
+# ========================
+#
+# hid.enumerate lists two interfaces per dongle. find_dongles pairs them up
+# per dongle: by serial number when every serial shows up exactly twice,
+# else by USB device path, else in enumeration order. open_dongle opens a
+# pair and tells the control interface from the data one.
+#
+# A DevicePool gives each dongle its own worker thread with its own Client,
+# and so its own reader threads. Jobs are callables taking that Client;
+# submit() queues one on the least loaded dongle, run_each() one on every
+# dongle. sync_all() runs a Scheduler per dongle over one shared table.
+#
+# Telling the interfaces apart means sending Get Version and waiting up to
+# PROBE_TIMEOUT_MS for a reply, which only the control interface gives. An
+# InterfaceCache remembers which path answered, keyed by the dongle's serial
+# number and paths, so the next start probes that one first and gets its
+# reply straight away; a stale entry costs one timeout and is rewritten.
+#
+# The hid module is imported on first use; any object with its enumerate()
+# and device() (e.g. fbemu.Backend) can be passed as backend instead.
+
+import os
+import json
+import Queue
+import threading
+from collections import OrderedDict
+from fbclient import Client, Future
+import fbsched
+
+VID = 0x2687
+PID = 0xfb01
+
+PROBE_TIMEOUT_MS = 500
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.fbtools-interfaces.json')
+
+def _backend(backend):
+    if backend is None:
+        import hid
+        backend = hid
+    return backend
+
+def _by_serial(info):
+    return info.get('serial_number') or None
+
+def _by_device_path(info):
+    # libusb style paths are bus:device:interface
+    path = info['path']
+    return path.rsplit(':', 1)[0] if path.count(':') >= 2 else None
+
+def find_dongles(backend=None, vid=VID, pid=PID):
+    """Lists each dongle's pair of hid.enumerate() entries"""
+    infos = _backend(backend).enumerate(vid, pid)
+    for key in (_by_serial, _by_device_path):
+        groups = OrderedDict()
+        for info in infos:
+            groups.setdefault(key(info), []).append(info)
+        if None not in groups and all(len(g) == 2 for g in groups.values()):
+            return groups.values()
+    if len(infos) % 2:
+        raise IOError("odd number of dongle interfaces: %d" % len(infos))
+    return [infos[i:i + 2] for i in range(0, len(infos), 2)]
+
+def identify(devs):
+    """Orders an opened pair as (CtrlIF, DataIF)
+
+    Only the control interface answers Get Version, so the probe returns at
+    once if devs[0] is it and after PROBE_TIMEOUT_MS if not.
+    """
+    devs[0].write([2, 1]) # Get Version
+    resp = devs[0].read(32, timeout_ms=PROBE_TIMEOUT_MS)
+    if resp:
+        return devs[0], devs[1]
+    return devs[1], devs[0]
+
+class InterfaceCache(object):
+    """Which path of each dongle is its control interface, kept in a JSON file"""
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.entries = None
+
+    @staticmethod
+    def key(infos):
+        return '%s %s' % (infos[0].get('serial_number') or '',
+                          ' '.join(sorted(info['path'] for info in infos)))
+
+    def _load(self):
+        if self.entries is None:
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def get(self, infos):
+        return self._load().get(self.key(infos))
+
+    def put(self, infos, ctrl_path):
+        entries = self._load()
+        key = self.key(infos)
+        if entries.get(key) == ctrl_path:
+            return
+        entries[key] = ctrl_path
+        # Write and rename, so concurrent starts never read half a file
+        tmp = '%s.%d' % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+def open_dongle(infos, backend=None, cache=None):
+    """Opens a find_dongles() pair; returns (CtrlIF, DataIF)
+
+    With an InterfaceCache, the path it remembers as the control interface
+    is probed first.
+    """
+    backend = _backend(backend)
+    infos = list(infos)
+    if cache is not None:
+        ctrl_path = cache.get(infos)
+        infos.sort(key=lambda info: info['path'] != ctrl_path)
+    devs = []
+    for info in infos:
+        dev = backend.device()
+        dev.open_path(info['path'])
+        devs.append(dev)
+    ctrl, data = identify(devs)
+    if cache is not None:
+        cache.put(infos, infos[devs.index(ctrl)]['path'])
+    return ctrl, data
+
+def open_dongles(backend=None, vid=VID, pid=PID, cache=None):
+    backend = _backend(backend)
+    return [open_dongle(infos, backend, cache) for infos in find_dongles(backend, vid, pid)]
+
+class DongleWorker(threading.Thread):
+    def __init__(self, index, ctrl, data, **client_args):
+        threading.Thread.__init__(self, name='fbpool-%d' % index)
+        self.daemon = True
+        self.index = index
+        self.client = Client(ctrl, data, **client_args)
+        self.jobs = Queue.Queue()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, func, args = job
+            try:
+                future.set_result(func(self.client, *args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def pending(self):
+        return self.jobs.qsize()
+
+class DevicePool(object):
+    def __init__(self, dongles, **client_args):
+        """dongles is a list of (CtrlIF, DataIF) pairs, e.g. from open_dongles()"""
+        self.workers = [DongleWorker(i, ctrl, data, **client_args)
+                        for i, (ctrl, data) in enumerate(dongles)]
+        for w in self.workers:
+            w.start()
+
+    @classmethod
+    def open(cls, backend=None, vid=VID, pid=PID, cache=None, **client_args):
+        return cls(open_dongles(backend, vid, pid, cache), **client_args)
+
+    def __len__(self):
+        return len(self.workers)
+
+    def _put(self, worker, func, args):
+        future = Future()
+        worker.jobs.put((future, func, args))
+        return future
+
+    def submit(self, func, *args):
+        """Runs func(client, *args) on the dongle with the fewest queued jobs"""
+        worker = min(self.workers, key=DongleWorker.pending)
+        return self._put(worker, func, args)
+
+    def run_each(self, func, *args):
+        """Runs func(client, *args) once on every dongle; returns the futures"""
+        return [self._put(w, func, args) for w in self.workers]
+
+    def map(self, func, items, timeout=None):
+        futures = [self.submit(func, item) for item in items]
+        return [f.result(timeout) for f in futures]
+
+    def sync_all(self, discovery_msg, duration=None, max_syncs=None, **scheduler_args):
+        """Runs a Scheduler on every dongle over one shared tracker table
+
+        max_syncs is per dongle. Returns the combined stats.
+        """
+        shared = fbsched.SharedState()
+        def work(client):
+            s = fbsched.Scheduler(client, discovery_msg, shared=shared, **scheduler_args)
+            s.run(duration, max_syncs)
+            return s.stats()
+        stats = [f.result() for f in self.run_each(work)]
+        seconds = max(s['seconds'] for s in stats) if stats else 0.0
+        synced = sum(s['synced'] for s in stats)
+        return {
+            'dongles': len(stats),
+            'synced': synced,
+            'failed': sum(s['failed'] for s in stats),
+            'scans': sum(s['scans'] for s in stats),
+            'seconds': seconds,
+            'synced_per_hour': synced * 3600.0 / seconds if seconds > 0 else 0.0,
+        }
+
+    def close(self):
+        for w in self.workers:
+            w.jobs.put(None)
+        for w in self.workers:
+            w.join()
+            w.client.close()
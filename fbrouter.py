@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Opcode-indexed dispatch for HID IN reports
+# ==========================================
+#
+# A Router keeps a 256-entry table indexed by the raw opcode byte of the
+# report. Each report is parsed at most once, and only if someone is
+# subscribed to its opcode; the parsed result is handed to every subscriber.
+# A Router is itself a handler, so it can be passed to send_and_wait and
+# recv_all in place of a plain function.
+
+import struct
+import fbpacket as fb
+import fbdecode
+
+_OPCODE = struct.Struct('<xB')
+
+class Router(object):
+    def __init__(self, parse=fbdecode.parse_hid_IN, opcodes=fb.HID_CTRL_IN_OPCODE):
+        self.parse = parse
+        self.opcodes = opcodes
+        self.table = [()] * 256
+        self.default = ()
+
+    def _opcode(self, opcode):
+        if isinstance(opcode, int):
+            return opcode
+        return self.opcodes.encoding[opcode]
+
+    def register(self, opcode, handler):
+        """Subscribes handler to reports with the given opcode (name or byte)"""
+        op = self._opcode(opcode)
+        self.table[op] = self.table[op] + (handler,)
+
+    def unregister(self, opcode, handler):
+        op = self._opcode(opcode)
+        self.table[op] = tuple(h for h in self.table[op] if h is not handler)
+
+    def register_default(self, handler):
+        """Subscribes handler to every opcode with no handler of its own"""
+        self.default = self.default + (handler,)
+
+    def on(self, *opcodes):
+        """Decorator form of register"""
+        def decorate(handler):
+            for opcode in opcodes:
+                self.register(opcode, handler)
+            return handler
+        return decorate
+
+    def copy(self):
+        r = Router(self.parse, self.opcodes)
+        r.table = list(self.table)
+        r.default = self.default
+        return r
+
+    def dispatch(self, report):
+        """Parses report once and passes it to each subscriber
+
+        Returns the first result that isn't None, so a Router can stand in
+        for a single handler function.
+        """
+        handlers = self.table[_OPCODE.unpack_from(report)[0]] or self.default
+        if not handlers:
+            return None
+        response = self.parse(report)
+        result = None
+        for handler in handlers:
+            res = handler(response)
+            if result is None:
+                result = res
+        return result
+
+    __call__ = dispatch
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+# Multi-tracker sync scheduler
+# ============================
+#
+# A Scheduler works through the trackers in a DiscoveryTable, one
+# connect/sync/disconnect cycle at a time, and rescans when it runs out of
+# candidates. The next tracker is the one with the best score:
+#
+#   smoothed RSSI
+#   + UNSYNCED_BONUS unless RF_ServiceData says it synced recently
+#   + AGE_WEIGHT per hour since this scheduler last synced it (capped)
+#
+# A link that terminates or fails to come up puts the tracker on
+# exponential backoff, with jitter, instead of retrying it straight away. A
+# tracker that synced isn't due again for RESYNC_INTERVAL, so the others get
+# their turn. The table is rescanned every RESCAN_INTERVAL, and whenever
+# there's nothing to sync; with nothing due, run() sleeps until something
+# is. stats() reports trackers synced per hour.
+#
+# Schedulers for several dongles can work from one SharedState: the same
+# table and backoff states, and a busy set so a tracker that one of them is
+# syncing is skipped by the others.
+
+import os
+import time
+import random
+import threading
+import fbpacket as fb
+from fbclient import Timeout, CommandError, DependencyError
+from fbcmd import establishLinkEx, enableTX, terminateLink, initAirlink, readTrackerBlock
+from fbdiscovery import DiscoveryTable
+from fbstream import Reassembler, StreamError
+
+UNSYNCED_BONUS = 20.0
+AGE_WEIGHT = 2.0
+AGE_CAP_HOURS = 24.0
+
+# Candidates taken from each end of the table before scoring
+CANDIDATES = 16
+
+BACKOFF_BASE = 5.0
+BACKOFF_MAX = 600.0
+
+RESYNC_INTERVAL = 900.0
+RESCAN_INTERVAL = 60.0
+
+SYNC_TIMEOUT = 30.0
+
+def _rf_hdr(group, opcode, table):
+    return chr(fb.RF_PKT_GRP.encoding[group] << 4 | table.encoding[opcode])
+
+_AIRLINK_BLOCK = fb.RF_PKT_MAGIC_BYTE + _rf_hdr('RF_PKT_GRP_READ', 'RF_PKT_READ_AIRLINK_BLOCK', fb.RF_PKT_READ)
+
+class SyncError(Exception):
+    pass
+
+def connect(client, rec):
+    """Brings up the link and TX pipe to a tracker"""
+    with client.pipeline() as p:
+        link = p.submit(establishLinkEx(rec.addr))
+        tx = p.submit(enableTX)
+    try:
+        tx.result()
+    except DependencyError:
+        # Raises whatever the link attempt raised
+        response, _ = link.result()
+        raise SyncError("%s: %s" % (rec.addr, response.hdr.opcode))
+
+def _wait_data(client, prefix, deadline):
+    while True:
+        report = client.recv_data(max(0, deadline - time.time()))
+        if report is None:
+            raise Timeout("no %r on the data interface" % prefix)
+        if report.startswith(prefix):
+            return report
+
+def megadump_sync(client, rec, timeout=SYNC_TIMEOUT):
+    """Initializes the airlink and reads the megadump
+
+    Returns the megadump as an fbstream.Block, its CRC already checked.
+    """
+    deadline = time.time() + timeout
+    while client.recv_data(0) is not None:
+        pass
+    client.send_data(initAirlink)
+    _wait_data(client, _AIRLINK_BLOCK, deadline)
+    client.send_data(readTrackerBlock)
+    reassembler = Reassembler()
+    while True:
+        report = client.recv_data(max(0, deadline - time.time()))
+        if report is None:
+            raise Timeout("megadump from %s stalled" % rec.addr)
+        try:
+            block = reassembler.feed(report)
+        except StreamError as e:
+            raise SyncError("%s: %s" % (rec.addr, e))
+        if block is not None and block.blockType == 'RF_TRACKERBLOCK_MEGA_DUMP':
+            return block
+
+def disconnect(client):
+    try:
+        client.command(terminateLink)
+    except (Timeout, CommandError):
+        pass
+
+class TrackerState(object):
+    __slots__ = ('addr', 'last_sync', 'failures', 'next_attempt', 'syncs')
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.last_sync = None
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.syncs = 0
+
+class SharedState(object):
+    """What Schedulers on several dongles need to agree on"""
+
+    def __init__(self, table=None, clock=time.time):
+        self.table = DiscoveryTable(clock=clock) if table is None else table
+        self.lock = threading.RLock()
+        self.busy = set()
+        self.states = {}
+
+class Scheduler(object):
+    def __init__(self, client, discovery_msg, table=None, sync=megadump_sync,
+                 connect=connect, disconnect=disconnect, clock=time.time, seed=None,
+                 shared=None, resync_interval=RESYNC_INTERVAL,
+                 rescan_interval=RESCAN_INTERVAL, sleep=time.sleep, trace_dir=None):
+        if shared is None:
+            shared = SharedState(table, clock)
+        self.client = client
+        self.discovery_msg = discovery_msg
+        self.table = shared.table
+        self.lock = shared.lock
+        self.busy = shared.busy
+        self.states = shared.states
+        self.sync = sync
+        self.connect = connect
+        self.disconnect = disconnect
+        self.clock = clock
+        self.sleep = sleep
+        self.trace_dir = trace_dir
+        self.resync_interval = resync_interval
+        self.rescan_interval = rescan_interval
+        self.random = random.Random(seed)
+        self.started = clock()
+        self.last_scan = None
+        self.synced = 0
+        self.failed = 0
+        self.scans = 0
+
+    def state(self, addr):
+        s = self.states.get(addr)
+        if s is None:
+            s = self.states[addr] = TrackerState(addr)
+        return s
+
+    def score(self, rec, now):
+        s = rec.rssi
+        if not rec.synchedRecently:
+            s += UNSYNCED_BONUS
+        state = self.states.get(rec.addr)
+        if state is None or state.last_sync is None:
+            hours = AGE_CAP_HOURS
+        else:
+            hours = min(AGE_CAP_HOURS, (now - state.last_sync) / 3600.0)
+        return s + AGE_WEIGHT * hours
+
+    def _waiting(self, now):
+        return set(addr for addr, s in self.states.iteritems() if s.next_attempt > now)
+
+    def next_tracker(self):
+        """Claims the best tracker that isn't backing off or busy, or returns None"""
+        now = self.clock()
+        with self.lock:
+            exclude = self._waiting(now) | self.busy
+            candidates = dict((rec.addr, rec) for rec in
+                              self.table.best(CANDIDATES, unsynced=True, exclude=exclude) +
+                              self.table.best(CANDIDATES, unsynced=False, exclude=exclude))
+            if not candidates:
+                return None
+            rec = max(candidates.itervalues(), key=lambda rec: self.score(rec, now))
+            self.busy.add(rec.addr)
+            return rec
+
+    def _backoff(self, state):
+        state.failures += 1
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (state.failures - 1))
+        state.next_attempt = self.clock() + delay * (0.5 + self.random.random())
+
+    def _sync(self, rec):
+        self.connect(self.client, rec)
+        return self.sync(self.client, rec)
+
+    def attempt(self, rec):
+        """One connect/sync/disconnect cycle; returns the sync result or None
+
+        With trace_dir, a failed cycle writes the client's trace there, to
+        sync-<addr>.txt.
+        """
+        tracer = self.client.tracer
+        try:
+            if tracer is None or self.trace_dir is None:
+                result = self._sync(rec)
+            else:
+                path = os.path.join(self.trace_dir, 'sync-%s.txt' % rec.addr)
+                with tracer.dump_on_error(path, text=True):
+                    result = self._sync(rec)
+        except (SyncError, Timeout, CommandError):
+            self.failed += 1
+            with self.lock:
+                self._backoff(self.state(rec.addr))
+            return None
+        finally:
+            self.disconnect(self.client)
+            with self.lock:
+                self.busy.discard(rec.addr)
+        self.synced += 1
+        with self.lock:
+            state = self.state(rec.addr)
+            state.failures = 0
+            state.last_sync = self.clock()
+            state.next_attempt = state.last_sync + self.resync_interval
+            state.syncs += 1
+            self.table.mark_synced(rec.addr)
+        return result
+
+    def scan(self):
+        self.scans += 1
+        self.last_scan = self.clock()
+        trackers = self.client.discover(self.discovery_msg)
+        with self.lock:
+            for response in trackers:
+                self.table.update(response)
+        return len(trackers)
+
+    def run(self, duration=None, max_syncs=None, on_sync=None):
+        """Syncs trackers until duration seconds pass or max_syncs are done
+
+        on_sync(rec, result) is called after each successful sync.
+        """
+        end = None if duration is None else self.clock() + duration
+        while (end is None or self.clock() < end) and (max_syncs is None or self.synced < max_syncs):
+            scanned = self.last_scan is None or self.clock() >= self.last_scan + self.rescan_interval
+            if scanned:
+                self.scan()
+            rec = self.next_tracker()
+            if rec is None and not scanned:
+                self.scan()
+                rec = self.next_tracker()
+            if rec is None:
+                self._idle(end)
+                continue
+            result = self.attempt(rec)
+            if result is not None and on_sync is not None:
+                on_sync(rec, result)
+
+    def _idle(self, end):
+        # Until a tracker comes off backoff or resync, the next rescan, or
+        # the end of the run, whichever is first
+        wake = self.last_scan + self.rescan_interval
+        with self.lock:
+            for state in self.states.itervalues():
+                if state.addr not in self.busy:
+                    wake = min(wake, state.next_attempt)
+        if end is not None:
+            wake = min(wake, end)
+        self.sleep(max(0.0, wake - self.clock()))
+
+    def stats(self):
+        elapsed = self.clock() - self.started
+        return {
+            'synced': self.synced,
+            'failed': self.failed,
+            'scans': self.scans,
+            'seconds': elapsed,
+            'synced_per_hour': self.synced * 3600.0 / elapsed if elapsed > 0 else 0.0,
+        }
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# XFR2HOST stream reassembly
+# ==========================
+#
+# A tracker sends anything bigger than a packet as an XFR2HOST stream: an
+# RF_Xfr2HostStreamStartingPkt, the payload in data packets, then an
+# RF_Xfr2HostStreamFinishedPkt with the payload's crc16 and length. In the
+# payload RF_PKT_MAGIC_BYTE is sent as ESCAPE_BYTE ESCAPE1_BYTE and
+# ESCAPE_BYTE as ESCAPE_BYTE ESCAPE2_BYTE, so that no data packet starts
+# with the magic byte; an escape pair can straddle two packets.
+#
+# A Reassembler takes raw data reports one at a time. It strips the
+# make_data_packet padding, undoes the escaping with an fbpacket.RFUnescaper,
+# appends the payload to a bytearray and folds it into a running Crc16, so a
+# stream is checked the moment its last packet lands. blocks() turns a
+# sequence of reports into a generator of verified Blocks.
+# RF_PKT_XFR2HOST_SINGLE_BLOCK packets come out as Blocks too.
+
+import struct
+import fbpacket as fb
+from fbcrc import Crc16
+from construct import Container
+
+def _hdr(group, opcode):
+    return fb.RF_PktHdr.build(Container(rsvd=0, group=group, opcode=opcode))
+
+STREAM_STARTING = _hdr('RF_PKT_GRP_XFR2HOST', 'RF_PKT_XFR2HOST_STREAM_STARTING')
+STREAM_FINISHED = _hdr('RF_PKT_GRP_XFR2HOST', 'RF_PKT_XFR2HOST_STREAM_FINISHED')
+SINGLE_BLOCK = _hdr('RF_PKT_GRP_XFR2HOST', 'RF_PKT_XFR2HOST_SINGLE_BLOCK')
+
+# After the two header bytes: rsvd:4 blockType:4, then
+# numPayloadBytes (starting) or crc, numPayloadBytes (finished)
+_STARTING = struct.Struct('<BI')
+_FINISHED = struct.Struct('<BHI')
+
+_BLOCK_TYPES = fb.RF_TrackerBlock.decoding
+
+class StreamError(Exception):
+    pass
+
+class Block(object):
+    """One verified XFR2HOST transfer"""
+    __slots__ = ('blockType', 'data', 'crc')
+
+    def __init__(self, blockType, data, crc=None):
+        self.blockType = blockType
+        self.data = data
+        self.crc = crc
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<Block %s %d bytes>' % (self.blockType, len(self.data))
+
+class Reassembler(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forgets any stream in progress"""
+        self.blockType = None
+        self.expected = None
+        self.data = None
+        self.crc = None
+        self._unescaper = fb.RFUnescaper()
+
+    @property
+    def active(self):
+        return self.data is not None
+
+    def feed(self, report):
+        """Takes one data report; returns a Block if it completed one
+
+        Reports that aren't part of an XFR2HOST transfer are ignored outside
+        a stream. Raises StreamError, and drops the stream, on anything that
+        doesn't fit: a bad CRC or length, a header in mid-stream, or payload
+        outside a stream.
+        """
+        n = ord(report[-1]) if len(report) == fb.HID_REPORT_SIZE else len(report)
+        magic = report[0] == fb.RF_PKT_MAGIC_BYTE
+        if self.data is None:
+            if not magic:
+                raise StreamError("payload outside a stream")
+            hdr = report[:2]
+            if hdr == STREAM_STARTING:
+                bits, self.expected = _STARTING.unpack_from(report, 2)
+                self.blockType = _BLOCK_TYPES[bits & 0xF]
+                self.data = bytearray()
+                self.crc = Crc16()
+            elif hdr == SINGLE_BLOCK:
+                return Block(_BLOCK_TYPES[ord(report[2]) & 0xF], bytearray(buffer(report, 3, n - 3)))
+            return None
+
+        if magic:
+            if report[:2] != STREAM_FINISHED:
+                self.reset()
+                raise StreamError("stream interrupted by %s" % report[:2].encode('hex'))
+            return self._finish(report)
+
+        try:
+            chunk = self._unescaper.feed(buffer(report, 0, n))
+        except ValueError as e:
+            self.reset()
+            raise StreamError(str(e))
+        self.crc.update(chunk)
+        self.data += chunk
+        return None
+
+    def _finish(self, report):
+        bits, crc, length = _FINISHED.unpack_from(report, 2)
+        data, expected, ours, unescaper = self.data, self.expected, self.crc.crc, self._unescaper
+        blockType = self.blockType
+        self.reset()
+        try:
+            unescaper.finish()
+        except ValueError as e:
+            raise StreamError(str(e))
+        if not len(data) == length == expected:
+            raise StreamError("%s: got %d bytes, expected %d" % (blockType, len(data), length))
+        if ours != crc:
+            raise StreamError("%s: crc %04x, expected %04x" % (blockType, ours, crc))
+        return Block(blockType, data, crc)
+
+def blocks(reports, reassembler=None):
+    """Yields each verified Block as its last report arrives
+
+    StreamError propagates; reports after a bad stream need a new call.
+    """
+    feed = (reassembler or Reassembler()).feed
+    for report in reports:
+        block = feed(report)
+        if block is not None:
+            yield block
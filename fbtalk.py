@@ -1,217 +1,228 @@
 #!/usr/bin/env python
 
-import IPython
-import hid
 import time
 import fbpacket as fb
-from fbpacket import Container
+import fbpool
+import fbbulk
+from fbrouter import Router
+from fbhid import Transport
+from fbtrace import Tracer
+from fbmetrics import Metrics
+from fbclient import CommandError, DependencyError, Timeout, RttEstimator, TERMINAL, \
+    DEFAULT_TERMINAL, TRACE_FRAMES, command_name, command_duration
+from fbstream import Reassembler, StreamError
+from fbcmd import hid_out_template, HID_OUT_TEMPLATES, RF_TEMPLATES, establishLinkExTemplate, \
+    establishLinkEx, enableTX, initAirlink, readTrackerBlock
 from operator import attrgetter
 
 VID = 0x2687
 PID = 0xfb01
 
-beginServiceDiscovery = fb.HID_CtrlOutStartDiscovery.build(
-    Container(
-        hdr = Container(
-            length = fb.HID_CtrlOutStartDiscovery.sizeof(),
-            opcode = 'HID_CTRL_OUT_START_DISCOVERY',
-        ),
-        serviceUUID = 64256,
-        rxPortUUID = 64258,
-        baseUUID = [186, 86, 137, 166, 250, 191, 162, 189, 1, 70, 125, 110, 0, 0, 171, 173],
-        txPortUUID = 64257,
-        scanDuration = 5000,
-    )
-)
-
-def establishLinkEx(addr):
-    return fb.HID_CtrlOutEstablishLinkEx.build(
-        Container(
-            hdr = Container(
-                length = fb.HID_CtrlOutEstablishLinkEx.sizeof(),
-                opcode = 'HID_CTRL_OUT_ESTABLISH_LINK_EX',
-            ),
-            addr = addr,
-            addrType = 1,
-            minConnInterval = 6,
-            maxConnInterval = 6,
-            slaveLatency = 0,
-            connTimeout = 200,
-        )
-    )
+beginServiceDiscovery = hid_out_template('HID_CTRL_OUT_START_DISCOVERY',
+    serviceUUID = 64256,
+    rxPortUUID = 64258,
+    baseUUID = [186, 86, 137, 166, 250, 191, 162, 189, 1, 70, 125, 110, 0, 0, 171, 173],
+    txPortUUID = 64257,
+    scanDuration = 5000,
+).build()
+
+# establishLinkEx, enableTX, initAirlink and readTrackerBlock are shared
+# with fbsched, from fbcmd
+
+setTXTemplate = HID_OUT_TEMPLATES['HID_CTRL_OUT_ENABLE_TX_PIPE']
 
 def setTX(state):
-    return fb.HID_CtrlOutEnableTxPipe.build(
-        Container(
-            hdr = Container(
-                length = fb.HID_CtrlOutEnableTxPipe.sizeof(),
-                opcode = 'HID_CTRL_OUT_ENABLE_TX_PIPE',
-            ),
-            enable=state,
-        )
-    )
-
-enableTX = setTX(True)
+    return setTXTemplate.build(enable=state)
 
 disableTX = setTX(False)
 
+setTransmitterPowerTemplate = HID_OUT_TEMPLATES['HID_CTRL_OUT_SET_TRANSMITTER_POWER']
+
 def setTransmitterPower(power):
-    return fb.HID_CtrlOutSetTransmitterPower.build(
-        Container(
-            hdr = Container(
-                length = fb.HID_CtrlOutSetTransmitterPower.sizeof(),
-                opcode = 'HID_CTRL_OUT_SET_TRANSMITTER_POWER',
-                ),
-            transmitterPower = power,
-        )
-    )
-
-forceDisconnect = fb.HID_CtrlOutForceDisconnect.build(
-    Container(
-        hdr = Container(
-            length = fb.HID_CtrlOutForceDisconnect.sizeof(),
-            opcode = 'HID_CTRL_OUT_FORCE_DISCONNECT',
-        )
-    )
-)
-
-enableFirmware = fb.HID_CtrlOutEnableFirmware.build(
-    Container(
-        hdr = Container(
-            length = fb.HID_CtrlOutEnableFirmware.sizeof(),
-            opcode = 'HID_CTRL_OUT_ENABLE_FIRMWARE',
-        ),
-        invertedSecurityCode = ~fb.ENABLE_IMAGE_SECURITY_CODE & 0xFFFFFFFF,
-        securityCode = fb.ENABLE_IMAGE_SECURITY_CODE,
-    )
-)
-
-destroyFirmware = fb.HID_CtrlOutDestroyImage.build(
-    Container(
-        hdr = Container(
-            length = fb.HID_CtrlOutDestroyImage.sizeof(),
-            opcode = 'HID_CTRL_OUT_DESTROY_IMAGE',
-        ),
-        securityCode = fb.DESTROY_IMAGE_SECURITY_CODE,
-        invertedSecurityCode = ~fb.DESTROY_IMAGE_SECURITY_CODE & 0xFFFFFFFF,
-    )
-)
-
-initAirlink = fb.make_data_packet(fb.RF_InitAirlink.build(
-    Container(
-        hdr = Container(
-            rsvd = 0,
-            group = 'RF_PKT_GRP_MISC',
-            opcode = 'RF_PKT_MISC_INIT_AIRLINK'
-        ),
-        majorHostVersion = 10,
-        minorHostVersion = 4,
-        minConnInterval = 6,
-        maxConnInterval = 6,
-        slaveLatency = 0,
-        connTimeout = 200
-    )
-))
-
-readTrackerBlock = fb.make_data_packet(fb.RF_ReadTrackerBlockPkt.build(
-    Container(
-        hdr = Container(
-            rsvd = 0,
-            group = 'RF_PKT_GRP_READ',
-            opcode = 'RF_PKT_READ_TRACKER_BLOCK'
-        ),
-        rsvd = 0,
-        blockType = 'RF_TRACKERBLOCK_MEGA_DUMP'
-    )
-))
+    return setTransmitterPowerTemplate.build(transmitterPower=power)
+
+forceDisconnect = HID_OUT_TEMPLATES['HID_CTRL_OUT_FORCE_DISCONNECT'].build()
+
+enableFirmware = hid_out_template('HID_CTRL_OUT_ENABLE_FIRMWARE',
+    invertedSecurityCode = ~fb.ENABLE_IMAGE_SECURITY_CODE & 0xFFFFFFFF,
+    securityCode = fb.ENABLE_IMAGE_SECURITY_CODE,
+).build()
+
+destroyFirmware = hid_out_template('HID_CTRL_OUT_DESTROY_IMAGE',
+    securityCode = fb.DESTROY_IMAGE_SECURITY_CODE,
+    invertedSecurityCode = ~fb.DESTROY_IMAGE_SECURITY_CODE & 0xFFFFFFFF,
+).build()
+
+readTrackerMemoryTemplate = RF_TEMPLATES['RF_PKT_READ_TRACKER_MEMORY']
 
 def readTrackerMemory(start, size):
-    return fb.make_data_packet(fb.RF_ReadTrackerMemoryPkt.build(
-        Container(
-            hdr = Container(
-                rsvd = 0,
-                group = 'RF_PKT_GRP_READ',
-                opcode = 'RF_PKT_READ_TRACKER_MEMORY'
-            ),
-            startAddr = start,
-            numBytesToRead = size,
-        )
-    ))
+    return readTrackerMemoryTemplate.build(startAddr=start, numBytesToRead=size)
+
+setTrackerTimeTemplate = RF_TEMPLATES['RF_PKT_MISC_SET_DEVICE_CLOCK']
 
 def setTrackerTime(gmtTime):
-    return fb.make_data_packet(fb.RF_SetDeviceClockPkt.build(
-        Container(
-            hdr = Container(
-                rsvd = 0,
-                group = 'RF_PKT_GRP_MISC',
-                opcode = 'RF_PKT_MISC_SET_DEVICE_CLOCK'
-            ),
-            gmtTime = gmtTime,
-        )
-    ))
+    return setTrackerTimeTemplate.build(gmtTime=gmtTime)
+
+trackerEchoTemplate = RF_TEMPLATES['RF_PKT_MISC_ECHO_PACKET']
 
 def trackerEcho(payload):
-    return fb.make_data_packet(fb.RF_EchoPkt.build(
-        Container(
-            hdr = Container(
-                rsvd = 0,
-                group = 'RF_PKT_GRP_MISC',
-                opcode = 'RF_PKT_MISC_ECHO_PACKET'
-            ),
-            payloadBytes = payload + '\0'*(16-len(payload)),
-        )
-    ))
-
-
-
-def get_devs():
-    fb_devs = hid.enumerate(VID, PID)
-    assert len(fb_devs) == 2
-    devs = []
-    for d in fb_devs:
-        dev = hid.device()
-        dev.open_path(d['path'])
-        devs.append(dev)
-
-    # Detect control interface
-    devs[0].write([2,1]) # Get Version
-    resp = devs[0].read(32, timeout_ms=500)
-    if resp:
-        CtrlIF, DataIF = devs
+    return trackerEchoTemplate.build(payloadBytes=payload)
+
+
+
+# The last reports on the interfaces get_devs opens; connect_to_tracker
+# writes them to TRACE_PATH when it fails, as connect does a Client's
+TRACE_PATH = 'fbtalk-trace.txt'
+tracer = Tracer(TRACE_FRAMES)
+# Latencies and report counts on the same interfaces, for write_metrics
+METRICS_PATH = 'fbtalk.prom'
+metrics = Metrics()
+
+def get_devs(index=0, cache=True, trace=True):
+    """Opens one dongle's interfaces; index picks among several
+
+    With cache, which interface is the control one is remembered across
+    runs (see fbpool.InterfaceCache), so startup doesn't wait out a probe.
+    With trace, the interfaces go through tracer and metrics.
+    """
+    # Only opening a real dongle needs hidapi; fbemu stands in without it
+    import hid
+    dongles = fbpool.find_dongles(hid, VID, PID)
+    if not dongles:
+        raise IOError("no Fitbit dongle found")
+    devs = fbpool.open_dongle(dongles[index], hid,
+                              fbpool.InterfaceCache() if cache else None)
+    return metrics.wrap(*tracer.wrap(*devs)) if trace else devs
+
+def write_metrics(path=METRICS_PATH, client=None):
+    """Writes metrics, or client's, to path in the Prometheus text format"""
+    m = client.metrics if client is not None else metrics
+    with open(path, 'w') as f:
+        f.write(m.prometheus())
+
+def _traced(tracer, path, attempt):
+    # Runs attempt(); if it raises or returns False, writes the trace to path
+    if tracer is None or path is None:
+        return attempt()
+    with tracer.dump_on_error(path, text=True):
+        ok = attempt()
+    if ok is False:
+        tracer.dump(path, text=True)
+        print "Last %d reports written to %s" % (len(tracer), path)
+    return ok
+
+# Round trip times per HID_CTRL_OUT_OPCODE and RF packet opcode, and the
+# gaps between data reports under DATA_GAP
+rtt = RttEstimator()
+DATA_GAP = 'data gap'
+
+# How often a read that's waiting looks at its cancel Event
+CANCEL_POLL = 0.1
+
+def until_opcode(*opcodes):
+    """A stop predicate for iter_send: true for a control report with one of the opcodes"""
+    codes = frozenset(chr(fb.HID_CTRL_IN_OPCODE.encoding[op]) for op in opcodes)
+    return lambda response: response[1] in codes
+
+def _read(transport, wait, cancel):
+    # One report, as a view of transport.buf, or None after wait seconds or
+    # once cancel is set
+    end = time.time() + wait
+    while cancel is None or not cancel.is_set():
+        left = end - time.time()
+        if left <= 0:
+            return None
+        if cancel is not None:
+            left = min(left, CANCEL_POLL)
+        # timeout_ms=0 would block
+        view = transport.recv(max(1, int(left * 1000)))
+        if view is not None:
+            return view
+    return None
+
+def _results(responses, handler):
+    for response in responses:
+        if handler is None:
+            yield response
+        else:
+            res = handler(response)
+            if res: yield res
+
+def iter_send(msg, interface, handler=None, stop=None, cancel=None):
+    """send_and_wait as a generator
+
+    Sends msg at once, then yields each response as it arrives or, with a
+    handler, each result that isn't empty. Ends when the interface goes
+    quiet, after the response stop(response) is true for (see until_opcode),
+    once the cancel Event is set, or when the caller stops iterating.
+    Nothing is read ahead of the caller, so nothing piles up.
+    """
+    hdr = bytes(bytearray(msg[:2]))
+    if hdr[0] == fb.RF_PKT_MAGIC_BYTE:
+        # Anything the tracker sends back answers a data packet
+        name, terminal, duration = fb.RF_PktHdr.parse(hdr).opcode, None, 0.0
     else:
-        DataIF, CtrlIF = devs
-    return CtrlIF, DataIF
+        name = command_name(msg)
+        terminal = set(fb.HID_CTRL_IN_OPCODE.encoding[op]
+                       for op in TERMINAL.get(name, DEFAULT_TERMINAL) + ('HID_CTRL_IN_NAK_RESPONSE',))
+        duration = command_duration(name, msg)
+    transport = Transport(interface)
+    transport.write(msg)
+    responses = _send_responses(transport, name, terminal, duration, time.time(), stop, cancel)
+    return _results(responses, handler)
 
-def send_and_wait(msg, interface, handler):
-    results = []
-    interface.write([ord(c) for c in msg])
+def _send_responses(transport, name, terminal, duration, sent, stop, cancel):
+    done = sent + duration
+    answered = False
     while True:
-        x = interface.read(32, timeout_ms=2500)
-        if not x:
-            time.sleep(.5)
-            x = interface.read(32, timeout_ms=2500)
-            if not x:
-                break
-
-        response = ''.join(chr(c) for c in x)
-        res = handler(response)
-        if res: results.append(res)
-    return results
+        wait = max(0.0, done - time.time()) + rtt.timeout(name)
+        view = _read(transport, wait, cancel)
+        if view is None:
+            if not answered and not (cancel is not None and cancel.is_set()):
+                rtt.backoff(name)
+            return
+        if not answered and (terminal is None or ord(view[1]) in terminal):
+            answered = True
+            done = 0
+            rtt.sample(name, max(0.0, time.time() - sent - duration))
 
-def recv_all(interface, handler):
-    results = []
+        response = view.tobytes()
+        yield response
+        if stop is not None and stop(response):
+            return
+
+def iter_recv(interface, handler=None, stop=None, cancel=None):
+    """recv_all as a generator; see iter_send"""
+    return _results(_recv_responses(Transport(interface), stop, cancel), handler)
+
+def _recv_responses(transport, stop, cancel):
+    last = None
     while True:
-        x = interface.read(32, timeout_ms=2500)
-        if not x:
-            time.sleep(.5)
-            x = interface.read(32, timeout_ms=2500)
-            if not x:
-                break
-
-        response = ''.join(chr(c) for c in x)
-        res = handler(response)
-        if res: results.append(res)
-    return results
+        view = _read(transport, rtt.timeout(DATA_GAP), cancel)
+        if view is None:
+            return
+        now = time.time()
+        if last is not None:
+            rtt.sample(DATA_GAP, now - last)
+        last = now
+
+        response = view.tobytes()
+        yield response
+        if stop is not None and stop(response):
+            return
+
+def send_and_wait(msg, interface, handler):
+    """Sends msg and handles what comes back until the interface goes quiet
+
+    Each read waits for the opcode's RTO (see fbclient.RttEstimator), plus
+    whatever is left of its duration, e.g. a discovery's scanDuration. The
+    first terminal response gives a round trip time sample.
+    """
+    return list(iter_send(msg, interface, handler))
+
+def recv_all(interface, handler):
+    """Handles data reports until none has come for the RTO of the gaps between them"""
+    return list(iter_recv(interface, handler))
 
 def print_tracker_info(response):
     print "  addrType:    %d" % response.addrType
@@ -221,17 +232,26 @@ def print_tracker_info(response):
     print "  serviceData: %s" % str(''.join(chr(x) for x in response.serviceData).encode('hex'))
     print "  serviceData: %s" % str(fb.RF_ServiceData.parse(''.join(chr(x) for x in response.serviceData)))
 
-def generic_handler(response):
-    response = fb.parse_hid_IN(response)
-    if response.hdr.opcode == 'HID_CTRL_IN_TRACE_MSG':
-        print "TRACE:", response.message[:response.message.find('\x00')]
-    elif  response.hdr.opcode == 'HID_CTRL_IN_TRACKER_DEVICE_INFO':
-        print "Found tracker:"
-        print_tracker_info(response)
-    elif response.hdr.opcode == 'HID_CTRL_IN_DISCOVERY_COMPLETE':
-        print "Discovery done, found %d trackers" % response.numTrackers
-    else:
-        print response
+def trace_handler(response):
+    print "TRACE:", response.message[:response.message.find('\x00')]
+
+def tracker_info_handler(response):
+    print "Found tracker:"
+    print_tracker_info(response)
+
+def discovery_complete_handler(response):
+    print "Discovery done, found %d trackers" % response.numTrackers
+
+def print_handler(response):
+    print response
+
+generic_handler = Router()
+generic_handler.register('HID_CTRL_IN_TRACE_MSG', trace_handler)
+generic_handler.register('HID_CTRL_IN_TRACKER_DEVICE_INFO', tracker_info_handler)
+generic_handler.register('HID_CTRL_IN_DISCOVERY_COMPLETE', discovery_complete_handler)
+generic_handler.register_default(print_handler)
+
+data_reassembler = Reassembler()
 
 def generic_data_handler(response):
     print "DATA IN:", response.encode('hex')
@@ -240,14 +260,23 @@ def generic_data_handler(response):
         print parsed
     except fb.ConstructError:
         pass
+    try:
+        block = data_reassembler.feed(response)
+    except StreamError as e:
+        print "STREAM ERROR:", e
+        return
+    if block is not None:
+        print "BLOCK:", block
+        return block
+
+discover_handler = generic_handler.copy()
+discover_handler.register('HID_CTRL_IN_TRACKER_DEVICE_INFO', lambda response: response)
 
-def discover_handler(response):
-    generic_handler(response)
-    response = fb.parse_hid_IN(response)
-    if response.hdr.opcode == 'HID_CTRL_IN_TRACKER_DEVICE_INFO':
-        return response
+def connect_to_tracker(ctrl, data, trace_path=TRACE_PATH):
+    """Connects to the nearest tracker; on failure, writes tracer to trace_path"""
+    return _traced(tracer, trace_path, lambda: _connect_to_tracker(ctrl, data))
 
-def connect_to_tracker(ctrl, data):
+def _connect_to_tracker(ctrl, data):
     print "Disconnecting..."
     send_and_wait(forceDisconnect, ctrl, generic_handler)
     print "Setting TX power to maximum."
@@ -256,11 +285,58 @@ def connect_to_tracker(ctrl, data):
     if not trackers:
         print "No trackers available, won't connect."
         return False
-    trackers.sort(key=attrgetter('rssi'))
+    trackers.sort(key=attrgetter('rssi'), reverse=True)
     send_and_wait(establishLinkEx(trackers[0].addr), ctrl, generic_handler)
     send_and_wait(enableTX, ctrl, generic_handler)
     recv_all(data, generic_data_handler)
 
-CtrlIF, DataIF = get_devs()
+def connect(client, trace_path=TRACE_PATH):
+    """connect_to_tracker on a Client, pipelining what doesn't depend on a response
+
+    On failure the client's trace is written to trace_path.
+    """
+    return _traced(client.tracer, trace_path, lambda: _connect(client))
+
+def _connect(client):
+    print "Disconnecting, setting TX power to maximum and discovering..."
+    with client.pipeline() as p:
+        p.submit(forceDisconnect)
+        p.submit(setTransmitterPower('TRANSMITTER_POWER_MAXIMUM'))
+        discovery = p.submit(beginServiceDiscovery, collect=('HID_CTRL_IN_TRACKER_DEVICE_INFO',))
+        _, trackers = discovery.result()
+        if not trackers:
+            print "No trackers available, won't connect."
+            return False
+        trackers.sort(key=attrgetter('rssi'), reverse=True)
+        link = p.submit(establishLinkEx(trackers[0].addr))
+        # Held back until the link is up (see fbclient.REQUIRES)
+        tx = p.submit(enableTX)
+        try:
+            tx.result()
+        except DependencyError:
+            # Report what the link attempt got: a NAK or timeout, or the
+            # response that wasn't LINK_ESTABLISHED
+            try:
+                reason, _ = link.result()
+            except (CommandError, Timeout) as reason:
+                pass
+            print "Link not established:", reason
+            return False
+        except (CommandError, Timeout) as e:
+            print "TX pipe not enabled:", e
+            return False
+    return True
+
+def read_memory(client, start, size, path=None, **kwargs):
+    """Reads start:start+size of the connected tracker's memory
+
+    readTrackerMemory reads split into fbbulk.CHUNK byte chunks, retried
+    when a stream goes wrong; see fbbulk.dump_memory for path and the rest.
+    """
+    return fbbulk.dump_memory(client, start, size, path, **kwargs)
+
+if __name__ == '__main__':
+    CtrlIF, DataIF = get_devs()
 
-IPython.embed()
+    import IPython
+    IPython.embed()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# Ring-buffer frame tracer
+# ========================
+#
+# A Tracer keeps the last N reports sent or received on either interface in
+# one preallocated bytearray, laid out as fbcapture records: timestamp,
+# direction, interface, length, then the report. Tracing a frame is a header
+# pack_into and a slice assignment, with nothing allocated, so it can stay on
+# for whole sessions.
+#
+# The buffer can be dumped at any point, or automatically when an exception
+# escapes a traced block, as a capture file or as CONTROL IN/OUT text that
+# parse_control_log reads. Data interface frames are written as DATA IN/OUT
+# lines, which parse_control_log skips.
+
+import sys
+import time
+import itertools
+from functools import partial
+import fbcapture
+from fbcapture import RECORD, DIR_IN, DIR_OUT, IF_CTRL, IF_DATA
+from binascii import hexlify
+from fbhid import Tap
+
+FRAMES = 1 << 16
+
+# Python 2 has no time.monotonic
+_clock = getattr(time, 'monotonic', time.time)
+
+_HDR = fbcapture._RECORD_HDR
+_HDR_SIZE = _HDR.size
+
+class _DumpOnError(object):
+    def __init__(self, tracer, path, text):
+        self.tracer = tracer
+        self.path = path
+        self.text = text
+
+    def __enter__(self):
+        return self.tracer
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tracer.dump(self.path, self.text)
+
+class Tracer(object):
+    def __init__(self, frames=FRAMES, clock=_clock):
+        self.frames = frames
+        self.clock = clock
+        self.buf = bytearray(RECORD.size * frames)
+        self.count = 0
+        # Frames before this one were cleared
+        self.start = 0
+        # next() on a count is atomic, so reader and writer threads can
+        # trace at once without claiming the same slot
+        self._seq = itertools.count()
+        self.trace = self._make_trace()
+
+    def wrap(self, ctrl, data):
+        """Traced stand-ins for the ctrl and data interfaces"""
+        trace = self.trace
+        return tuple(Tap(device, partial(trace, DIR_OUT, interface), partial(trace, DIR_IN, interface))
+                     for device, interface in ((ctrl, IF_CTRL), (data, IF_DATA)))
+
+    def _make_trace(self):
+        # Everything the hot path touches is bound here, once
+        buf = self.buf
+        pack_into = _HDR.pack_into
+        seq = self._seq
+        frames = self.frames
+        size = RECORD.size
+        maxlen = RECORD.size - _HDR_SIZE
+        clock = self.clock
+        def trace(direction, interface, report):
+            """Records one report: a str, bytearray or list of ints of up to 32 bytes"""
+            n = next(seq)
+            off = n % frames * size
+            length = len(report)
+            if length > maxlen:
+                # A longer slice assignment would grow the buffer
+                report = report[:maxlen]
+                length = maxlen
+            pack_into(buf, off, int(clock() * 1e9), direction, interface, length)
+            off += _HDR_SIZE
+            buf[off:off + length] = report
+            self.count = n + 1
+        return trace
+
+    def __len__(self):
+        return max(0, min(self.count - self.start, self.frames))
+
+    def clear(self):
+        # Interfaces from wrap() hold on to trace, so it keeps its counter
+        self.start = self.count
+
+    def __iter__(self):
+        """Yields (timestamp, direction, interface, report), oldest first"""
+        count = self.count
+        buf = self.buf
+        for n in xrange(max(self.start, count - self.frames), count):
+            off = (n % self.frames) * RECORD.size
+            timestamp, direction, interface, length = _HDR.unpack_from(buf, off)
+            off += _HDR_SIZE
+            yield timestamp, direction, interface, str(buf[off:off + length])
+
+    def dump_capture(self, path):
+        with fbcapture.CaptureWriter(path) as w:
+            for timestamp, direction, interface, report in self:
+                w.append(direction, interface, report, timestamp)
+
+    def dump_text(self, f=sys.stdout):
+        for timestamp, direction, interface, report in self:
+            f.write('[%d.%09d] %s %s bytes: %s\n' % (timestamp // 1000000000, timestamp % 1000000000,
+                'CONTROL' if interface == IF_CTRL else 'DATA',
+                'IN' if direction == DIR_IN else 'OUT', hexlify(report).upper()))
+
+    def dump(self, path, text=False):
+        """Writes the buffer to path, as text or as a capture"""
+        if text:
+            with open(path, 'w') as f:
+                self.dump_text(f)
+        else:
+            self.dump_capture(path)
+
+    def dump_on_error(self, path, text=False):
+        """Context manager that dumps the buffer to path if its block raises"""
+        return _DumpOnError(self, path, text)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+# Lazy views over raw HID reports
+# ===============================
+#
+# A view wraps a memoryview of the report and only decodes a field when it
+# is accessed, so a handler that just looks at hdr.opcode never pays for the
+# rest of the packet. Arrays of bytes come back as memoryview slices of the
+# report rather than lists. The view classes are generated from the same
+# construct definitions as fbpacket, walked the same way as fbdecode's
+# compiler does; packets that can't be laid out at fixed offsets get the
+# generic header + payload view.
+#
+# Like fbpacket.parse_hid_IN, a view only sees the report up to its length
+# byte: a field past that raises FieldError when it's accessed.
+
+import struct
+from construct import Container, FormatField, Pass, MappingError, FieldError
+import fbpacket as fb
+import fbdecode
+
+class LayoutError(Exception):
+    pass
+
+class PacketView(object):
+    """Base class for the generated views"""
+    __slots__ = ('_buf', '_off', '_end')
+    _fields = ()
+    # memoryview fields that construct decodes as a string rather than a list
+    _string_fields = ()
+    size = 0
+
+    def __init__(self, buf, off=0, end=None):
+        self._buf = buf
+        self._off = off
+        # Where the report ends, going by its length byte
+        self._end = _report_avail(buf) if end is None else end
+
+    def raw(self):
+        """The bytes this view covers"""
+        return self._buf[self._off:self._off + self.size]
+
+    def to_container(self):
+        """Decodes every field into a construct Container"""
+        c = Container()
+        for name in self._fields:
+            value = getattr(self, name)
+            if isinstance(value, PacketView):
+                value = value.to_container()
+            elif isinstance(value, memoryview):
+                if name in self._string_fields:
+                    value = value.tobytes()
+                else:
+                    value = list(bytearray(value))
+            c[name] = value
+        return c
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+            ', '.join('%s = %r' % (name, getattr(self, name)) for name in self._fields))
+
+def _report_avail(buf):
+    return min(struct.unpack_from('B', buf)[0], len(buf))
+
+def _past_end(view, start, size):
+    return FieldError("expected %d, found %d" % (size, max(0, view._end - start)))
+
+def _format_getter(off, packer):
+    unpack_from = packer.unpack_from
+    size = packer.size
+    def get(self):
+        start = self._off + off
+        if start + size > self._end:
+            raise _past_end(self, start, size)
+        return unpack_from(self._buf, start)[0]
+    return get
+
+def _mapping_getter(off, packer, cons):
+    unpack_from = packer.unpack_from
+    size = packer.size
+    decoding = cons.decoding
+    default = cons.decdefault
+    def get(self):
+        start = self._off + off
+        if start + size > self._end:
+            raise _past_end(self, start, size)
+        value = unpack_from(self._buf, start)[0]
+        try:
+            return decoding[value]
+        except KeyError:
+            if default is NotImplemented:
+                raise MappingError("no decoding mapping for %r [%s]" % (value, cons.subcon.name))
+            if default is Pass:
+                return value
+            return default
+    return get
+
+def _bytes_getter(off, length):
+    def get(self):
+        start = self._off + off
+        if start + length > self._end:
+            raise _past_end(self, start, length)
+        return self._buf[start:start + length]
+    return get
+
+def _string_getter(off, length, encoding):
+    def get(self):
+        start = self._off + off
+        if start + length > self._end:
+            raise _past_end(self, start, length)
+        s = self._buf[start:start + length].tobytes()
+        if encoding:
+            s = s.decode(encoding)
+        return s
+    return get
+
+def _mac_getter(off, length):
+    hexbyte = fbdecode._HEX_BYTE
+    def get(self):
+        start = self._off + off
+        if start + length > self._end:
+            raise _past_end(self, start, length)
+        return '-'.join([hexbyte[b] for b in bytearray(self._buf[start:start + length])])
+    return get
+
+def _array_getter(off, count, packer):
+    packer = struct.Struct('<%d%s' % (count, packer.format[1:]))
+    unpack_from = packer.unpack_from
+    size = packer.size
+    def get(self):
+        start = self._off + off
+        if start + size > self._end:
+            raise _past_end(self, start, size)
+        return unpack_from(self._buf, start)
+    return get
+
+def _optional_getter(off, packer):
+    unpack_from = packer.unpack_from
+    def get(self):
+        start = self._off + off
+        if start + packer.size > self._end:
+            return None
+        return unpack_from(self._buf, start)[0]
+    return get
+
+def _view_getter(off, cls):
+    def get(self):
+        return cls(self._buf, self._off + off, self._end)
+    return get
+
+class _Field(fbdecode.LayoutWalker):
+    """walk() returns (getter, size) for a field placed at offset off"""
+    error = LayoutError
+
+    def __init__(self, off):
+        self.off = off
+
+    def struct(self, cons):
+        cls = make_view(cons)
+        return _view_getter(self.off, cls), cls.size
+
+    def format(self, cons, packer):
+        return _format_getter(self.off, packer), packer.size
+
+    def mapping(self, cons):
+        if not isinstance(cons.subcon, FormatField):
+            raise LayoutError("can't lay out %s (%s)" % (cons.name, type(cons.subcon).__name__))
+        packer = self.packer(cons.subcon)
+        return _mapping_getter(self.off, packer, cons), packer.size
+
+    def mac(self, cons, length):
+        return _mac_getter(self.off, length), length
+
+    def string(self, cons, length, encoding):
+        return _string_getter(self.off, length, encoding), length
+
+    def static(self, cons, length):
+        return _bytes_getter(self.off, length), length
+
+    def array(self, cons, count, packer):
+        if packer.size == 1:
+            return _bytes_getter(self.off, count), count
+        return _array_getter(self.off, count, packer), count * packer.size
+
+    def optional(self, cons, packer):
+        # Optional() only works as the last field, since nothing after it
+        # has a fixed offset
+        return _optional_getter(self.off, packer), 0
+
+_views = {}
+
+def make_view(cons, name=None):
+    """Returns the view class for a fixed-layout construct Struct"""
+    if cons in _views:
+        return _views[cons]
+    attrs = {'__slots__': ()}
+    fields = []
+    off = 0
+    layout = _Field(off)
+    for sc in layout.fields(cons):
+        layout.off = off
+        getter, size = layout.walk(sc)
+        attrs[sc.name] = property(getter)
+        fields.append(sc.name)
+        off += size
+    attrs['_fields'] = tuple(fields)
+    attrs['size'] = off
+    cls = type(name or cons.name + 'View', (PacketView,), attrs)
+    _views[cons] = cls
+    return cls
+
+# Rename() renames the shared header Struct to "hdr", so name it explicitly
+HID_CtrlRptHdrInView = make_view(fb.HID_CtrlRptHdrIn, 'HID_CtrlRptHdrInView')
+
+HID_CtrlInDefaultView = type('HID_CtrlInDefaultView', (PacketView,), {
+    '__slots__': (),
+    '_fields': ('hdr', 'payload'),
+    '_string_fields': ('payload',),
+    'size': fb.HID_REPORT_SIZE,
+    'hdr': property(_view_getter(0, HID_CtrlRptHdrInView)),
+    'payload': property(lambda self: self._buf[self._off + HID_CtrlRptHdrInView.size:
+                                               self._end]),
+})
+
+def _build_in_table():
+    # None for opcodes fbpacket doesn't know, which parse_hid_IN refuses
+    table = [None] * 256
+    for opCode, opStr in fb.HID_CTRL_IN_OPCODE.decoding.items():
+        PktType = fb.HID_IN_MAP.get(opStr)
+        try:
+            table[opCode] = HID_CtrlInDefaultView if PktType is None else make_view(PktType)
+        except LayoutError:
+            table[opCode] = HID_CtrlInDefaultView
+    return table
+
+HID_IN_VIEWS = _build_in_table()
+
+HID_CtrlInVersionResponseView = make_view(fb.HID_CtrlInVersionResponse)
+HID_CtrlInVersionResponseExView = make_view(fb.HID_CtrlInVersionResponseEx)
+
+def view_hid_IN(data):
+    """Wraps a message received FROM the dongle in a lazy view"""
+    buf = data if isinstance(data, memoryview) else memoryview(data)
+    length, opCode = fbdecode._HDR.unpack_from(buf)
+    end = min(length, len(buf))
+    if opCode == fbdecode._VERSION_OPCODE:
+        if length <= fb.VERSION_RESPONSE_LEGACY_PKT_SIZE:
+            return HID_CtrlInVersionResponseView(buf, 0, end)
+        return HID_CtrlInVersionResponseExView(buf, 0, end)
+    cls = HID_IN_VIEWS[opCode]
+    if cls is None:
+        raise KeyError(opCode)
+    return cls(buf, 0, end)
@@ -1,19 +1,245 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import re
-import fbpacket
+import io
+import json
+import mmap
+import argparse
+import multiprocessing
+from collections import deque
+from binascii import unhexlify
+import fbdecode
+from utils import construct_dict, construct_pretty
 
 reg = re.compile(r'CONTROL (?P<direction>IN|OUT) bytes: (?P<data>[A-F0-9]+)')
 
-with open(sys.argv[1]) as logfile:
-    for line in logfile:
-        match = reg.search(line)
-        if match:
-            res = match.groupdict()
-            if res['direction'] == 'IN':
-                print "<== %s" % res['data']
-                print fbpacket.parse_hid_IN(res['data'].decode('hex'))
-            elif res['direction'] == 'OUT':
-                print "==> %s" % res['data']
-                print fbpacket.parse_hid_OUT(res['data'].decode('hex'))
+# Lines that can't match the regex are skipped with a plain substring search
+MARKER = 'CONTROL '
+
+BATCH_SIZE = 4096
+
+CHUNK_SIZE = 16 << 20
+# Log bytes decode_parallel has queued or decoded but not yet yielded, at
+# any -j. Decoded text runs to about four times the log it comes from.
+MAX_INFLIGHT = 128 << 20
+# Chunks shrink to give each worker two within MAX_INFLIGHT, but no further
+MIN_CHUNK_SIZE = 1 << 20
+
+def open_log(path):
+    """Memory-maps a log file; returns '' for an empty file"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def scan(buf, start=0, end=None):
+    """Yields (offset, direction, hexdata) for each matching line in buf[start:end]
+
+    offset is the position of the match. As with reg.search on each line,
+    only the first match on a line counts.
+    """
+    if end is None:
+        end = len(buf)
+    find = buf.find
+    match = reg.match
+    pos = find(MARKER, start, end)
+    while pos != -1:
+        m = match(buf, pos, end)
+        if m is None:
+            pos = find(MARKER, pos + 1, end)
+            continue
+        yield pos, m.group('direction'), m.group('data')
+        eol = find('\n', m.end(), end)
+        if eol == -1:
+            break
+        pos = find(MARKER, eol, end)
+
+def batches(matches, size=BATCH_SIZE, decode_batch=None):
+    """Groups matches and hex-decodes each group in a single unhexlify call"""
+    if decode_batch is None:
+        decode_batch = _decode_batch
+    batch = []
+    for item in matches:
+        batch.append(item)
+        if len(batch) == size:
+            yield decode_batch(batch)
+            batch = []
+    if batch:
+        yield decode_batch(batch)
+
+def _decode_batch(batch):
+    for _, _, data in batch:
+        if len(data) & 1:
+            raise TypeError("Odd-length string: %s" % data)
+    blob = unhexlify(''.join(data for _, _, data in batch))
+    out = []
+    pos = 0
+    for offset, direction, data in batch:
+        n = len(data) // 2
+        out.append((offset, direction, data, blob[pos:pos + n]))
+        pos += n
+    return out
+
+def _decode_lines(batch):
+    # _decode_batch, except that a line that isn't valid hex comes out with
+    # its error as raw instead of failing the batch
+    try:
+        return _decode_batch(batch)
+    except TypeError:
+        pass
+    out = []
+    for item in batch:
+        try:
+            out.extend(_decode_batch([item]))
+        except TypeError as e:
+            out.append(item + (e,))
+    return out
+
+def parse_packet(direction, raw):
+    if direction == 'IN':
+        return fbdecode.parse_hid_IN(raw)
+    return fbdecode.parse_hid_OUT(raw)
+
+_ARROWS = {'IN': '<==', 'OUT': '==>'}
+
+def format_text(offset, direction, data, packet):
+    return "%s %s\n%s\n" % (_ARROWS[direction], data, construct_pretty(packet))
+
+# sort_keys would push json onto its pure Python encoder
+_json_encode = json.JSONEncoder().encode
+
+def format_jsonl(offset, direction, data, packet):
+    return _json_encode({
+        'offset': offset,
+        'direction': direction,
+        'data': data,
+        'packet': construct_dict(packet),
+    }) + '\n'
+
+FORMATS = {
+    'text': format_text,
+    'jsonl': format_jsonl,
+}
+
+def decode(buf, start=0, end=None, fmt=format_text):
+    """Yields formatted output for the packets in buf[start:end], a batch at a time
+
+    A line that doesn't decode raises its error, but only once the output
+    for the lines before it (and, in text, its own arrow line) has been
+    yielded, as when the log was printed line by line.
+    """
+    for batch in batches(scan(buf, start, end), decode_batch=_decode_lines):
+        out = []
+        try:
+            for offset, direction, data, raw in batch:
+                if isinstance(raw, Exception):
+                    raise raw
+                out.append(fmt(offset, direction, data, parse_packet(direction, raw)))
+        except Exception:
+            error = sys.exc_info()
+            if fmt is format_text:
+                out.append("%s %s\n" % (_ARROWS[direction], data))
+            yield ''.join(out)
+            raise error[0], error[1], error[2]
+        yield ''.join(out)
+
+def chunk_bounds(buf, chunk_size=CHUNK_SIZE):
+    """Splits buf into (start, end) ranges of about chunk_size, ending on a newline"""
+    start = 0
+    size = len(buf)
+    while start < size:
+        end = buf.find('\n', min(start + chunk_size, size) - 1)
+        end = size if end == -1 else end + 1
+        yield start, end
+        start = end
+
+# Each pool worker maps the log once, in _init_worker
+_worker_buf = None
+
+def _init_worker(path):
+    global _worker_buf
+    _worker_buf = open_log(path)
+
+def _decode_chunk(args):
+    # (output, None), or the output up to a bad line and its error
+    start, end, fmt_name = args
+    out = []
+    try:
+        for text in decode(_worker_buf, start, end, FORMATS[fmt_name]):
+            out.append(text)
+    except Exception as e:
+        return ''.join(out), e
+    return ''.join(out), None
+
+def _chunk_output(result):
+    text, error = result
+    yield text
+    if error is not None:
+        raise error
+
+def _window(jobs, chunk_size, max_inflight):
+    # (chunk size, chunks in flight) for decode_parallel
+    chunk_size = min(chunk_size, max(max_inflight // (2 * jobs), MIN_CHUNK_SIZE))
+    return chunk_size, max(1, max_inflight // chunk_size)
+
+def decode_parallel(path, fmt_name='text', jobs=None, chunk_size=CHUNK_SIZE,
+                    max_inflight=MAX_INFLIGHT):
+    """Like decode, but hands line-aligned chunks of the log to a process pool
+
+    Output comes back in file order. Chunks covering at most about
+    max_inflight bytes of log are queued or held at any time, which bounds
+    memory however many jobs there are and however far the workers get
+    ahead of the consumer. With many jobs the chunks are made smaller, down
+    to MIN_CHUNK_SIZE, and past that fewer are kept in flight.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    chunk_size, window = _window(jobs, chunk_size, max_inflight)
+    pool = multiprocessing.Pool(jobs, _init_worker, (path,))
+    try:
+        pending = deque()
+        for start, end in chunk_bounds(open_log(path), chunk_size):
+            if len(pending) >= window:
+                for text in _chunk_output(pending.popleft().get()):
+                    yield text
+            pending.append(pool.apply_async(_decode_chunk, ((start, end, fmt_name),)))
+        while pending:
+            for text in _chunk_output(pending.popleft().get()):
+                yield text
+    finally:
+        # Not terminate(): on Python 2 it can hang when it cuts a run short,
+        # as a bad line does. What's still queued is at most max_inflight.
+        pool.close()
+        pool.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Decode CONTROL IN/OUT lines from a dongle log')
+    parser.add_argument('logfile')
+    parser.add_argument('-f', '--format', choices=sorted(FORMATS), default='text')
+    parser.add_argument('-o', '--output', help='write here instead of stdout')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='decode with this many processes (0 for one per core); '
+                             'together they hold at most %d MB of log, about four '
+                             'times that as text' % (MAX_INFLIGHT >> 20))
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='bytes of log per parallel work unit, made smaller '
+                             'to fit two per process in that limit')
+    args = parser.parse_args(argv)
+
+    if args.jobs == 1:
+        chunks = decode(open_log(args.logfile), fmt=FORMATS[args.format])
+    else:
+        chunks = decode_parallel(args.logfile, args.format, args.jobs or None, args.chunk_size)
+    if args.output:
+        out = io.open(args.output, 'wb', buffering=1 << 20)
+    else:
+        out = io.open(sys.stdout.fileno(), 'wb', buffering=1 << 20, closefd=False)
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        out.close()
+
+if __name__ == '__main__':
+    main()
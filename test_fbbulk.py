@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# fbbulk memory reads against the emulator, one at a time and pipelined,
+# over links that lose and reorder reports, and resumed after a drop.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import fbemu
+import fbclient
+import fbsched
+import fbbulk
+
+SIZE = 16384
+CHUNK = 512
+
+class ReadMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            self.client.close()
+        shutil.rmtree(self.dir)
+
+    def connect(self, **dongle_args):
+        self.tracker = fbemu.make_trackers(1, seed=1)[0]
+        self.dongle = fbemu.Dongle([self.tracker], latency=0.005, report_interval=0.0001,
+                                   seed=3, **dongle_args)
+        self.client = fbclient.Client(*self.dongle.interfaces(), poll_ms=20)
+        fbsched.connect(self.client, self.tracker)
+
+    def read(self, start=0, size=SIZE, **kwargs):
+        return fbbulk.dump_memory(self.client, start, size, chunk=CHUNK, **kwargs)
+
+    def test_one_at_a_time(self):
+        self.connect()
+        self.assertEqual(self.read(window=1), self.tracker.memory[:SIZE])
+
+    def test_window(self):
+        self.connect()
+        self.assertEqual(self.read(100, window=4), self.tracker.memory[100:100 + SIZE])
+
+    def test_window_loss(self):
+        self.connect(loss=0.005)
+        self.assertEqual(self.read(window=4), self.tracker.memory[:SIZE])
+
+    def test_window_reorder(self):
+        self.connect(reorder=0.005)
+        self.assertEqual(self.read(window=4), self.tracker.memory[:SIZE])
+
+    def test_refused(self):
+        self.connect()
+        self.assertRaises(fbbulk.ReadError, self.read, len(self.tracker.memory) - 100, 1000)
+
+    def test_resume(self):
+        path = os.path.join(self.dir, 'dump.bin')
+        self.connect()
+        size = 4 * SIZE
+        threading.Timer(0.1, self.dongle.drop_link).start()
+        self.assertRaises(fbclient.Timeout, self.read, size=size, path=path, window=4,
+                          timeout=0.3, retries=1)
+        self.assertTrue(os.path.exists(path + '.part'))
+        dump = fbbulk.MemoryDump(0, size, path, CHUNK)
+        missing = len(dump.missing())
+        dump.close()
+        self.assertTrue(0 < missing < size // CHUNK)
+
+        fbsched.connect(self.client, self.tracker)
+        self.assertEqual(self.read(size=size, path=path, window=4), path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.tracker.memory[:size])
+        self.assertFalse(os.path.exists(path + '.part'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Capture files written and read back: time range lookups across
+# TIME_STRIDE blocks, and the report types append() takes.
+
+import os
+import shutil
+import tempfile
+import unittest
+import fbcapture
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, timestamps, report='\x20\x0a'):
+        with fbcapture.CaptureWriter(self.path) as w:
+            for ts in timestamps:
+                w.append(fbcapture.DIR_IN, fbcapture.IF_CTRL, report, ts)
+        return fbcapture.CaptureReader(self.path)
+
+    def test_between_duplicate_timestamps(self):
+        # 3000 records at 0 fill more than two TIME_STRIDE blocks
+        timestamps = [0] * 3000 + [1] * 100 + [5] * (fbcapture.TIME_STRIDE + 10) + [9]
+        r = self.write(timestamps)
+        try:
+            for start, end in [(0, 1), (0, 2), (1, 5), (1, 6), (5, 6), (2, 5), (5, 10), (10, 20)]:
+                expected = len([ts for ts in timestamps if start <= ts < end])
+                self.assertEqual(len(list(r.between(start, end))), expected, (start, end))
+        finally:
+            r.close()
+
+    def test_between_spread(self):
+        timestamps = range(0, 5000, 2)
+        r = self.write(timestamps)
+        try:
+            for start, end in [(0, 1), (1, 3), (2047, 2050), (4000, 6000), (-5, 3)]:
+                got = [rec[0] for rec in r.between(start, end)]
+                self.assertEqual(got, [ts for ts in timestamps if start <= ts < end])
+        finally:
+            r.close()
+
+    def test_append_report_types(self):
+        report = [0x20, 0x0a] + range(30)
+        with fbcapture.CaptureWriter(self.path) as w:
+            for data in (report, str(bytearray(report)), bytearray(report),
+                         memoryview(bytearray(report))):
+                w.append(fbcapture.DIR_IN, fbcapture.IF_CTRL, data, 0)
+        r = fbcapture.CaptureReader(self.path)
+        try:
+            self.assertEqual([rec[3] for rec in r], [str(bytearray(report))] * 4)
+            self.assertEqual(list(r.indices(0x0a)), [0, 1, 2, 3])
+        finally:
+            r.close()
+
+if __name__ == '__main__':
+    unittest.main()
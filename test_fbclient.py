@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# RttEstimator on its own and as Client and Pipeline drive it: terminal
+# responses give samples, timeouts back off, whatever came in before them.
+# And the Metrics every Client keeps.
+
+import unittest
+import fbemu
+import fbclient
+import fbcmd
+
+class RttEstimatorTest(unittest.TestCase):
+    def test_initial(self):
+        rtt = fbclient.RttEstimator(initial=1.0)
+        self.assertEqual(rtt.timeout('x'), 1.0)
+
+    def test_sample(self):
+        rtt = fbclient.RttEstimator(min_rto=0.0)
+        rtt.sample('x', 0.1)
+        # SRTT + 4 * RTTVAR, with RTTVAR half the first sample
+        self.assertAlmostEqual(rtt.timeout('x'), 0.3)
+        self.assertEqual(rtt.timeout('y'), fbclient.COMMAND_TIMEOUT)
+
+    def test_min_rto(self):
+        rtt = fbclient.RttEstimator()
+        rtt.sample('x', 0.001)
+        self.assertEqual(rtt.timeout('x'), fbclient.MIN_RTO)
+
+    def test_backoff(self):
+        rtt = fbclient.RttEstimator(initial=1.0, max_rto=5.0)
+        rtt.backoff('x')
+        self.assertEqual(rtt.timeout('x'), 2.0)
+        rtt.backoff('x')
+        rtt.backoff('x')
+        self.assertEqual(rtt.timeout('x'), 5.0)
+        rtt.sample('x', 0.1)
+        self.assertLess(rtt.timeout('x'), 1.0)
+
+class TimeoutTest(unittest.TestCase):
+    # FORCE_DISCONNECT is only ever ACKed, so waiting on LINK_ESTABLISHED
+    # times out after a reply that isn't terminal
+    name = 'HID_CTRL_OUT_FORCE_DISCONNECT'
+    terminal = ('HID_CTRL_IN_LINK_ESTABLISHED',)
+
+    def setUp(self):
+        self.dongle = fbemu.Dongle(latency=0.001)
+        self.rtt = fbclient.RttEstimator(initial=0.05)
+        self.client = fbclient.Client(*self.dongle.interfaces(), poll_ms=10, rtt=self.rtt)
+        self.msg = fbcmd.HID_OUT_TEMPLATES[self.name].build()
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_command_backs_off(self):
+        for expected in (0.1, 0.2):
+            self.assertRaises(fbclient.Timeout, self.client.command, self.msg, self.terminal)
+            self.assertAlmostEqual(self.rtt.timeout(self.name), expected)
+            self.assertIsNone(self.rtt.srtt.get(self.name))
+
+    def test_pipeline_backs_off(self):
+        with self.client.pipeline() as p:
+            c = p.submit(self.msg, terminal=self.terminal)
+            self.assertRaises(fbclient.Timeout, c.result)
+        self.assertAlmostEqual(self.rtt.timeout(self.name), 0.1)
+        self.assertIsNone(self.rtt.srtt.get(self.name))
+
+    def test_terminal_response_samples(self):
+        self.client.command(self.msg)
+        self.assertIsNotNone(self.rtt.srtt.get(self.name))
+
+class MetricsTest(unittest.TestCase):
+    name = 'HID_CTRL_OUT_FORCE_DISCONNECT'
+
+    def test_command_latency(self):
+        client = fbclient.Client(*fbemu.Dongle(latency=0.001).interfaces(), poll_ms=10)
+        try:
+            msg = fbcmd.HID_OUT_TEMPLATES[self.name].build()
+            for _ in range(3):
+                client.command(msg)
+            snapshot = client.metrics.snapshot()
+            self.assertEqual(snapshot['latency'][self.name]['terminal']['count'], 3)
+            self.assertEqual(snapshot['in_reports']['HID_CTRL_IN_ACK_RESPONSE'], 3)
+            self.assertIn('fb_command_latency_seconds_count{opcode="%s",stage="terminal"} 3'
+                          % self.name, client.metrics.prometheus())
+        finally:
+            client.close()
+
+    def test_no_metrics(self):
+        client = fbclient.Client(*fbemu.Dongle().interfaces(), poll_ms=10, metrics=False)
+        client.close()
+        self.assertIsNone(client.metrics)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Parity of the compiled decoders with the construct parsers in fbpacket:
+# every opcode, every report length, seeded random payloads, and each of the
+# input types the transport hands over.
+
+import random
+import unittest
+import fbpacket as fb
+import fbdecode
+
+SEED = 2
+SAMPLES = 8
+
+def _inputs(report):
+    return [('str', report), ('bytearray', bytearray(report)),
+            ('memoryview', memoryview(report))]
+
+def _outcome(parse, data):
+    try:
+        return True, parse(data)
+    except Exception as e:
+        return False, e
+
+class ParityTest(unittest.TestCase):
+    def assertParity(self, parse, reference, report):
+        ok, expected = _outcome(reference, report)
+        for kind, data in _inputs(report):
+            got_ok, got = _outcome(parse, data)
+            msg = '%s %s' % (kind, report.encode('hex'))
+            if ok:
+                self.assertTrue(got_ok, '%s: raised %r' % (msg, got))
+                self.assertEqual(got, expected, msg)
+            else:
+                self.assertFalse(got_ok, '%s: fbpacket raised %r, got %r' % (msg, expected, got))
+
+    def reports(self, opcode, lengths, samples=SAMPLES):
+        rng = random.Random('%d %d' % (SEED, opcode))
+        for length in lengths:
+            for _ in range(samples):
+                payload = ''.join(chr(rng.randrange(256)) for _ in range(fb.HID_REPORT_SIZE - 2))
+                yield length, chr(length) + chr(opcode) + payload
+
+    def test_hid_in(self):
+        for opcode in sorted(fb.HID_CTRL_IN_OPCODE.decoding):
+            for length, report in self.reports(opcode, range(2, fb.HID_REPORT_SIZE + 1)):
+                self.assertParity(fbdecode.parse_hid_IN, fb.parse_hid_IN, report)
+
+    def test_hid_out(self):
+        # OUT reports aren't trimmed to their length byte, so the report
+        # itself gets shorter
+        for opcode in sorted(fb.HID_CTRL_OUT_OPCODE.decoding):
+            for length, report in self.reports(opcode, range(2, fb.HID_REPORT_SIZE + 1)):
+                self.assertParity(fbdecode.parse_hid_OUT, fb.parse_hid_OUT, report[:length])
+
+    def test_unknown_opcodes(self):
+        for table, parse, reference in [
+                (fb.HID_CTRL_IN_OPCODE, fbdecode.parse_hid_IN, fb.parse_hid_IN),
+                (fb.HID_CTRL_OUT_OPCODE, fbdecode.parse_hid_OUT, fb.parse_hid_OUT)]:
+            for opcode in range(256):
+                if opcode not in table.decoding:
+                    for _, report in self.reports(opcode, [fb.HID_REPORT_SIZE], 1):
+                        self.assertParity(parse, reference, report)
+
+if __name__ == '__main__':
+    unittest.main()
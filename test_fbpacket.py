@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# Round trips of the RF stream escaping, whole and split into reports, on
+# seeded random payloads; and rejection of malformed escapes, checked
+# against a byte-at-a-time reference decoder.
+
+import random
+import unittest
+import fbpacket as fb
+
+SEED = 21
+ROUNDS = 2000
+
+ESCAPE = chr(fb.RF_PKT_ESCAPE_BYTE)
+ESCAPE1 = chr(fb.RF_PKT_ESCAPE1_BYTE)
+ESCAPE2 = chr(fb.RF_PKT_ESCAPE2_BYTE)
+MAGIC = fb.RF_PKT_MAGIC_BYTE
+
+def random_payload(rng, size):
+    # Mostly the bytes escaping is about, so pairs turn up everywhere
+    alphabet = [MAGIC, ESCAPE, ESCAPE1, ESCAPE2, '\0']
+    return ''.join(rng.choice(alphabet) if rng.random() < 0.6 else chr(rng.randrange(256))
+                   for _ in xrange(size))
+
+def random_split(rng, data):
+    cuts = sorted(rng.sample(xrange(len(data) + 1), rng.randrange(min(len(data), 8) + 1)))
+    return [data[i:j] for i, j in zip([0] + cuts, cuts + [len(data)])]
+
+def reference_unescape(data):
+    out = []
+    i = 0
+    while i < len(data):
+        c = data[i]
+        if c == ESCAPE:
+            pair = data[i + 1:i + 2]
+            if pair == ESCAPE1:
+                out.append(MAGIC)
+            elif pair == ESCAPE2:
+                out.append(ESCAPE)
+            else:
+                raise ValueError("bad escape at %d" % i)
+            i += 2
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out)
+
+def unescape_pieces(pieces):
+    u = fb.RFUnescaper()
+    out = [str(bytearray(u.feed(piece))) for piece in pieces]
+    u.finish()
+    return ''.join(out)
+
+class RFEscapeTest(unittest.TestCase):
+    def test_round_trip(self):
+        rng = random.Random(SEED)
+        for _ in xrange(ROUNDS):
+            data = random_payload(rng, rng.randrange(64))
+            escaped = fb.rf_escape(data)
+            self.assertNotIn(MAGIC, escaped)
+            self.assertEqual(reference_unescape(escaped), data)
+            self.assertEqual(fb.rf_unescape(escaped), data)
+            for wrapped in (bytearray(data), memoryview(data), buffer(data)):
+                self.assertEqual(str(bytearray(fb.rf_escape(wrapped))), escaped)
+            self.assertIsInstance(fb.rf_escape(bytearray(data)), bytearray)
+            for wrapped in (bytearray(escaped), memoryview(escaped), buffer(escaped)):
+                self.assertEqual(str(bytearray(fb.rf_unescape(wrapped))), data)
+
+    def test_split_round_trip(self):
+        rng = random.Random(SEED + 1)
+        for _ in xrange(ROUNDS):
+            data = random_payload(rng, rng.randrange(64))
+            escaped = fb.rf_escape(data)
+            pieces = random_split(rng, escaped)
+            self.assertEqual(unescape_pieces(pieces), data)
+            self.assertEqual(unescape_pieces([memoryview(p) for p in pieces]), data)
+
+    def test_pair_split_across_reports(self):
+        for data in (MAGIC, ESCAPE, 'a' + MAGIC + 'b', ESCAPE * 3, MAGIC + ESCAPE):
+            escaped = fb.rf_escape(data)
+            for i in range(len(escaped)):
+                if escaped[i] == ESCAPE:
+                    self.assertEqual(unescape_pieces([escaped[:i + 1], escaped[i + 1:]]), data)
+
+    def test_report_sized_pieces(self):
+        # As a stream arrives: 20 byte chunks of the escaped payload
+        rng = random.Random(SEED + 2)
+        for _ in xrange(200):
+            data = random_payload(rng, rng.randrange(1, 1024))
+            escaped = fb.rf_escape(data)
+            pieces = [escaped[i:i + 20] for i in xrange(0, len(escaped), 20)]
+            self.assertEqual(unescape_pieces(pieces), data)
+
+    def test_malformed(self):
+        for bad in (ESCAPE, 'ab' + ESCAPE, ESCAPE + 'x', ESCAPE + ESCAPE,
+                    ESCAPE + ESCAPE + ESCAPE1, 'a' + ESCAPE + MAGIC + 'b'):
+            self.assertRaises(ValueError, fb.rf_unescape, bad)
+            self.assertRaises(ValueError, unescape_pieces, [bad])
+            self.assertRaises(ValueError, unescape_pieces, list(bad))
+
+    def test_random_input_agrees_with_reference(self):
+        rng = random.Random(SEED + 3)
+        rejected = 0
+        for _ in xrange(ROUNDS):
+            data = random_payload(rng, rng.randrange(1, 32))
+            try:
+                expected = reference_unescape(data)
+            except ValueError:
+                rejected += 1
+                self.assertRaises(ValueError, fb.rf_unescape, data)
+                self.assertRaises(ValueError, unescape_pieces, random_split(rng, data))
+            else:
+                self.assertEqual(fb.rf_unescape(data), expected)
+                self.assertEqual(unescape_pieces(random_split(rng, data)), expected)
+        self.assertTrue(0 < rejected < ROUNDS)
+
+if __name__ == '__main__':
+    unittest.main()
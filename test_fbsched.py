@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Scheduler runs against the emulator: every tracker gets its turn, and the
+# table is rescanned on a schedule rather than only when it runs dry.
+
+import os
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+import fbemu
+import fbclient
+import fbcmd
+import fbsched
+
+def discovery_msg():
+    return fbcmd.hid_out_template('HID_CTRL_OUT_START_DISCOVERY',
+        serviceUUID=64256, scanDuration=5000).build()
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.trackers = fbemu.make_trackers(3, seed=5)
+        self.dongle = fbemu.Dongle(self.trackers, scan_scale=0.001, latency=0.001, seed=1)
+        self.client = fbclient.Client(*self.dongle.interfaces(), poll_ms=20)
+
+    def tearDown(self):
+        self.client.close()
+
+    def run_scheduler(self, duration=None, max_syncs=None, **kwargs):
+        kwargs.setdefault('rescan_interval', 0.2)
+        s = fbsched.Scheduler(self.client, discovery_msg(), seed=1, **kwargs)
+        synced = Counter()
+        def on_sync(rec, result):
+            synced[rec.addr] += 1
+        s.run(duration, max_syncs, on_sync)
+        return s, synced
+
+    def test_each_tracker_synced_once(self):
+        s, synced = self.run_scheduler(max_syncs=len(self.trackers))
+        self.assertEqual(synced, Counter(t.addr for t in self.trackers))
+
+    def test_synced_tracker_waits_for_resync(self):
+        # Nothing is due again within the run, so it sits out the rest of
+        # it rescanning
+        s, synced = self.run_scheduler(duration=1.0)
+        self.assertEqual(synced, Counter(t.addr for t in self.trackers))
+        self.assertGreater(s.scans, 1)
+
+    def test_resync_interval(self):
+        s, synced = self.run_scheduler(duration=1.5, resync_interval=0.3)
+        self.assertEqual(sorted(synced), sorted(t.addr for t in self.trackers))
+        self.assertGreaterEqual(min(synced.values()), 2)
+        self.assertLessEqual(max(synced.values()) - min(synced.values()), 1)
+
+    def test_rescans_on_schedule(self):
+        s, synced = self.run_scheduler(max_syncs=len(self.trackers), rescan_interval=0.0)
+        self.assertEqual(s.scans, len(self.trackers))
+
+    def test_failed_sync_writes_trace(self):
+        self.client.close()
+        self.dongle = fbemu.Dongle(self.trackers, scan_scale=0.001, latency=0.001, seed=1,
+                                   connect_failure=1.0)
+        self.client = fbclient.Client(*self.dongle.interfaces(), poll_ms=20)
+        trace_dir = tempfile.mkdtemp()
+        try:
+            s, synced = self.run_scheduler(duration=0.5, trace_dir=trace_dir)
+            self.assertFalse(synced)
+            self.assertGreater(s.failed, 0)
+            self.assertTrue(os.listdir(trace_dir))
+            for name in os.listdir(trace_dir):
+                self.assertTrue(name.startswith('sync-'), name)
+        finally:
+            shutil.rmtree(trace_dir)
+
+if __name__ == '__main__':
+    unittest.main()
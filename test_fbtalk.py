@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# fbtalk.connect against the emulator, with links that come up and links
+# that don't, and the trace a failure leaves behind; read_memory over a link.
+
+import os
+import shutil
+import tempfile
+import unittest
+import fbemu
+import fbclient
+import fbtalk
+
+class NakDongle(fbemu.Dongle):
+    """Refuses every link"""
+    def _establish_link(self, cmd):
+        self._send(self.ctrl, [self._nak(fbemu.CONNECTION_FAILED)])
+
+    _establish_link_ex = _establish_link
+
+class ConnectTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.trace_path = os.path.join(self.dir, 'trace.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def connect(self, dongle=fbemu.Dongle, then=None, **dongle_args):
+        self.dongle = dongle(fbemu.make_trackers(3, seed=5), scan_scale=0.001,
+                             latency=0.001, seed=1, **dongle_args)
+        client = fbclient.Client(*self.dongle.interfaces(), poll_ms=20)
+        try:
+            ok = fbtalk.connect(client, self.trace_path)
+            if then is not None:
+                then(client)
+            return ok
+        finally:
+            client.close()
+
+    def test_connect(self):
+        self.assertTrue(self.connect())
+        self.assertTrue(self.dongle.tx_enabled)
+        self.assertFalse(os.path.exists(self.trace_path))
+
+    def test_read_memory(self):
+        def read(client):
+            memory = self.dongle.linked.memory
+            self.assertEqual(fbtalk.read_memory(client, 0x100, 5000), memory[0x100:0x100 + 5000])
+        self.assertTrue(self.connect(then=read))
+
+    def test_connect_failure(self):
+        # The link attempt fails, so TX is never enabled
+        self.assertFalse(self.connect(connect_failure=1.0))
+        self.assertIsNone(self.dongle.linked)
+        self.assertFalse(self.dongle.tx_enabled)
+
+    def test_failure_writes_trace(self):
+        self.assertFalse(self.connect(connect_failure=1.0))
+        with open(self.trace_path) as f:
+            trace = f.read()
+        # The link request out and its LINK_TERMINATED back
+        self.assertIn('CONTROL OUT bytes: 1112', trace)
+        self.assertIn('CONTROL IN bytes: 0305', trace)
+
+    def test_link_naked(self):
+        self.assertFalse(self.connect(NakDongle))
+        self.assertFalse(self.dongle.tx_enabled)
+
+    def test_no_trackers(self):
+        self.dongle = None
+        d = fbemu.Dongle([], scan_scale=0.001, latency=0.001)
+        client = fbclient.Client(*d.interfaces(), poll_ms=20)
+        try:
+            self.assertFalse(fbtalk.connect(client, None))
+        finally:
+            client.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# The lazy views against fbpacket.parse_hid_IN: every opcode, known or not,
+# and every report length, including ones too short for the packet type.
+
+import random
+import unittest
+from construct import FieldError
+import fbpacket as fb
+import fbview
+
+SEED = 3
+SAMPLES = 4
+
+def _outcome(parse, data):
+    try:
+        return True, parse(data)
+    except Exception as e:
+        return False, e
+
+def _decoded(data):
+    return fbview.view_hid_IN(data).to_container()
+
+class ViewParityTest(unittest.TestCase):
+    def test_hid_in(self):
+        rng = random.Random(SEED)
+        for opcode in range(256):
+            for length in range(2, fb.HID_REPORT_SIZE + 1):
+                for _ in range(SAMPLES):
+                    payload = ''.join(chr(rng.randrange(256)) for _ in range(fb.HID_REPORT_SIZE - 2))
+                    report = chr(length) + chr(opcode) + payload
+                    ok, expected = _outcome(fb.parse_hid_IN, report)
+                    got_ok, got = _outcome(_decoded, bytearray(report))
+                    msg = report.encode('hex')
+                    if ok:
+                        self.assertTrue(got_ok, '%s: raised %r' % (msg, got))
+                        self.assertEqual(got, expected, msg)
+                    else:
+                        self.assertFalse(got_ok, '%s: fbpacket raised %r, got %r' % (msg, expected, got))
+
+    def test_unknown_opcode(self):
+        for opcode in range(256):
+            if opcode not in fb.HID_CTRL_IN_OPCODE.decoding:
+                report = bytearray([fb.HID_REPORT_SIZE, opcode]) + bytearray(fb.HID_REPORT_SIZE - 2)
+                self.assertRaises(KeyError, fbview.view_hid_IN, report)
+
+    def test_header_of_short_report(self):
+        # Only the fields past the length byte are off limits
+        report = bytearray(fb.HID_REPORT_SIZE)
+        report[0] = 2
+        report[1] = fb.HID_CTRL_IN_OPCODE.encoding['HID_CTRL_IN_TRACKER_DEVICE_INFO']
+        view = fbview.view_hid_IN(report)
+        self.assertEqual(view.hdr.opcode, 'HID_CTRL_IN_TRACKER_DEVICE_INFO')
+        self.assertRaises(FieldError, getattr, view, 'addr')
+
+if __name__ == '__main__':
+    unittest.main()
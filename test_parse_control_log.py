@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# A line that won't decode, in the middle of a batch: the lines before it
+# come out before its error, serially and in parallel. And the bound on how
+# much of the log parallel decoding holds at once.
+
+import os
+import shutil
+import tempfile
+import unittest
+from construct import ConstructError
+import parse_control_log as pcl
+
+GOOD = ['CONTROL OUT bytes: 0202',
+        'CONTROL IN bytes: 1303C0FFEE00000101CE0201000000000000FB00000000000000000000000000']
+
+class BadLineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_log(self, bad, before=101, after=50):
+        lines = ['%d %s' % (i, GOOD[i % 2]) for i in range(before)]
+        lines.append('x ' + bad)
+        lines.extend('%d %s' % (i, GOOD[i % 2]) for i in range(after))
+        path = os.path.join(self.dir, 'control.log')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def expected(self, before=101):
+        return ''.join(pcl.decode('\n'.join(GOOD[i % 2] for i in range(before))))
+
+    def collect(self, chunks, error):
+        out = []
+        with self.assertRaises(error):
+            for chunk in chunks:
+                out.append(chunk)
+        return ''.join(out)
+
+    def test_odd_length(self):
+        buf = pcl.open_log(self.write_log('CONTROL IN bytes: 0302030'))
+        out = self.collect(pcl.decode(buf), TypeError)
+        self.assertEqual(out, self.expected() + '<== 0302030\n')
+
+    def test_bad_packet(self):
+        buf = pcl.open_log(self.write_log('CONTROL IN bytes: 0203'))
+        out = self.collect(pcl.decode(buf), ConstructError)
+        self.assertEqual(out, self.expected() + '<== 0203\n')
+
+    def test_parallel(self):
+        path = self.write_log('CONTROL IN bytes: 0302030', before=2001)
+        out = self.collect(pcl.decode_parallel(path, jobs=2, chunk_size=4096), TypeError)
+        self.assertEqual(out, self.expected(2001) + '<== 0302030\n')
+
+    def test_jsonl(self):
+        buf = pcl.open_log(self.write_log('CONTROL IN bytes: 0302030'))
+        out = self.collect(pcl.decode(buf, fmt=pcl.format_jsonl), TypeError)
+        self.assertEqual(out.count('\n'), 101)
+
+class InflightTest(unittest.TestCase):
+    def test_window(self):
+        mb = 1 << 20
+        # Few jobs: full chunks, two per job
+        self.assertEqual(pcl._window(2, 16 * mb, 128 * mb), (16 * mb, 8))
+        # Many jobs: smaller chunks, still two per job
+        self.assertEqual(pcl._window(32, 16 * mb, 128 * mb), (2 * mb, 64))
+        # Too many for that: fewer chunks in flight than two per job
+        for jobs in (64, 256, 1024):
+            chunk_size, window = pcl._window(jobs, 16 * mb, 128 * mb)
+            self.assertEqual(chunk_size, pcl.MIN_CHUNK_SIZE)
+            self.assertLessEqual(chunk_size * window, 128 * mb)
+        self.assertEqual(pcl._window(4, 16 * mb, mb // 2), (mb, 1))
+
+    def test_small_limit(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'control.log')
+            with open(path, 'w') as f:
+                f.write(''.join('%d %s\n' % (i, GOOD[i % 2]) for i in range(3000)))
+            expected = ''.join(pcl.decode(pcl.open_log(path)))
+            got = ''.join(pcl.decode_parallel(path, jobs=2, chunk_size=4096, max_inflight=8192))
+            self.assertEqual(got, expected)
+        finally:
+            shutil.rmtree(d)
+
+if __name__ == '__main__':
+    unittest.main()
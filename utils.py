@@ -1,7 +1,48 @@
-from construct import Container
+from construct import Container, ListContainer
 
 def construct_str(c):
     str = 'Container('
     str += ', '.join("%s = %s" % (field, construct_str(data) if isinstance(data, Container) else repr(data)) for field, data in c.items())
     str += ')'
     return str
+
+def construct_dict(c):
+    """Converts parsed construct data into plain types that json can dump"""
+    if isinstance(c, dict):
+        return dict((field, construct_dict(data)) for field, data in c.items())
+    if isinstance(c, list):
+        return [construct_dict(data) for data in c]
+    if isinstance(c, str):
+        # Raw payload bytes aren't necessarily valid UTF-8
+        return c.decode('latin-1')
+    return c
+
+def construct_pretty(c, nesting=1, indentation='    '):
+    """Same text as str(c) for parsed construct data, without the per-call
+    overhead of construct's recursion-locked __pretty_str__"""
+    if type(c) is ListContainer:
+        if not c:
+            return "[]"
+        ind = "\n" + indentation * nesting
+        if type(c[0]) is int:
+            # Arrays of plain integers, i.e. every Array(ULInt8(...)) field
+            items = map(repr, c)
+        else:
+            items = [_pretty_value(elem, nesting, indentation) for elem in c]
+        return "[" + ind + ind.join(items) + "\n" + indentation * (nesting - 1) + "]"
+    ind = indentation * nesting
+    attrs = [c.__class__.__name__ + ":"]
+    for k in c.keys():
+        if not k.startswith("_"):
+            attrs.append(ind + k + " = " + _pretty_value(c[k], nesting, indentation))
+    if len(attrs) == 1:
+        return "%s()" % (c.__class__.__name__,)
+    return "\n".join(attrs)
+
+def _pretty_value(v, nesting, indentation):
+    t = type(v)
+    if t is Container or t is ListContainer:
+        return construct_pretty(v, nesting + 1, indentation)
+    if hasattr(v, "__pretty_str__"):
+        return v.__pretty_str__(nesting + 1, indentation)
+    return repr(v)